@@ -0,0 +1,296 @@
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+import xarray as xr
+
+from catalog import DEFAULT_CATALOG
+from core import time_window_indices
+
+# GIF: своя палитра на каждый кадр. Общая палитра (по умолчанию в matplotlib) строится
+# только после последнего кадра, и до этого ffmpeg держит в памяти все кадры
+GIF_FILTER = 'split[a][b];[a]palettegen=stats_mode=single[p];[b][p]paletteuse=new=1'
+TIME_DIMS = ('time', 'valid_time')
+
+
+class AnimationTask(NamedTuple):
+    """Анимация одного загрязнителя в окне ±delta градусов вокруг точки."""
+
+    latitude: float
+    longitude: float
+    pollutant: str
+    output_file: str
+    delta: float = 0.5
+    title: Optional[str] = None
+
+
+def _resolve_variable(dataset: xr.Dataset, pollutant: str) -> Tuple[str, float]:
+    # Имя переменной в файле и множитель до μg/m³: pollutant — имя ESGCalculator (no2_conc)
+    # или имя из файла продукта каталога (no2), см. variables и scale в DEFAULT_CATALOG
+    if pollutant in dataset:
+        return pollutant, 1.0
+    for entry in DEFAULT_CATALOG:
+        for name, target in entry.get('variables', {}).items():
+            if target == pollutant and name in dataset:
+                return name, entry.get('scale', {}).get(target, 1.0)
+            if name == pollutant and target in dataset:
+                return target, 1.0
+    raise KeyError(f"Variable {pollutant!r} not found in the data files")
+
+
+def _index_range(axis: np.ndarray, lo: float, hi: float) -> slice:
+    rows = np.flatnonzero((axis >= lo) & (axis <= hi))
+    if len(rows) == 0:
+        rows = np.array([int(np.abs(axis - (lo + hi) / 2).argmin())])
+    return slice(int(rows[0]), int(rows[-1]) + 1)
+
+
+class LazyFrames:
+    """Кадры переменной в окне вокруг точки из лениво открытых NetCDF-файлов.
+
+    Файлы открываются без чтения данных; каждый кадр читает с диска только окно
+    одного шага времени, так что память не зависит ни от длины ряда, ни от размера
+    сетки. Уровни (pressure_level, level) выбираются ближайшим к level значением,
+    без level — первым.
+    """
+
+    def __init__(self, data_files: Sequence[str], pollutant: str, latitude: float, longitude: float,
+                 delta: float = 0.5, level: Optional[float] = None, start=None, stop=None):
+        self.datasets = [xr.open_dataset(path) for path in data_files]
+        # Файлы областей (fetch_areas) и продуктов покрывают разные участки и периоды: берём файл,
+        # где есть точка, с наибольшим числом шагов в окне, из равных — с самой мелкой сеткой
+        candidates = [ds for ds in self.datasets if _has_variable(ds, pollutant)]
+        if not candidates:
+            self.close()
+            raise KeyError(f"Variable {pollutant!r} not found in the data files")
+        dataset = max(candidates, key=lambda ds: _coverage(ds, latitude, longitude, start, stop))
+        name, self.scale = _resolve_variable(dataset, pollutant)
+        variable = dataset[name]
+        self.pollutant = pollutant
+        self.time_dim = next(dim for dim in variable.dims if dim in TIME_DIMS)
+
+        for dim in [dim for dim in variable.dims if dim not in (self.time_dim, 'latitude', 'longitude')]:
+            if level is not None and dim in variable.coords:
+                variable = variable.sel({dim: level}, method='nearest')
+            else:
+                variable = variable.isel({dim: 0})
+
+        # Долгота точки в конвенции файла (0..360 у глобальных продуктов)
+        lon_axis = variable.longitude.values
+        if lon_axis.max() > 180 and longitude < 0:
+            longitude += 360
+        rows = _index_range(variable.latitude.values, latitude - delta, latitude + delta)
+        cols = _index_range(lon_axis, longitude - delta, longitude + delta)
+        a, b = time_window_indices(variable[self.time_dim].values, start, stop)
+        self.window = variable.isel({'latitude': rows, 'longitude': cols, self.time_dim: slice(a, b)})
+        self.latitude = self.window.latitude.values
+        self.longitude = self.window.longitude.values
+        self.time = self.window[self.time_dim].values
+        self.units = 'μg/m³' if self.scale != 1.0 or 'conc' in name else variable.attrs.get('units', '')
+
+    def __len__(self) -> int:
+        return len(self.time)
+
+    def __getitem__(self, i: int) -> np.ndarray:
+        return self.window.isel({self.time_dim: i}).values.astype(np.float64) * self.scale
+
+    def value_range(self) -> Tuple[float, float]:
+        """Общая цветовая шкала: минимум и максимум по всем кадрам за один проход по одному кадру."""
+        lo, hi = np.inf, -np.inf
+        for i in range(len(self)):
+            frame = self[i]
+            if np.isfinite(frame).any():
+                lo, hi = min(lo, np.nanmin(frame)), max(hi, np.nanmax(frame))
+        if not np.isfinite(lo):
+            return 0.0, 1.0
+        return float(lo), float(hi if hi > lo else lo + 1e-12)
+
+    def close(self) -> None:
+        for dataset in self.datasets:
+            dataset.close()
+        self.datasets = []
+
+
+def _has_variable(dataset: xr.Dataset, pollutant: str) -> bool:
+    try:
+        _resolve_variable(dataset, pollutant)
+        return True
+    except KeyError:
+        return False
+
+
+def _coverage(dataset: xr.Dataset, latitude: float, longitude: float, start=None, stop=None) -> tuple:
+    lat, lon = dataset.latitude.values, dataset.longitude.values
+    if lon.max() > 180 and longitude < 0:
+        longitude += 360
+    contains = bool(lat.min() <= latitude <= lat.max() and lon.min() <= longitude <= lon.max())
+    time_dim = next((dim for dim in TIME_DIMS if dim in dataset.dims), None)
+    steps = 0
+    if time_dim is not None:
+        a, b = time_window_indices(dataset[time_dim].values, start, stop)
+        steps = max(b - a, 0)
+    step = abs(float(lat[1] - lat[0])) if len(lat) > 1 else np.inf
+    return contains, steps, -step
+
+
+def render_animation(frames: LazyFrames, output_file: str, fps: int = 4, dpi: int = 100,
+                     title: Optional[str] = None, coastlines: bool = True) -> Dict[str, Any]:
+    """Рисует кадры по одному и сразу передаёт их ffmpeg по конвейеру (GIF или MP4 по расширению).
+
+    Фигура создаётся один раз, между кадрами меняются только данные изображения и
+    заголовок; в памяти одновременно находятся один кадр и один растр фигуры.
+    """
+    import cartopy.crs as ccrs
+    import cartopy.feature as cfeature
+    from matplotlib import animation
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    if len(frames) == 0:
+        raise ValueError("No time steps to animate")
+    gif = output_file.lower().endswith('.gif')
+    writer = animation.FFMpegWriter(fps=fps, extra_args=['-filter_complex', GIF_FILTER] if gif else None)
+    if not writer.isAvailable():
+        raise RuntimeError("ffmpeg is required for animations (set animation.ffmpeg_path or install it)")
+
+    vmin, vmax = frames.value_range()
+    lat, lon = frames.latitude, frames.longitude
+    half_lat = abs(lat[1] - lat[0]) / 2 if len(lat) > 1 else 0.05
+    half_lon = abs(lon[1] - lon[0]) / 2 if len(lon) > 1 else 0.05
+    extent = [lon.min() - half_lon, lon.max() + half_lon, lat.min() - half_lat, lat.max() + half_lat]
+
+    fig = Figure(figsize=(10, 6))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(projection=ccrs.PlateCarree())
+    ax.set_extent(extent, crs=ccrs.PlateCarree())
+    if coastlines:
+        ax.add_feature(cfeature.COASTLINE)
+        ax.add_feature(cfeature.BORDERS, linestyle=':')
+    image = ax.imshow(frames[0], extent=extent, origin='upper' if lat[0] > lat[-1] else 'lower',
+                      transform=ccrs.PlateCarree(), cmap='viridis', vmin=vmin, vmax=vmax, interpolation='nearest')
+    fig.colorbar(image, ax=ax, orientation='vertical', pad=0.02,
+                 label=f'{frames.pollutant} ({frames.units})' if frames.units else frames.pollutant)
+    heading = ax.set_title('')
+    title = title or f'{frames.pollutant} around {np.mean(lat):.2f}°N, {np.mean(lon):.2f}°E'
+
+    started = time.perf_counter()
+    with writer.saving(fig, output_file, dpi):
+        for i in range(len(frames)):
+            if i:
+                image.set_data(frames[i])
+            heading.set_text(f'{title}\n{str(frames.time[i])[:16]}')
+            writer.grab_frame()
+    return {'output_file': output_file, 'frames': len(frames), 'seconds': time.perf_counter() - started}
+
+
+def render_task(task: AnimationTask, data_files: Sequence[str], fps: int = 4, dpi: int = 100,
+                level: Optional[float] = None, start=None, stop=None, coastlines: bool = True) -> Dict[str, Any]:
+    """Одна анимация в процессе-воркере; файл появляется под итоговым именем только целиком."""
+    import matplotlib
+    matplotlib.use('Agg')
+
+    root, extension = os.path.splitext(task.output_file)
+    tmp_file = f'{root}.part{extension}'
+    frames = LazyFrames(data_files, task.pollutant, task.latitude, task.longitude, task.delta, level, start, stop)
+    try:
+        result = render_animation(frames, tmp_file, fps=fps, dpi=dpi, title=task.title, coastlines=coastlines)
+        os.replace(tmp_file, task.output_file)
+    finally:
+        frames.close()
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    # ru_maxrss в КБ на Linux
+    return dict(result, output_file=task.output_file,
+                peak_rss_bytes=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+
+
+def render_animations(tasks: Sequence[AnimationTask], data_files: Sequence[str], workers: Optional[int] = None,
+                      **options) -> Iterator[Dict[str, Any]]:
+    """Анимации в параллельных процессах; результаты (или ошибки) отдаются по мере готовности."""
+    # spawn, как в JobQueue: воркеры не наследуют потоки и состояние matplotlib родителя
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count(),
+                             mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = {executor.submit(render_task, task, list(data_files), **options): task for task in tasks}
+        for future in as_completed(futures):
+            task = futures[future]
+            try:
+                yield future.result()
+            except Exception as e:
+                yield {'output_file': task.output_file, 'error': str(e)}
+
+
+def netcdf_files(paths: Sequence[str], extract_dir: str) -> List[str]:
+    # Архивы CDS (netcdf_zip) распаковываются один раз, воркеры открывают уже .nc
+    files = []
+    for path in paths:
+        if zipfile.is_zipfile(path):
+            target = os.path.join(extract_dir, os.path.splitext(os.path.basename(path))[0])
+            with zipfile.ZipFile(path) as archive:
+                archive.extractall(target)
+            files.extend(sorted(glob.glob(os.path.join(target, '*.nc'))))
+        else:
+            files.append(path)
+    return files
+
+
+def pack_tasks(sites: Sequence[Dict[str, Any]], pollutants: Sequence[str], output_dir: str, fmt: str = 'mp4',
+               delta: float = 0.5) -> List[AnimationTask]:
+    """Задачи на все пары площадка × загрязнитель; файлы называются {id}_{pollutant}.{fmt}."""
+    tasks = []
+    for i, site in enumerate(sites):
+        site_id = str(site.get('id', site.get('name', i)))
+        for pollutant in pollutants:
+            tasks.append(AnimationTask(float(site['latitude']), float(site['longitude']), pollutant,
+                                       os.path.join(output_dir, f'{site_id}_{pollutant}.{fmt}'),
+                                       float(site.get('delta', delta)), f'{pollutant} — {site_id}'))
+    return tasks
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render animation packs for many sites in parallel processes.")
+    parser.add_argument('data_files', nargs='+', help="CAMS netcdf_zip archives or NetCDF files")
+    parser.add_argument('--sites', required=True, help='JSON list of {"latitude", "longitude"} with optional "id"')
+    parser.add_argument('--pollutants', default='no2_conc', help="Comma-separated pollutant names")
+    parser.add_argument('--start', default=None, help="First time step, e.g. 2024-08-01")
+    parser.add_argument('--stop', default=None, help="End of the period (exclusive), e.g. 2024-09-01")
+    parser.add_argument('--format', choices=['mp4', 'gif'], default='mp4')
+    parser.add_argument('--fps', type=int, default=4)
+    parser.add_argument('--dpi', type=int, default=100)
+    parser.add_argument('--delta', type=float, default=0.5, help="Window half-size in degrees")
+    parser.add_argument('--level', type=float, default=None, help="Pressure level; the first one by default")
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--no-coastlines', action='store_true', help="Skip Natural Earth coastlines and borders")
+    parser.add_argument('-o', '--output-dir', default='animations')
+    args = parser.parse_args()
+
+    with open(args.sites) as f:
+        sites = json.load(f)
+    os.makedirs(args.output_dir, exist_ok=True)
+    tasks = pack_tasks(sites, args.pollutants.split(','), args.output_dir, args.format, args.delta)
+
+    with tempfile.TemporaryDirectory() as extract_dir:
+        data_files = netcdf_files(args.data_files, extract_dir)
+        failed = 0
+        for result in render_animations(tasks, data_files, args.workers, fps=args.fps, dpi=args.dpi,
+                                        level=args.level, start=args.start, stop=args.stop,
+                                        coastlines=not args.no_coastlines):
+            if 'error' in result:
+                failed += 1
+                print(f"FAILED {result['output_file']}: {result['error']}")
+            else:
+                print(f"{result['output_file']}: {result['frames']} frames in {result['seconds']:.1f}s, "
+                      f"peak RSS {result['peak_rss_bytes'] / 2 ** 20:.0f} MiB")
+    print(f"Rendered {len(tasks) - failed} of {len(tasks)} animations to {args.output_dir}")
+
+
+if __name__ == '__main__':
+    main()
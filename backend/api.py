@@ -1,113 +1,996 @@
-from fastapi import FastAPI, BackgroundTasks, HTTPException
+import asyncio
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+from fastapi import FastAPI, BackgroundTasks, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, PlainTextResponse, Response, StreamingResponse
 from pydantic import BaseModel, Field
 
-from typing import Dict, Any
-
-from main import AtmosphericLayerPollutantConverter, CopernicusDataFetcher, CopernicusDataHandler, ESGCalculator
+from datetime import datetime
+from typing import Dict, Any, List, Optional
+
+from core import (AtmosphericLayerPollutantConverter, ESGCalculator, MultiAreaDataHandler,
+                  compact_dataset, covering_areas, nearest_indices, time_window_indices)
+from core import Location as SiteLocation
+from batching import MicroBatcher, SingleFlight, compute_groups
+from catalog import DatasetCatalog, DatasetSpec, DatasetView
+from download_cache import DownloadCache
+from exceedance import ExceedanceEngine
+from export import ARROW_MEDIA_TYPE, PARQUET_MEDIA_TYPE, concat_scores, scores_table, serialize_table
+from jobs import JOB_DONE, JobQueue, JobStore
+from pyramid import TemporalPyramid
+from recompute import RecomputeScheduler, ScoreStore, detect_changes, merge_ingested
+from ranking import ANY, PEER_DIMENSIONS, PeerRanking
+from sharding import ShardBounds
+from timeseries import pollutant_series
+from zonal import ZonalStatistics
+from metrics import (finish_request_timings, registry, server_timing_header, start_request_timings,
+                     timed)
 
 app = FastAPI()
+logger = logging.getLogger(__name__)
 
 
 class Location(BaseModel):
     latitude: float = Field(..., ge=-90, le=90)
     longitude: float = Field(..., ge=-180, le=180)
     delta: float = Field(0.1, ge=0)
+    # Optional scoring period [start, stop); the whole loaded period by default
+    start: Optional[datetime] = None
+    stop: Optional[datetime] = None
+    # Comparison region half-size and the coarsest grid cell (degrees) it may be averaged at;
+    # the native grid when resolution is not set
+    region_delta: float = Field(1.0, gt=0)
+    resolution: Optional[float] = Field(None, gt=0)
 
 
 class AIRQualityData(BaseModel):
     pollution_index: float
     normalized_concentrations: Dict[str, float]
     pollution_trend: Dict[str, float]
+    # Catalog dataset the scores were computed on
+    dataset: Optional[str] = None
+
+
+class LocationBatch(BaseModel):
+    locations: List[Location] = Field(..., min_length=1)
+
+
+class RegionSweep(BaseModel):
+    north: float = Field(..., ge=-90, le=90)
+    south: float = Field(..., ge=-90, le=90)
+    west: float = Field(..., ge=-180, le=180)
+    east: float = Field(..., ge=-180, le=180)
+    step: float = Field(0.5, gt=0)
+    delta: float = Field(0.1, ge=0)
+
+
+class JobRequest(BaseModel):
+    kind: str = Field(..., pattern="^(heatmaps|animation|animation_mp4|batch_scores)$")
+    params: Dict[str, Any] = Field(default_factory=dict)
+
+
+class PeerScore(BaseModel):
+    company_id: str = Field(..., min_length=1)
+    score: float
+    industry: Optional[str] = None
+    size: Optional[str] = None
+    country: Optional[str] = None
+
+
+class PeerScoreBatch(BaseModel):
+    scores: List[PeerScore] = Field(..., min_length=1)
+
+
+class PeerPercentileRequest(BaseModel):
+    company_ids: List[str] = Field(..., min_length=1)
+    by: List[str] = Field(default_factory=lambda: list(PEER_DIMENSIONS))
+
+
+class TimelineRequest(BaseModel):
+    locations: List[Location] = Field(..., min_length=1)
+    # Calendar windows ("D", "W", "M", "Y") or sliding windows of `window` length every `step`, e.g. "30D" / "7D"
+    freq: Optional[str] = Field(None, pattern="^(D|W|M|Y)$")
+    window: Optional[str] = None
+    step: Optional[str] = None
+    start: Optional[datetime] = None
+    stop: Optional[datetime] = None
+
+
+class TimeseriesRequest(Location):
+    # Points kept per pollutant after downsampling
+    points: int = Field(1000, ge=3, le=20000)
+    method: str = Field("lttb", pattern="^(lttb|minmax)$")
+
+
+class ZoneComparison(Location):
+    # Zone name from ZONES_FILE; the smallest zone containing the point when not set
+    zone: Optional[str] = None
+
+
+class ZonalStatsRequest(BaseModel):
+    # All zones when not set
+    zones: Optional[List[str]] = None
+
+
+class RegionBox(BaseModel):
+    lat_min: float = Field(..., ge=-90, le=90)
+    lat_max: float = Field(..., ge=-90, le=90)
+    lon_min: float = Field(..., ge=-180, le=180)
+    lon_max: float = Field(..., ge=-180, le=180)
+
+
+class IngestRequest(BaseModel):
+    # CDS date or date range, e.g. "2024-08-21" or "2024-08-21/2024-08-22"
+    date: str = Field(..., pattern=r"^\d{4}-\d{2}-\d{2}(/\d{4}-\d{2}-\d{2})?$")
+
+
+class Company(BaseModel):
+    company_id: str = Field(..., min_length=1)
+    latitude: float = Field(..., ge=-90, le=90)
+    longitude: float = Field(..., ge=-180, le=180)
+
+
+class CompanyBatch(BaseModel):
+    companies: List[Company] = Field(..., min_length=1)
 
 
 class DataRequest(BaseModel):
     dataset_name: str
     parameters: Dict[str, Any]
+    area: Optional[List[float]] = None
 
 
 # Global variables
-combined_data = None
+# The default dataset is dataset_catalog.default_store.blocks (one catalog.DatasetView per
+# downloaded area); the WHO exceedance engine of each block is kept here by block version
+exceedance_engines: Dict[Optional[str], ExceedanceEngine] = {}
+zonal_statistics = None
+data_files = None
+job_queue = None
+recompute_scheduler = None
+ingest_lock = threading.Lock()
+peer_ranking = PeerRanking()
 pollutant_converter = AtmosphericLayerPollutantConverter()
 calculator = ESGCalculator(pollutant_converter)
 
+# CDS date range loaded at startup; POST /ingest adds later dates on top of it
+DATA_DATES = os.environ.get("DATA_DATES", "2024-08-01/2024-08-20")
+
+# CAMS products the API can score on (JSON list or path, catalog.DEFAULT_CATALOG when unset).
+# DEFAULT_DATASET is loaded at startup; the others are opened on the first request routed
+# to them, and at most DATASET_MAX_OPEN of those are kept in memory.
+DATASET_CATALOG = os.environ.get("DATASET_CATALOG")
+DEFAULT_DATASET = os.environ.get("DEFAULT_DATASET", "cams-europe")
+DATASET_MAX_OPEN = int(os.environ.get("DATASET_MAX_OPEN", 2))
+
+# JSON list of {"latitude", "longitude", "delta"} with an optional "id" or "name"; when set,
+# only the areas around these sites (and their comparison regions) are downloaded, and
+# their scores are kept up to date in the score store (see /scores).
+PORTFOLIO_FILE = os.environ.get("PORTFOLIO_FILE")
+REGION_DELTA = 1.0
+GRID_PADDING = 0.1
+
+# Downloads are cached by request hash, so restarts and other nodes sharing the
+# directory skip identical CDS requests
+DOWNLOAD_CACHE_DIR = os.environ.get("DOWNLOAD_CACHE_DIR", "../download_cache")
+DOWNLOAD_CACHE_MAX_BYTES = int(os.environ.get("DOWNLOAD_CACHE_MAX_BYTES", 20 * 1024 ** 3))
+# Archives of the loaded data are hard-linked here out of the cache (DOWNLOAD_DIR/<product>/<request hash>.zip),
+# so cache eviction never deletes a file that is being extracted or that jobs still read
+DOWNLOAD_DIR = os.environ.get("DOWNLOAD_DIR", "../copernicus_areas")
+
+# Sharding mode: this node loads and serves only the "south,north,west,east" tile of the grid
+# plus SHARD_HALO degrees around it, so comparison regions up to that size are answered
+# locally; router.py sends requests to the owning shard and merges larger regions.
+# pollution_trend (grid-wide in ESGCalculator) then describes the loaded block around the site.
+SHARD_BOUNDS = ShardBounds.parse(os.environ["SHARD_BOUNDS"]) if os.environ.get("SHARD_BOUNDS") else None
+SHARD_HALO = float(os.environ.get("SHARD_HALO", REGION_DELTA))
+
+# Change in pollution_index that marks an entry of /scores/changes as an alert
+SCORE_ALERT_THRESHOLD = float(os.environ.get("SCORE_ALERT_THRESHOLD", 0.05))
+# After /ingest, scores that moved less than this (with the same interpretation) are not saved again
+SCORE_TOLERANCE = float(os.environ.get("SCORE_TOLERANCE", 0.01))
+
+# GeoJSON with admin areas for zonal comparisons; rasterized grid weights are cached in ZONE_MASK_CACHE_DIR
+ZONES_FILE = os.environ.get("ZONES_FILE")
+ZONES_NAME_PROPERTY = os.environ.get("ZONES_NAME_PROPERTY", "name")
+ZONE_MASK_CACHE_DIR = os.environ.get("ZONE_MASK_CACHE_DIR", "../zone_masks")
+
+# Upper bound on sites computed at the same time by the streaming endpoints,
+# so one large batch cannot occupy the whole threadpool.
+STREAM_CONCURRENCY = 4
+MAX_SWEEP_POINTS = 10000
+
+# Concurrent single-site requests are computed together: identical ones share one result,
+# distinct ones arriving within MICROBATCH_WINDOW_MS go into one vectorized calculator call
+MICROBATCH_WINDOW = float(os.environ.get("MICROBATCH_WINDOW_MS", 2)) / 1000
+MICROBATCH_MAX_SIZE = int(os.environ.get("MICROBATCH_MAX_SIZE", 256))
+
+# Server-Timing headers for every response; otherwise only when the request sends "X-Timing: 1"
+TIMING_HEADERS = os.environ.get("TIMING_HEADERS", "0") == "1"
+LOOP_LAG_INTERVAL = 0.5
+
+
+def _portfolio_sites(spec: DatasetSpec) -> List[SiteLocation]:
+    if not PORTFOLIO_FILE:
+        return []
+    sites = [SiteLocation(site["latitude"], site["longitude"], site.get("delta", 0.1)) for site in _portfolio()
+             if spec.bounds.contains(site["latitude"], site["longitude"])]
+    if SHARD_BOUNDS is not None:
+        sites = [site for site in sites if SHARD_BOUNDS.contains(site.latitude, site.longitude)]
+    return sites
+
+
+def _download_areas(spec: DatasetSpec, sites: Optional[List[SiteLocation]] = None) -> Optional[List[list]]:
+    # CDS areas [north, west, south, east] downloaded for the product; None means all of it
+    sites = _portfolio_sites(spec) if sites is None else sites
+    if sites:
+        # Область каждой площадки должна вмещать и регион сравнения compare_point_to_region
+        return covering_areas(sites, padding=REGION_DELTA + GRID_PADDING)
+    if SHARD_BOUNDS is not None:
+        return [SHARD_BOUNDS.area(halo=SHARD_HALO + GRID_PADDING)]
+    return None
+
+
+def _planned_areas(spec: DatasetSpec) -> Optional[List[ShardBounds]]:
+    # Lets the catalog tell whether a product it has not opened yet would cover a location
+    areas = _download_areas(spec)
+    return [ShardBounds.from_area(area) for area in areas] if areas is not None else None
+
+
+def _download_dataset(date: str, spec: DatasetSpec, areas: Optional[List[Optional[ShardBounds]]] = None):
+    # One data block per downloaded area: [(data, area)], area None for the whole product.
+    # `areas` re-downloads the areas of loaded blocks (/ingest); by default they are planned
+    # from the portfolio sites or the shard tile.
+    # cdsapi is only needed here, so it stays out of the request path and worker imports
+    from fetchers import CopernicusDataFetcher
+
+    # Product, variables (only the pollutants ESGCalculator scores) and units come from the catalog entry
+    data_request = spec.request(date)
+
+    data_fetcher = CopernicusDataFetcher(cache=DownloadCache(DOWNLOAD_CACHE_DIR, max_bytes=DOWNLOAD_CACHE_MAX_BYTES))
+    if areas is None:
+        sites = _portfolio_sites(spec)
+        planned = _download_areas(spec, sites)
+        areas = [ShardBounds.from_area(area) for area in planned] if planned is not None else [None]
+        if sites:
+            registry.set_gauge("esg_download_areas", len(areas), dataset=spec.name)
+            registry.set_gauge("esg_portfolio_sites", len(sites), dataset=spec.name)
+            logger.info("Downloading %d %s areas for %d portfolio sites: %s", len(areas), spec.name, len(sites),
+                        planned)
+    with timed('loader.download'):
+        zip_files = data_fetcher.fetch_areas(data_request, [area.area() if area is not None else None for area in areas],
+                                             target_dir=os.path.join(DOWNLOAD_DIR, spec.name))
+
+    data_handler = MultiAreaDataHandler(zip_files)
+    data_handler.extract_and_load_data()
+    blocks = [(compact_dataset(spec.normalize(area_data), calculator.who_limits), area)
+              for area_data, area in zip(data_handler.get_area_data(), areas) if area_data is not None]
+    data_handler.close_data()
+    if not blocks:
+        raise RuntimeError(f"No {spec.name} data downloaded for {date}")
+    registry.set_gauge("esg_dataset_bytes", sum(data.nbytes for data, _ in blocks))
+    return blocks, zip_files
+
+
+def _prune_downloads(spec: DatasetSpec, keep: List[str]) -> None:
+    # Archives of earlier loads that nothing references any more; jobs queued on them fail cleanly
+    keep = {os.path.abspath(path) for path in keep}
+    for path in glob.glob(os.path.join(DOWNLOAD_DIR, spec.name, "*.zip")):
+        if os.path.abspath(path) not in keep:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def _load_catalog_dataset(spec: DatasetSpec):
+    blocks, zip_files = _download_dataset(spec.dates, spec)
+    # The data is in memory and jobs only read the default dataset's files
+    if spec.name != dataset_catalog.default:
+        _prune_downloads(spec, [])
+    return blocks
+
+
+dataset_catalog = DatasetCatalog.load(DATASET_CATALOG, DATA_DATES, _load_catalog_dataset, list(calculator.who_limits),
+                                      default=DEFAULT_DATASET, max_open=DATASET_MAX_OPEN, planner=_planned_areas)
+# pollution_index averages only the pollutants every product provides, so scores from different products compare
+calculator.index_pollutants = dataset_catalog.index_pollutants
+
+
+def _portfolio() -> List[Dict[str, Any]]:
+    with open(PORTFOLIO_FILE) as f:
+        return json.load(f)
+
+
+def _build_blocks(blocks: List[tuple]) -> List[DatasetView]:
+    return [DatasetView.build(dataset_catalog.default, data, list(calculator.who_limits), area) for data, area in blocks]
+
+
+def _publish_data(views: List[DatasetView], zip_files: List[str]) -> None:
+    # Derived structures are built before the blocks are swapped, so requests never
+    # see a block together with structures of another one
+    global exceedance_engines, zonal_statistics, data_files
+
+    engines = {view.version: exceedance_engines.get(view.version)
+               or ExceedanceEngine(view.data, pollutant_converter, calculator.who_limits) for view in views}
+    if ZONES_FILE and zonal_statistics is None:
+        zonal_statistics = ZonalStatistics.from_geojson(ZONES_FILE, ZONES_NAME_PROPERTY, cache_dir=ZONE_MASK_CACHE_DIR)
+    if zonal_statistics is not None:
+        with timed('loader.zone_masks'):
+            for view in views:
+                zonal_statistics.weights(view.data.latitude.values, view.data.longitude.values)
+    # Engines of the old blocks stay until the new ones are published (versions never repeat)
+    exceedance_engines = {**exceedance_engines, **engines}
+    data_files = zip_files
+    dataset_catalog.default_store.publish(views)
+    exceedance_engines = engines
+    _prune_downloads(dataset_catalog.default_store.spec, zip_files)
 
-def load_data():
-    global combined_data
-
-    parameters = {
-        'variable': [
-            'ammonia', 'carbon_monoxide', 'nitrogen_dioxide', 'ozone',
-            'particulate_matter_2.5um', 'particulate_matter_10um', 'sulphur_dioxide',
-            'non_methane_vocs', 'dust', 'formaldehyde', 'nitrogen_monoxide',
-            'pm2.5_total_organic_matter', 'pm10_wildfires', 'secondary_inorganic_aerosol'
-        ],
-        'model': ['ensemble'],
-        'level': ['0'],
-        'date': ['2024-08-01/2024-08-20'],
-        'type': ['forecast'],
-        'time': ['00:00'],
-        'leadtime_hour': ['0'],
-        'data_format': 'netcdf_zip'
-    }
-
-    data_request = DataRequest(
-        dataset_name='cams-europe-air-quality-forecasts',
-        parameters=parameters,
-    )
-
-    data_fetcher = CopernicusDataFetcher()
-    result = data_fetcher.fetch_data(data_request)
-
-    zip_file = '../copernicus_data.zip'
-    result.download(zip_file)
 
-    data_handler = CopernicusDataHandler(zip_file)
-    data_handler.extract_and_load_data()
-    combined_data = data_handler.get_combined_data()
+def load_data():
+    blocks, zip_files = _download_dataset(DATA_DATES, dataset_catalog.default_store.spec)
+    _publish_data(_build_blocks(blocks), zip_files)
+
+    # Portfolio companies get scores right away; after that only ingestions that touch
+    # their cells recompute them
+    if PORTFOLIO_FILE:
+        companies = [
+            {"company_id": str(site.get("id", site.get("name", i))), "latitude": site["latitude"],
+             "longitude": site["longitude"]}
+            for i, site in enumerate(_portfolio())
+        ]
+        recompute_scheduler.set_companies(companies)
+    # Companies registered through /scores/companies before the data was loaded are scored here too
+    if recompute_scheduler.company_ids:
+        summary = recompute_scheduler.rescore(dataset_catalog.default_store.blocks)
+        logger.info("Scored %d portfolio companies (%d alerts)", summary["companies"], summary["alerts"])
+
+
+def ingest(date: str) -> Dict[str, Any]:
+    """Loads `date` (CDS date range) on top of the current data and rescores the affected companies."""
+    with ingest_lock:
+        current = dataset_catalog.default_store.blocks
+        # The same areas again, so every new block extends the block of its area
+        blocks, zip_files = _download_dataset(date, dataset_catalog.default_store.spec,
+                                              [view.area for view in current])
+        new_data = {area: data for data, area in blocks}
+        views, changes = [], []
+        with timed('ingest.merge'):
+            for view in current:
+                if view.area not in new_data:
+                    views.append(view)
+                    changes.append(None)
+                    continue
+                merged = compact_dataset(merge_ingested(view.data, new_data[view.area]), calculator.who_limits)
+                changes.append(detect_changes(view.data, merged, list(calculator.who_limits)))
+                views.extend(_build_blocks([(merged, view.area)]))
+        _publish_data(views, data_files + [path for path in zip_files if path not in data_files])
+        return recompute_scheduler.rescore(views, changes)
+
+
+@app.middleware("http")
+async def instrument_requests(request: Request, call_next):
+    send_timings = TIMING_HEADERS or request.headers.get("x-timing") == "1"
+    token = start_request_timings() if send_timings else None
+    registry.inc("esg_http_requests_in_flight", 1)
+    start = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        registry.inc("esg_http_requests_in_flight", -1)
+    elapsed = time.perf_counter() - start
+
+    route = request.scope.get("route")
+    endpoint = route.path if route is not None else "unmatched"
+    registry.observe("esg_http_request_seconds", elapsed, endpoint=endpoint, status=response.status_code)
+    if token is not None:
+        timings = finish_request_timings(token)
+        timings["total"] = elapsed
+        response.headers["Server-Timing"] = server_timing_header(timings)
+    return response
+
+
+async def monitor_event_loop_lag():
+    # Насколько позже запланированного просыпается цикл событий: рост значит,
+    # что обработчики блокируют его синхронными вычислениями.
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + LOOP_LAG_INTERVAL
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        registry.observe("esg_event_loop_lag_seconds", max(0.0, loop.time() - expected))
 
 
 @app.on_event("startup")
 async def startup_event():
+    global job_queue, recompute_scheduler
+
+    jobs_dir = os.environ.get("JOBS_DIR", "job_data")
+    os.makedirs(jobs_dir, exist_ok=True)
+    recompute_scheduler = RecomputeScheduler(calculator, ScoreStore(os.path.join(jobs_dir, "scores.sqlite3")),
+                                             alert_threshold=SCORE_ALERT_THRESHOLD, tolerance=SCORE_TOLERANCE)
+    job_queue = JobQueue(JobStore(os.path.join(jobs_dir, "jobs.sqlite3")),
+                         artifacts_dir=os.path.join(jobs_dir, "artifacts"),
+                         max_workers=int(os.environ.get("JOB_WORKERS", "2")))
+    job_queue.fail_interrupted()
+    asyncio.get_running_loop().create_task(monitor_event_loop_lag())
+
     background_tasks = BackgroundTasks()
     background_tasks.add_task(load_data)
     await background_tasks()
 
 
-@app.post("/esg_results", response_model=AIRQualityData)
-async def get_esg_results(location: Location):
-    global combined_data, calculator
-
-    print(combined_data)
-    if combined_data is None:
+def _route(location: Location, margin: float = 0.0):
+    store = dataset_catalog.route(location.latitude, location.longitude, location.resolution,
+                                  location.start, location.stop, margin)
+    if store is None:
+        raise HTTPException(status_code=404, detail="No dataset covers this location and period.")
+    return store
+
+
+def _open_view(location: Location, margin: float = 0.0) -> DatasetView:
+    # Catalog dataset for the location (see DatasetCatalog.route), opened if needed;
+    # the default one is only ever loaded by load_data
+    for _ in range(len(dataset_catalog.stores)):
+        store = _route(location, margin)
+        view = dataset_catalog.view(store, location.latitude, location.longitude, margin)
+        if view is not None:
+            return view
+        if store is dataset_catalog.default_store:
+            raise HTTPException(status_code=503, detail="Data not loaded yet. Please try again later.")
+        try:
+            dataset_catalog.open(store)
+        except Exception as e:
+            raise HTTPException(status_code=503, detail=f"Dataset {store.spec.name} could not be loaded: {e}")
+        # Once open, the store knows the areas it actually downloaded; if they miss the
+        # location, routing moves on to the next dataset
+        if store.covers(location.latitude, location.longitude, margin, location.start, location.stop):
+            return store.block(location.latitude, location.longitude, margin)
+    raise HTTPException(status_code=404, detail="No dataset covers this location and period.")
+
+
+async def _dataset_view(location: Location, margin: float = 0.0) -> DatasetView:
+    view = dataset_catalog.view(_route(location, margin), location.latitude, location.longitude, margin)
+    if view is None:
+        view = await run_in_threadpool(_open_view, location, margin)
+    return view
+
+
+def _default_blocks():
+    blocks = dataset_catalog.default_store.blocks
+    if blocks is None:
         raise HTTPException(status_code=503, detail="Data not loaded yet. Please try again later.")
+    return blocks
+
+
+def _default_block(latitude: float, longitude: float) -> DatasetView:
+    # Endpoints reading the default dataset directly: the block of the downloaded area around the point
+    _default_blocks()
+    view = dataset_catalog.default_store.block(latitude, longitude)
+    if view is None:
+        raise HTTPException(status_code=404, detail="Location is outside the loaded data areas.")
+    return view
+
+
+def _require_time_steps(view: DatasetView, location: Location) -> None:
+    # A window inside the covered period can still fall between time steps (or be empty, start == stop)
+    a, b = time_window_indices(view.temporal_pyramid.time, location.start, location.stop)
+    if a >= b:
+        raise HTTPException(status_code=422, detail="Invalid window: no time steps in [start, stop).")
+
+
+def _esg_results_batch(items: List[tuple]) -> List[Any]:
+    # One vectorized calculator call per dataset and scoring period present in the batch
+    return compute_groups(items, lambda item: (item[1].name, item[1].version, item[0].start, item[0].stop),
+                          _esg_results_group)
+
+
+def _esg_results_group(items: List[tuple]) -> List[Dict[str, Any]]:
+    view, start, stop = items[0][1], items[0][0].start, items[0][0].stop
+    batch = calculator.calculate_indicators_batch(view.data, [location.latitude for location, _ in items],
+                                                  [location.longitude for location, _ in items],
+                                                  start=start, stop=stop, pyramid=view.temporal_pyramid)
+    pollutants = batch["pollutants"]
+    trend = dict(zip(pollutants, batch["pollution_trend"].tolist()))
+    return [{
+        "pollution_index": float(batch["pollution_index"][k]),
+        "normalized_concentrations": dict(zip(pollutants, batch["normalized_concentrations"][k].tolist())),
+        "pollution_trend": trend,
+        "dataset": view.name,
+    } for k in range(len(items))]
+
+
+def _comparison_batch(items: List[tuple]) -> List[Any]:
+    # Regions are averaged at the level chosen by resolution, so batches are split by it
+    return compute_groups(items, lambda item: (item[1].name, item[1].version, item[0].resolution),
+                          _comparison_group)
+
+
+def _comparison_group(items: List[tuple]) -> List[Dict[str, Any]]:
+    view, resolution = items[0][1], items[0][0].resolution
+    comparisons = calculator.compare_points_to_regions(view.spatial_pyramid,
+                                                       [location.latitude for location, _ in items],
+                                                       [location.longitude for location, _ in items],
+                                                       [location.region_delta for location, _ in items], resolution)
+    return [dict(comparison, dataset=view.name) for comparison in comparisons]
 
-    esg_results = calculator.calculate_indicator(combined_data, lat=location.latitude, lon=location.longitude,
-                                                 delta=location.delta)
-    return AIRQualityData(**esg_results)
+
+esg_results_flight = SingleFlight("esg_results")
+comparison_flight = SingleFlight("comparison")
+esg_results_batcher = MicroBatcher("esg_results", _esg_results_batch, MICROBATCH_WINDOW, MICROBATCH_MAX_SIZE)
+comparison_batcher = MicroBatcher("comparison", _comparison_batch, MICROBATCH_WINDOW, MICROBATCH_MAX_SIZE)
+
+
+async def _esg_results(location: Location) -> Dict[str, Any]:
+    # Scores depend only on the nearest grid cell and the period, so requests for the
+    # same cell are coalesced even when their coordinates differ; the cell centre is
+    # what gets computed, which keeps the key and the result consistent
+    view = await _dataset_view(location)
+    _require_time_steps(view, location)
+    latitude, longitude = view.temporal_pyramid.latitude, view.temporal_pyramid.longitude
+    lat_idx = int(np.abs(latitude - location.latitude).argmin())
+    lon_idx = int(np.abs(longitude - location.longitude).argmin())
+    cell = location.model_copy(update={"latitude": float(latitude[lat_idx]), "longitude": float(longitude[lon_idx])})
+    key = (view.name, view.version, lat_idx, lon_idx, location.start, location.stop)
+    return await esg_results_flight.do(key, lambda: esg_results_batcher.submit((cell, view)))
+
+
+@app.post("/esg_results", response_model=AIRQualityData)
+async def get_esg_results(location: Location):
+    return AIRQualityData(**await _esg_results(location))
 
 
 @app.post("/interpretation")
 async def get_interpretation(location: Location):
-    global combined_data, calculator
-    if combined_data is None:
-        raise HTTPException(status_code=503, detail="Data not loaded yet. Please try again later.")
-
-    esg_results = calculator.calculate_indicator(combined_data, lat=location.latitude, lon=location.longitude,
-                                                 delta=location.delta)
-    interpretation = calculator.interpret_results(esg_results)
+    interpretation = calculator.interpret_results(await _esg_results(location))
     return {"interpretation": interpretation}
 
 
 @app.post("/comparison")
 async def get_comparison(location: Location):
-    global combined_data, calculator
-    if combined_data is None:
-        raise HTTPException(status_code=503, detail="Data not loaded yet. Please try again later.")
+    # The comparison region has to lie inside the dataset, so it is routed with region_delta as margin.
+    # The result echoes the location and the region is centred on it, so only exact repeats are coalesced
+    view = await _dataset_view(location, location.region_delta)
+    key = (view.name, view.version, location.latitude, location.longitude, location.region_delta, location.resolution)
+    compare = await comparison_flight.do(key, lambda: comparison_batcher.submit((location, view)))
+    return {"comparison": compare}
+
+
+@app.get("/datasets")
+async def get_datasets():
+    return dataset_catalog.describe()
+
+
+@app.get("/datasets/route")
+async def route_dataset(latitude: float = Query(..., ge=-90, le=90), longitude: float = Query(..., ge=-180, le=180),
+                        resolution: Optional[float] = Query(None, gt=0), start: Optional[datetime] = None,
+                        stop: Optional[datetime] = None, region_delta: float = Query(0.0, ge=0)):
+    # Which dataset /esg_results (region_delta=0) or /comparison would use, without opening it
+    location = Location(latitude=latitude, longitude=longitude, resolution=resolution, start=start, stop=stop)
+    store = _route(location, region_delta)
+    return {"dataset": store.spec.name, "resolution": store.spec.resolution, "open": store.blocks is not None}
+
+
+@app.post("/exceedance")
+async def get_exceedance(location: Location):
+    engine = exceedance_engines.get(_default_block(location.latitude, location.longitude).version)
+    if engine is None:
+        raise HTTPException(status_code=503, detail="Data is being reloaded. Please try again later.")
+
+    return await run_in_threadpool(engine.point, location.latitude, location.longitude)
+
+
+def _timeline(request: TimelineRequest, views: List[DatasetView]) -> Dict[str, Any]:
+    # One vectorized call per data block; the blocks share the time axis, so the windows are the same.
+    # pollution_trend is per site: each block describes only its own area
+    groups: Dict[Optional[str], List[int]] = {}
+    for i, view in enumerate(views):
+        groups.setdefault(view.version, []).append(i)
+    sites: List[Optional[Dict[str, Any]]] = [None] * len(views)
+    for indices in groups.values():
+        timeline = calculator.calculate_timeline(views[indices[0]].temporal_pyramid,
+                                                 [request.locations[i].latitude for i in indices],
+                                                 [request.locations[i].longitude for i in indices],
+                                                 freq=request.freq, window=request.window, step=request.step,
+                                                 start=request.start, stop=request.stop)
+        pollutants = timeline["pollutants"]
+        trend = {p: _json_floats(timeline["pollution_trend"][:, j]) for j, p in enumerate(pollutants)}
+        for k, i in enumerate(indices):
+            normalized = timeline["normalized_concentrations"][:, k]
+            sites[i] = {
+                "latitude": float(timeline["latitude"][k]),
+                "longitude": float(timeline["longitude"][k]),
+                "pollution_index": _json_floats(timeline["pollution_index"][:, k]),
+                "normalized_concentrations": {p: _json_floats(normalized[:, j]) for j, p in enumerate(pollutants)},
+                "pollution_trend": trend,
+            }
+    return {
+        "window_start": [str(t) for t in timeline["window_start"].astype("datetime64[s]")],
+        "window_stop": [str(t) for t in timeline["window_stop"].astype("datetime64[s]")],
+        "sites": sites,
+    }
 
-    compare = calculator.compare_point_to_region(combined_data, lat=location.latitude, lon=location.longitude)
+
+def _json_floats(values) -> List[Optional[float]]:
+    # NaN (окно без данных) не сериализуется в JSON
+    return [float(v) if v == v else None for v in values.tolist()]
+
+
+@app.post("/timeline")
+async def get_timeline(request: TimelineRequest):
+    _default_blocks()
+    if (request.freq is None) == (request.window is None):
+        raise HTTPException(status_code=422, detail="Specify either freq or window.")
+    views = [_default_block(location.latitude, location.longitude) for location in request.locations]
+
+    try:
+        return await run_in_threadpool(_timeline, request, views)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=f"Invalid window: {e}")
+
+
+@app.post("/zonal_comparison")
+async def get_zonal_comparison(request: ZoneComparison):
+    blocks = _default_blocks()
+    if zonal_statistics is None:
+        raise HTTPException(status_code=404, detail="No zones configured (ZONES_FILE).")
+
+    zone = request.zone
+    if zone is None:
+        containing = zonal_statistics.zones_containing(request.latitude, request.longitude)
+        if not containing:
+            raise HTTPException(status_code=404, detail="Location is not inside any zone.")
+        zone = containing[0]
+    elif zone not in zonal_statistics.index:
+        raise HTTPException(status_code=404, detail="Zone not found.")
+
+    # The zone is averaged over every block it overlaps
+    view = _default_block(request.latitude, request.longitude)
+    compare = await run_in_threadpool(calculator.compare_point_to_zone, request.latitude, request.longitude, zone,
+                                      view.spatial_pyramid, zonal_statistics,
+                                      [block.spatial_pyramid for block in blocks])
     return {"comparison": compare}
 
 
+def _zonal_stats(blocks, names: List[str]) -> Dict[str, Any]:
+    means = zonal_statistics.pyramid_means([view.spatial_pyramid for view in blocks], names)
+    pollutants = blocks[0].spatial_pyramid.pollutants
+    return {
+        "zones": {
+            name: {p: _json_floats(means[z, [i]])[0] for i, p in enumerate(pollutants)}
+            for z, name in enumerate(names)
+        }
+    }
+
+
+@app.post("/zonal_stats")
+async def get_zonal_stats(request: ZonalStatsRequest):
+    # Area-weighted time-mean concentrations for many zones in one sparse product
+    blocks = _default_blocks()
+    if zonal_statistics is None:
+        raise HTTPException(status_code=404, detail="No zones configured (ZONES_FILE).")
+
+    names = request.zones if request.zones is not None else zonal_statistics.names
+    unknown = [name for name in names if name not in zonal_statistics.index]
+    if unknown:
+        raise HTTPException(status_code=404, detail=f"Zones not found: {unknown[:10]}")
+    return await run_in_threadpool(_zonal_stats, blocks, names)
+
+
+@app.get("/shard")
+async def get_shard():
+    return {
+        "bounds": list(SHARD_BOUNDS) if SHARD_BOUNDS is not None else None,
+        "halo": SHARD_HALO,
+        "loaded": dataset_catalog.default_store.blocks is not None,
+    }
+
+
+@app.post("/shard/region_sums")
+async def get_region_sums(box: RegionBox):
+    # Native-grid sums and counts over the part of the box this shard owns; the router adds
+    # them up across shards, so cells in the halo are never counted twice. The blocks do not
+    # overlap (core.covering_areas), so their sums add up the same way
+    blocks = _default_blocks()
+
+    bounds = (box.lat_min, box.lat_max, box.lon_min, box.lon_max)
+    if SHARD_BOUNDS is not None:
+        bounds = SHARD_BOUNDS.clip(*bounds)
+    pollutants = blocks[0].spatial_pyramid.pollutants
+    if bounds is None:
+        return {"sums": {p: 0.0 for p in pollutants}, "counts": {p: 0 for p in pollutants}}
+    block_sums = [view.spatial_pyramid.region_sums(*bounds) for view in blocks]
+    sums, counts = sum(s for s, _ in block_sums), sum(c for _, c in block_sums)
+    return {"sums": dict(zip(pollutants, sums.tolist())), "counts": dict(zip(pollutants, counts.tolist()))}
+
+
+@app.post("/shard/point_mean")
+async def get_point_mean(location: Location):
+    pyramid = _default_block(location.latitude, location.longitude).spatial_pyramid
+    means = pyramid.point_mean(location.latitude, location.longitude)
+    return {"means": dict(zip(pyramid.pollutants, _json_floats(means)))}
+
+
+def _timeseries(request: TimeseriesRequest, temporal_pyramid: TemporalPyramid) -> Dict[str, Any]:
+    lat_idx = int(nearest_indices(temporal_pyramid.latitude, request.latitude)[0])
+    lon_idx = int(nearest_indices(temporal_pyramid.longitude, request.longitude)[0])
+    with timed("timeseries.downsample"):
+        result = pollutant_series(temporal_pyramid, pollutant_converter, lat_idx, lon_idx, calculator.who_limits,
+                                  request.points, request.method, start=request.start, stop=request.stop)
+    result["location"] = {"latitude": float(temporal_pyramid.latitude[lat_idx]),
+                          "longitude": float(temporal_pyramid.longitude[lon_idx])}
+    return result
+
+
+@app.post("/timeseries")
+async def get_timeseries(request: TimeseriesRequest):
+    # Series for client-side plotting: every pollutant downsampled to `points` (LTTB or
+    # per-bucket min/max), times as integer seconds from t0
+    view = _default_block(request.latitude, request.longitude)
+
+    return await run_in_threadpool(_timeseries, request, view.temporal_pyramid)
+
+
+def _site_result(location: Location) -> Dict[str, Any]:
+    # Sites outside the default dataset are scored on the catalog dataset covering them
+    view = _open_view(location)
+    _require_time_steps(view, location)
+    esg_results = calculator.calculate_indicator(view.data, lat=location.latitude, lon=location.longitude,
+                                                 delta=location.delta, start=location.start, stop=location.stop,
+                                                 pyramid=view.temporal_pyramid)
+    region_view = _open_view(location, location.region_delta)
+    compare = calculator.compare_point_to_region(region_view.data, lat=location.latitude, lon=location.longitude,
+                                                 delta=location.region_delta, resolution=location.resolution,
+                                                 pyramid=region_view.spatial_pyramid)
+    return {
+        "esg_results": AIRQualityData(**esg_results, dataset=view.name).model_dump(),
+        "interpretation": {"interpretation": calculator.interpret_results(esg_results)},
+        "comparison": {"comparison": dict(compare, dataset=region_view.name)},
+    }
+
+
+def _sweep_result(location: Location) -> Dict[str, Any]:
+    # Sweep points outside the downloaded areas get an error row
+    view = _default_block(location.latitude, location.longitude)
+    esg_results = calculator.calculate_indicator(view.data, lat=location.latitude, lon=location.longitude,
+                                                 delta=location.delta, start=location.start, stop=location.stop,
+                                                 pyramid=view.temporal_pyramid)
+    return AIRQualityData(**esg_results).model_dump()
+
+
+async def _stream_results(locations: List[Location], compute):
+    # Sites are computed concurrently and emitted as NDJSON lines in completion
+    # order; "index" refers to the position in the request so clients can reorder.
+    semaphore = asyncio.Semaphore(STREAM_CONCURRENCY)
+
+    async def run(index: int, location: Location):
+        async with semaphore:
+            row = {"index": index, "latitude": location.latitude, "longitude": location.longitude}
+            try:
+                row.update(await run_in_threadpool(compute, location))
+            except HTTPException as e:
+                row["error"] = e.detail
+            except Exception as e:
+                row["error"] = str(e)
+            try:
+                return json.dumps(row, allow_nan=False)
+            except ValueError:
+                # NaN is not valid JSON: a cell without data is an error, not a score
+                return json.dumps({"index": index, "latitude": location.latitude, "longitude": location.longitude,
+                                   "error": "No data at this location."})
+
+    tasks = [asyncio.ensure_future(run(i, loc)) for i, loc in enumerate(locations)]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task + "\n"
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+@app.post("/sites/stream")
+async def stream_sites(batch: LocationBatch):
+    _default_blocks()
+
+    return StreamingResponse(_stream_results(batch.locations, _site_result), media_type="application/x-ndjson")
+
+
+@app.post("/region_sweep/stream")
+async def stream_region_sweep(sweep: RegionSweep):
+    _default_blocks()
+    if sweep.south > sweep.north or sweep.west > sweep.east:
+        raise HTTPException(status_code=422, detail="Invalid sweep bounds.")
+
+    n_lat = int((sweep.north - sweep.south) / sweep.step) + 1
+    n_lon = int((sweep.east - sweep.west) / sweep.step) + 1
+    if n_lat * n_lon > MAX_SWEEP_POINTS:
+        raise HTTPException(status_code=422, detail=f"Sweep exceeds {MAX_SWEEP_POINTS} points, increase the step.")
+    locations = [
+        Location(latitude=sweep.south + i * sweep.step, longitude=sweep.west + j * sweep.step, delta=sweep.delta)
+        for i in range(n_lat)
+        for j in range(n_lon)
+    ]
+    return StreamingResponse(_stream_results(locations, _sweep_result), media_type="application/x-ndjson")
+
+
+def _locations_by_block(latitudes: List[float], longitudes: List[float]) -> List[tuple]:
+    # [(block, indices of its points)] of the default dataset; 404 for points outside every block
+    groups: Dict[Optional[str], tuple] = {}
+    outside = []
+    for i, (latitude, longitude) in enumerate(zip(latitudes, longitudes)):
+        view = dataset_catalog.default_store.block(latitude, longitude)
+        if view is None:
+            outside.append(i)
+        else:
+            groups.setdefault(view.version, (view, []))[1].append(i)
+    if outside:
+        raise HTTPException(status_code=404,
+                            detail=f"Locations outside the loaded data areas: {outside[:10]}")
+    return list(groups.values())
+
+
+def _export_scores(batch: LocationBatch, fmt: str) -> bytes:
+    lats = [location.latitude for location in batch.locations]
+    lons = [location.longitude for location in batch.locations]
+    tables = []
+    for view, indices in _locations_by_block(lats, lons):
+        results = calculator.calculate_indicators_batch(view.data, [lats[i] for i in indices],
+                                                        [lons[i] for i in indices], pyramid=view.temporal_pyramid)
+        tables.append(scores_table(results, site_ids=indices))
+    return serialize_table(concat_scores(tables), fmt)
+
+
+@app.post("/export")
+async def export_scores(batch: LocationBatch, format: str = Query("arrow", pattern="^(arrow|parquet)$")):
+    _default_blocks()
+
+    content = await run_in_threadpool(_export_scores, batch, format)
+    media_type = ARROW_MEDIA_TYPE if format == "arrow" else PARQUET_MEDIA_TYPE
+    return Response(content=content, media_type=media_type,
+                    headers={"Content-Disposition": f"attachment; filename=esg_scores.{format}"})
+
+
+@app.put("/peers/scores")
+async def update_peer_scores(batch: PeerScoreBatch):
+    # Scores are upserted; a company moving to another group leaves the old one
+    peer_ranking.update_many([score.model_dump() for score in batch.scores])
+    return {"companies": len(peer_ranking)}
+
+
+def _check_peer_dimensions(by: List[str]) -> None:
+    unknown = set(by) - set(PEER_DIMENSIONS)
+    if unknown:
+        raise HTTPException(status_code=422, detail=f"Unknown peer dimensions: {sorted(unknown)}.")
+
+
+@app.get("/peers/{company_id}/percentile")
+async def get_peer_percentile(company_id: str, by: List[str] = Query(list(PEER_DIMENSIONS))):
+    _check_peer_dimensions(by)
+    result = peer_ranking.percentile(company_id, by)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Company not found.")
+    return result
+
+
+@app.post("/peers/percentiles")
+async def get_peer_percentiles(request: PeerPercentileRequest):
+    _check_peer_dimensions(request.by)
+    return {"results": [peer_ranking.percentile(company_id, request.by) for company_id in request.company_ids]}
+
+
+@app.get("/peers/top")
+async def get_peer_top(k: int = Query(10, ge=1, le=1000), industry: str = ANY, size: str = ANY,
+                       country: str = ANY):
+    return {"group": {"industry": industry, "size": size, "country": country},
+            "top": peer_ranking.top(k, industry=industry, size=size, country=country)}
+
+
+@app.post("/ingest")
+async def ingest_data(request: IngestRequest):
+    # Merges the new dates into the loaded data and rescores only the companies whose cells changed
+    _default_blocks()
+
+    return await run_in_threadpool(ingest, request.date)
+
+
+@app.put("/scores/companies")
+async def register_companies(batch: CompanyBatch):
+    # New and moved companies are scored immediately; the rest only when their data changes
+    if recompute_scheduler is None:
+        raise HTTPException(status_code=503, detail="Score store not initialised yet. Please try again later.")
+
+    changed = recompute_scheduler.set_companies([company.model_dump() for company in batch.companies])
+    blocks = dataset_catalog.default_store.blocks
+    if blocks is None or not changed:
+        return {"companies": 0, "portfolio": len(recompute_scheduler.company_ids), "seq": None}
+    return await run_in_threadpool(recompute_scheduler.rescore, blocks, None, changed)
+
+
+@app.get("/scores")
+async def get_scores(since: int = Query(0, ge=0)):
+    # Latest results of companies rescored after change `since`; poll with the returned seq.
+    # Every result carries the pollution_trend of the data block its company is in
+    if recompute_scheduler is None:
+        raise HTTPException(status_code=503, detail="Score store not initialised yet. Please try again later.")
+
+    store = recompute_scheduler.store
+    seq = await run_in_threadpool(store.last_seq)
+    scores = await run_in_threadpool(store.scores, since)
+    return {"seq": seq, "scores": scores}
+
+
+@app.get("/scores/changes")
+async def get_score_changes(since: int = Query(0, ge=0), limit: int = Query(1000, ge=1, le=10000),
+                            alerts_only: bool = False):
+    if recompute_scheduler is None:
+        raise HTTPException(status_code=503, detail="Score store not initialised yet. Please try again later.")
+
+    changes = await run_in_threadpool(recompute_scheduler.store.changes, since, limit, alerts_only)
+    return {"changes": changes, "seq": changes[-1]["seq"] if changes else since}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if job_queue is not None:
+        job_queue.shutdown()
+
+
+def _job_response(job: Dict[str, Any]) -> Dict[str, Any]:
+    return {key: job[key] for key in ("id", "kind", "params", "status", "error", "created_at", "updated_at")}
+
+
+@app.post("/jobs")
+async def submit_job(job_request: JobRequest):
+    if data_files is None:
+        raise HTTPException(status_code=503, detail="Data not loaded yet. Please try again later.")
+    if job_request.kind == "heatmaps" and not {"latitude", "longitude"} <= job_request.params.keys():
+        raise HTTPException(status_code=422, detail="heatmaps jobs require latitude and longitude.")
+    if job_request.kind == "batch_scores" and not {"latitudes", "longitudes"} <= job_request.params.keys():
+        raise HTTPException(status_code=422, detail="batch_scores jobs require latitudes and longitudes.")
+
+    # Job workers load the same blocks; points outside them would only fail in the worker
+    params = job_request.params
+    if job_request.kind == "batch_scores":
+        await run_in_threadpool(_locations_by_block, params["latitudes"], params["longitudes"])
+        params = dict(params, index_pollutants=calculator.index_pollutants)
+    elif {"latitude", "longitude"} <= params.keys():
+        _default_block(params["latitude"], params["longitude"])
+    elif len(_default_blocks()) > 1:
+        raise HTTPException(status_code=422, detail="Jobs over several data areas require latitude and longitude.")
+    job = await run_in_threadpool(job_queue.submit, job_request.kind, params, data_files,
+                                  dataset_catalog.default_store.spec)
+    return _job_response(job)
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = job_queue.store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return _job_response(job)
+
+
+@app.get("/jobs/{job_id}/result")
+async def get_job_result(job_id: str):
+    job = job_queue.store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    if job["status"] != JOB_DONE:
+        raise HTTPException(status_code=409, detail=f"Job is {job['status']}.")
+    return FileResponse(job["artifact"], filename=os.path.basename(job["artifact"]))
+
+
 if __name__ == "__main__":
     import uvicorn
 
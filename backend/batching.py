@@ -0,0 +1,124 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Set, Tuple
+
+from fastapi.concurrency import run_in_threadpool
+
+from metrics import current_request_timings, finish_request_timings, registry, start_request_timings
+
+
+class SingleFlight:
+    """Объединение одинаковых одновременных запросов.
+
+    Пока вычисление по ключу не завершено, остальные вызовы с тем же ключом ждут
+    его результат (или исключение) вместо повторного расчёта. Отмена одного из
+    ожидающих (клиент закрыл соединение) не отменяет вычисление для остальных.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+
+    async def do(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Any:
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(factory())
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            registry.inc('esg_coalesced_requests_total', endpoint=self.name)
+        return await asyncio.shield(future)
+
+
+def compute_groups(items: List[Any], key: Callable[[Any], Hashable],
+                   compute: Callable[[List[Any]], List[Any]]) -> List[Any]:
+    """Один вызов compute на группу элементов с равным key, результаты — в порядке items.
+
+    Если вызов для группы падает, её элементы пересчитываются по одному: исключение
+    достаётся только тем элементам, на которых оно повторяется, а не всей пачке.
+    """
+    groups: Dict[Hashable, List[int]] = {}
+    for i, item in enumerate(items):
+        groups.setdefault(key(item), []).append(i)
+
+    results: List[Any] = [None] * len(items)
+    for indices in groups.values():
+        try:
+            group_results = compute([items[i] for i in indices])
+        except Exception:
+            if len(indices) == 1:
+                raise
+            group_results = []
+            for i in indices:
+                try:
+                    group_results.extend(compute([items[i]]))
+                except Exception as e:
+                    group_results.append(e)
+        for i, result in zip(indices, group_results):
+            results[i] = result
+    return results
+
+
+class MicroBatcher:
+    """Сбор одновременных запросов в пачки для одного векторизованного вызова.
+
+    Первый запрос открывает окно в window секунд; всё, что пришло за это время
+    (но не больше max_size), считается одним вызовом compute(items) в пуле потоков,
+    и результаты раздаются по запросам в том же порядке. compute может вернуть
+    на месте результата исключение — оно достанется только своему запросу.
+    Стадии metrics.timed, пройденные пачкой, попадают в Server-Timing каждого
+    запроса пачки, а не только того, кто открыл окно.
+    """
+
+    def __init__(self, name: str, compute: Callable[[List[Any]], List[Any]], window: float = 0.002,
+                 max_size: int = 256):
+        self.name = name
+        self.compute = compute
+        self.window = window
+        self.max_size = max_size
+        self._pending: List[Tuple[Any, asyncio.Future, Optional[Dict[str, float]]]] = []
+        self._timer = None
+        self._running: Set[asyncio.Task] = set()
+
+    async def submit(self, item: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future, current_request_timings()))
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._run(batch))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run(self, batch: List[Tuple[Any, asyncio.Future, Optional[Dict[str, float]]]]) -> None:
+        registry.inc('esg_microbatch_batches_total', batcher=self.name)
+        registry.inc('esg_microbatch_items_total', len(batch), batcher=self.name)
+        # Задача пачки унаследовала контекст одного из запросов: стадии собираются отдельно
+        token = start_request_timings()
+        try:
+            results = await run_in_threadpool(self.compute, [item for item, _, _ in batch])
+        except Exception as e:
+            results = [e] * len(batch)
+        finally:
+            stages = finish_request_timings(token)
+        for _, future, timings in batch:
+            if timings is not None:
+                for stage, elapsed in stages.items():
+                    timings[stage] = timings.get(stage, 0.0) + elapsed
+        for (_, future, _), result in zip(batch, results):
+            # Запрос мог быть отменён, пока пачка считалась
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
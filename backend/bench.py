@@ -0,0 +1,199 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+from typing import Any, Callable, Dict
+
+import numpy as np
+
+from core import AtmosphericLayerPollutantConverter, CopernicusDataHandler, ESGCalculator, compact_dataset
+from pyramid import SpatialPyramid
+from synthetic import POLLUTANT_SCALES, make_cams_dataset, write_cams_zip
+
+SITES = [
+    (51.5074, -0.1278), (48.8566, 2.3522), (52.5200, 13.4050), (41.9028, 12.4964), (59.3293, 18.0686),
+    (52.3676, 4.9041), (55.6761, 12.5683), (48.2082, 16.3738), (50.8503, 4.3517), (45.4642, 9.1900),
+]
+
+
+def _timeit(func: Callable[[], Any], repeat: int) -> Dict[str, float]:
+    func()  # прогрев
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return {'min_s': min(samples), 'median_s': statistics.median(samples), 'repeat': repeat}
+
+
+def bench_calculator(data, repeat: int, n_batch_sites: int) -> Dict[str, Dict[str, float]]:
+    calculator = ESGCalculator(AtmosphericLayerPollutantConverter())
+    lat, lon = SITES[0]
+    rng = np.random.default_rng(0)
+    batch_lats = rng.uniform(float(data.latitude.min()), float(data.latitude.max()), n_batch_sites)
+    batch_lons = rng.uniform(float(data.longitude.min()), float(data.longitude.max()), n_batch_sites)
+    spatial_pyramid = SpatialPyramid.for_dataset(data, list(calculator.who_limits))
+
+    return {
+        'calculate_indicator': _timeit(lambda: calculator.calculate_indicator(data, lat=lat, lon=lon), repeat),
+        '_calculate_trend': _timeit(lambda: calculator._calculate_trend(data), repeat),
+        'compare_point_to_region': _timeit(lambda: calculator.compare_point_to_region(data, lat=lat, lon=lon),
+                                           repeat),
+        'compare_point_to_region[spatial_pyramid]': _timeit(
+            lambda: calculator.compare_point_to_region(data, lat=lat, lon=lon, pyramid=spatial_pyramid), repeat),
+        f'calculate_indicators_batch[{n_batch_sites}]': _timeit(
+            lambda: calculator.calculate_indicators_batch(data, batch_lats, batch_lons), repeat),
+    }
+
+
+def bench_loader(data, repeat: int) -> Dict[str, Dict[str, float]]:
+    who_limits = ESGCalculator(AtmosphericLayerPollutantConverter()).who_limits
+    with tempfile.TemporaryDirectory() as directory:
+        zip_file = write_cams_zip(data, os.path.join(directory, 'synthetic.zip'))
+
+        def load():
+            data_handler = CopernicusDataHandler(zip_file)
+            data_handler.extract_and_load_data()
+            data_handler.get_combined_data().load()
+            data_handler.close_data()
+
+        def load_compacted():
+            data_handler = CopernicusDataHandler(zip_file)
+            data_handler.extract_and_load_data()
+            compact_dataset(data_handler.get_combined_data(), who_limits)
+            data_handler.close_data()
+
+        return {
+            'CopernicusDataHandler.load': _timeit(load, repeat),
+            'CopernicusDataHandler.load+compact': _timeit(load_compacted, repeat),
+        }
+
+
+async def _api_load(data, endpoint: str, concurrency: int, requests_total: int) -> Dict[str, float]:
+    import httpx
+    import api
+
+    # Same path as load_data: pyramids, derived engines and the default catalog view
+    api._publish_data(data, [])
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=api.app), base_url='http://bench') as client:
+        async def one(i):
+            lat, lon = SITES[i % len(SITES)]
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.post(endpoint, json={'latitude': lat, 'longitude': lon, 'delta': 0.1})
+                latencies.append(time.perf_counter() - start)
+                response.raise_for_status()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(requests_total)))
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'requests': requests_total,
+        'concurrency': concurrency,
+        'throughput_rps': requests_total / elapsed,
+        'p50_s': latencies[len(latencies) // 2],
+        'p95_s': latencies[int(len(latencies) * 0.95) - 1],
+        'max_s': latencies[-1],
+    }
+
+
+def bench_api(data, concurrency: int, requests_total: int) -> Dict[str, Dict[str, float]]:
+    return {
+        f'api{endpoint}': asyncio.run(_api_load(data, endpoint, concurrency, requests_total))
+        for endpoint in ('/esg_results', '/comparison')
+    }
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def _previous_record(results_file: str, config: Dict[str, Any]):
+    if not os.path.exists(results_file):
+        return None
+    previous = None
+    with open(results_file) as f:
+        for line in f:
+            record = json.loads(line)
+            if record['config'] == config:
+                previous = record
+    return previous
+
+
+def _print_results(results: Dict[str, Dict[str, float]], previous) -> None:
+    for name, result in results.items():
+        metric = 'median_s' if 'median_s' in result else 'p50_s'
+        line = f"{name:45s} {result[metric] * 1000:10.2f} ms"
+        if 'throughput_rps' in result:
+            line += f"  {result['throughput_rps']:8.1f} req/s"
+        if previous is not None and name in previous['results']:
+            before = previous['results'][name][metric]
+            line += f"  ({result[metric] / before:5.2f}x vs {previous['revision']})"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the calculator, loader and API on synthetic CAMS data.")
+    parser.add_argument('--lat', type=int, default=100)
+    parser.add_argument('--lon', type=int, default=150)
+    parser.add_argument('--time', type=int, default=24 * 20)
+    parser.add_argument('--levels', type=int, default=1)
+    parser.add_argument('--pollutants', type=int, default=14, help="Number of variables (the first 7 are scored)")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--batch-sites', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=64)
+    parser.add_argument('--only', choices=['calculator', 'loader', 'api'], action='append')
+    parser.add_argument('--raw', action='store_true',
+                        help="Run the calculator and API on the raw dataset instead of the compacted one")
+    parser.add_argument('--results', default='bench_results.jsonl', help="JSON lines file the run is appended to")
+    args = parser.parse_args()
+
+    pollutants = list(POLLUTANT_SCALES)[:args.pollutants]
+    config = {'lat': args.lat, 'lon': args.lon, 'time': args.time, 'levels': args.levels,
+              'pollutants': len(pollutants), 'compacted': not args.raw}
+    data = make_cams_dataset(n_lat=args.lat, n_lon=args.lon, n_time=args.time, n_levels=args.levels,
+                             pollutants=pollutants)
+    print(f"Synthetic dataset {dict(data.sizes)}, {data.nbytes / 1e6:.1f} MB")
+
+    suites = args.only or ['calculator', 'loader', 'api']
+    results = {}
+    if 'loader' in suites:
+        results.update(bench_loader(data, max(1, args.repeat // 2)))
+    if not args.raw:
+        data = compact_dataset(data, ESGCalculator(AtmosphericLayerPollutantConverter()).who_limits)
+    if 'calculator' in suites:
+        results.update(bench_calculator(data, args.repeat, args.batch_sites))
+    if 'api' in suites:
+        results.update(bench_api(data, args.concurrency, args.requests))
+
+    previous = _previous_record(args.results, config)
+    _print_results(results, previous)
+
+    record = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'revision': _git_revision(),
+        'python': platform.python_version(),
+        'config': config,
+        'results': results,
+    }
+    with open(args.results, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,348 @@
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from core import DataRequest, _to_datetime64
+from metrics import registry, timed
+from pyramid import SpatialPyramid, TemporalPyramid
+from sharding import ShardBounds
+
+# Продукты по умолчанию: региональный европейский (0.1°) и глобальный (0.4°).
+# variables переименовывает переменные файла в имена ESGCalculator, scale переводит
+# их в μg/m³ (глобальные газы — массовые доли, кг/кг, при плотности воздуха у земли 1.2 кг/м³)
+DEFAULT_CATALOG = [
+    {
+        'name': 'cams-europe',
+        'dataset_name': 'cams-europe-air-quality-forecasts',
+        'resolution': 0.1,
+        'bounds': [30.0, 72.0, -25.0, 45.0],
+        'parameters': {
+            'variable': [
+                'ammonia', 'carbon_monoxide', 'nitrogen_dioxide', 'ozone',
+                'particulate_matter_2.5um', 'particulate_matter_10um', 'sulphur_dioxide',
+            ],
+            'model': ['ensemble'],
+            'level': ['0'],
+            'type': ['forecast'],
+            'time': ['00:00'],
+            'leadtime_hour': ['0'],
+            'data_format': 'netcdf_zip',
+        },
+    },
+    {
+        'name': 'cams-global',
+        'dataset_name': 'cams-global-atmospheric-composition-forecasts',
+        'resolution': 0.4,
+        'bounds': [-90.0, 90.0, -180.0, 180.0],
+        'parameters': {
+            'variable': [
+                'carbon_monoxide', 'nitrogen_dioxide', 'ozone', 'sulphur_dioxide',
+                'particulate_matter_2.5um', 'particulate_matter_10um',
+            ],
+            'pressure_level': ['1000'],
+            'type': ['forecast'],
+            'time': ['00:00'],
+            'leadtime_hour': ['0'],
+            'data_format': 'netcdf_zip',
+        },
+        'variables': {'co': 'co_conc', 'no2': 'no2_conc', 'go3': 'o3_conc', 'so2': 'so2_conc',
+                      'pm2p5': 'pm2p5_conc', 'pm10': 'pm10_conc'},
+        'scale': {'co_conc': 1.2e9, 'no2_conc': 1.2e9, 'o3_conc': 1.2e9, 'so2_conc': 1.2e9,
+                  'pm2p5_conc': 1e9, 'pm10_conc': 1e9},
+    },
+]
+
+
+# Переменные запроса CDS и имена загрязнителей ESGCalculator, в которые они превращаются
+CDS_POLLUTANTS = {
+    'ammonia': 'nh3_conc',
+    'carbon_monoxide': 'co_conc',
+    'nitrogen_dioxide': 'no2_conc',
+    'ozone': 'o3_conc',
+    'particulate_matter_2.5um': 'pm2p5_conc',
+    'particulate_matter_10um': 'pm10_conc',
+    'sulphur_dioxide': 'so2_conc',
+}
+
+
+class DatasetSpec(NamedTuple):
+    """Продукт CAMS в каталоге: что запрашивать у CDS и какую область и период он покрывает."""
+
+    name: str
+    dataset_name: str
+    resolution: float  # шаг сетки в градусах
+    bounds: ShardBounds
+    parameters: Dict[str, Any]
+    dates: str  # диапазон дат CDS, "YYYY-MM-DD/YYYY-MM-DD"
+    variables: Dict[str, str]
+    scale: Dict[str, float]
+
+    @classmethod
+    def from_config(cls, entry: Dict[str, Any], dates: str) -> 'DatasetSpec':
+        return cls(entry['name'], entry['dataset_name'], float(entry['resolution']),
+                   ShardBounds(*entry.get('bounds', (-90.0, 90.0, -180.0, 180.0))), dict(entry.get('parameters', {})),
+                   entry.get('dates', dates), dict(entry.get('variables', {})), dict(entry.get('scale', {})))
+
+    @property
+    def pollutants(self) -> Optional[frozenset]:
+        """Загрязнители, которые даёт продукт (None, если запрос не перечисляет переменные)."""
+        requested = self.parameters.get('variable')
+        if requested is None:
+            return None
+        return frozenset(CDS_POLLUTANTS[name] for name in requested if name in CDS_POLLUTANTS) | frozenset(
+            self.variables.values())
+
+    def request(self, date: Optional[str] = None, area: Optional[list] = None) -> DataRequest:
+        return DataRequest(self.dataset_name, dict(self.parameters, date=[date or self.dates]), area=area)
+
+    def period(self):
+        """Период [start, stop) по диапазону дат запроса: stop — начало дня после последней даты."""
+        first, _, last = self.dates.partition('/')
+        return np.datetime64(first, 'ns'), np.datetime64(last or first, 'ns') + np.timedelta64(1, 'D')
+
+    def normalize(self, data: xr.Dataset) -> xr.Dataset:
+        """Приводит файл продукта к виду европейского: имена переменных, ось time, долготы -180..180, μg/m³."""
+        data = data.rename({name: target for name, target in self.variables.items() if name in data})
+        if 'time' not in data.dims:
+            for name in ('valid_time', 'forecast_reference_time'):
+                if name in data.dims:
+                    data = data.rename({name: 'time'})
+                    break
+        extra = [dim for dim in data.dims
+                 if dim not in ('time', 'latitude', 'longitude', 'pressure_level') and data.sizes[dim] == 1]
+        if extra:
+            data = data.isel({dim: 0 for dim in extra}, drop=True)
+        if float(data.longitude.max()) > 180:
+            data = data.assign_coords(longitude=(data.longitude + 180) % 360 - 180).sortby('longitude')
+        for name, factor in self.scale.items():
+            if name in data:
+                data[name] = (data[name] * factor).assign_attrs(data[name].attrs)
+        return data
+
+
+def load_specs(config: Optional[str], dates: str) -> List[DatasetSpec]:
+    """config — JSON-список продуктов (как DEFAULT_CATALOG) или путь к файлу с ним; None — DEFAULT_CATALOG."""
+    entries = DEFAULT_CATALOG
+    if config:
+        if os.path.exists(config):
+            with open(config) as f:
+                config = f.read()
+        entries = json.loads(config)
+    return [DatasetSpec.from_config(entry, dates) for entry in entries]
+
+
+class DatasetView(NamedTuple):
+    """Загруженный блок продукта и его пирамиды; неизменяем, поэтому его можно держать во время расчёта.
+
+    Блок — данные одной скачанной области на её собственной сетке: области вокруг
+    разнесённых площадок не сливаются в одну плотную сетку, а запрос идёт в блок,
+    внутри которого лежит точка (DatasetStore.block).
+    """
+
+    name: str
+    data: xr.Dataset
+    temporal_pyramid: TemporalPyramid
+    spatial_pyramid: SpatialPyramid
+    # Скачанная область блока (вокруг площадок портфеля или тайл шарда); None — вся область продукта
+    area: Optional[ShardBounds] = None
+
+    @classmethod
+    def build(cls, name: str, data: xr.Dataset, pollutants: Sequence[str],
+              area: Optional[ShardBounds] = None) -> 'DatasetView':
+        with timed('loader.temporal_pyramid'):
+            temporal = TemporalPyramid(data, pollutants)
+        with timed('loader.spatial_pyramid'):
+            spatial = SpatialPyramid.for_dataset(data, pollutants)
+        return cls(name, data, temporal, spatial, area)
+
+    @property
+    def version(self) -> Optional[str]:
+        return self.data.attrs.get('dataset_version')
+
+
+# Загрузчик продукта: блоки данных со скачанными областями (None — вся область продукта)
+Loader = Callable[[DatasetSpec], Sequence[Tuple[xr.Dataset, Optional[ShardBounds]]]]
+# Области, которые загрузчик скачает для продукта, без загрузки (None — вся область продукта)
+AreaPlanner = Callable[[DatasetSpec], Optional[Sequence[ShardBounds]]]
+
+
+def _box(lat: float, lon: float, margin: float) -> Tuple[float, float, float, float]:
+    return max(lat - margin, -90.0), min(lat + margin, 90.0), max(lon - margin, -180.0), min(lon + margin, 180.0)
+
+
+class DatasetStore:
+    """Лениво открываемый продукт: данные скачиваются и пирамиды строятся при первом запросе к нему."""
+
+    def __init__(self, spec: DatasetSpec, loader: Loader, pollutants: Sequence[str],
+                 planner: Optional[AreaPlanner] = None):
+        self.spec = spec
+        self.loader = loader
+        self.pollutants = list(pollutants)
+        self.planner = planner
+        self._planned: Optional[Tuple[ShardBounds, ...]] = None
+        self.blocks: Optional[Tuple[DatasetView, ...]] = None
+        self.last_used = 0.0
+        self._lock = threading.Lock()
+
+    def open(self) -> Tuple[DatasetView, ...]:
+        with self._lock:
+            if self.blocks is None:
+                with timed('catalog.open'):
+                    self.blocks = tuple(DatasetView.build(self.spec.name, data, self.pollutants, area)
+                                        for data, area in self.loader(self.spec))
+                registry.inc('esg_dataset_opens_total', dataset=self.spec.name)
+            self.last_used = time.monotonic()
+            return self.blocks
+
+    def block(self, lat: float, lon: float, margin: float = 0.0) -> Optional[DatasetView]:
+        """Загруженный блок, в котором целиком лежит точка с регионом ±margin градусов."""
+        blocks = self.blocks
+        if blocks is None:
+            return None
+        box = _box(lat, lon, margin)
+        for block in blocks:
+            if (block.area or self.spec.bounds).covers(*box, 0.0):
+                return block
+        return None
+
+    def period(self):
+        """Покрываемый период [start, stop): по загруженной оси времени (её расширяет /ingest) или по spec.dates."""
+        blocks = self.blocks
+        if not blocks or not blocks[0].data.sizes['time']:
+            return self.spec.period()
+        # Блоки скачиваются и дополняются одними и теми же датами, ось времени у них общая
+        time_axis = blocks[0].data.time.values
+        return time_axis[0], time_axis[-1] + np.timedelta64(1, 'D')
+
+    def covers(self, lat: float, lon: float, margin: float = 0.0, start=None, stop=None) -> bool:
+        """Покрывает ли продукт точку (с регионом ±margin градусов) и период [start, stop).
+
+        У загруженного продукта регион должен целиком лежать в одном из блоков,
+        у ещё не открытого — в одной из областей, которые скачает загрузчик.
+        """
+        box = _box(lat, lon, margin)
+        if not any(area.covers(*box, 0.0) for area in self.areas()):
+            return False
+        first, last = self.period()
+        return ((start is None or first <= _to_datetime64(start) < last)
+                and (stop is None or first < _to_datetime64(stop) <= last))
+
+    def areas(self) -> Sequence[ShardBounds]:
+        """Области загруженных блоков или запланированные для ещё не открытого продукта."""
+        blocks = self.blocks
+        if blocks is not None:
+            return tuple(block.area or self.spec.bounds for block in blocks)
+        if self._planned is None:
+            planned = self.planner(self.spec) if self.planner is not None else None
+            self._planned = tuple(planned) if planned is not None else (self.spec.bounds,)
+        return self._planned
+
+    def publish(self, blocks: Sequence[DatasetView]) -> None:
+        with self._lock:
+            self.blocks = tuple(blocks)
+            self.last_used = time.monotonic()
+
+    def close(self) -> None:
+        with self._lock:
+            self.blocks = None
+
+
+class DatasetCatalog:
+    """Несколько продуктов CAMS и выбор продукта для запроса.
+
+    Подходят продукты, покрывающие точку (с регионом сравнения) и период. Загруженные
+    данные всегда предпочтительнее: сначала основной продукт, затем самый детальный из
+    открытых; resolution для них выбирает только уровень SpatialPyramid. Другой
+    продукт открывается (со скачиванием) лишь тогда, когда загруженные данные точку не
+    покрывают; из неоткрытых при заданном resolution берётся самый грубый с шагом сетки
+    не крупнее него — его дешевле всего скачать, — иначе самый детальный. Открытыми
+    держится не больше max_open неосновных, давно не использованные закрываются.
+
+    index_pollutants — загрязнители, которые есть во всех продуктах: pollution_index
+    усредняется только по ним, чтобы индексы из разных продуктов были сравнимы.
+    """
+
+    def __init__(self, specs: Sequence[DatasetSpec], loader: Loader,
+                 pollutants: Sequence[str], default: Optional[str] = None, max_open: int = 2,
+                 planner: Optional[AreaPlanner] = None):
+        self.stores = {spec.name: DatasetStore(spec, loader, pollutants, planner) for spec in specs}
+        self.default = default or specs[0].name
+        if self.default not in self.stores:
+            raise ValueError(f"Default dataset {self.default!r} is not in the catalog")
+        self.max_open = max_open
+        self.index_pollutants = [p for p in pollutants
+                                 if all(spec.pollutants is None or p in spec.pollutants for spec in specs)]
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, config: Optional[str], dates: str, loader: Loader,
+             pollutants: Sequence[str], default: Optional[str] = None, max_open: int = 2,
+             planner: Optional[AreaPlanner] = None) -> 'DatasetCatalog':
+        return cls(load_specs(config, dates), loader, pollutants, default, max_open, planner)
+
+    @property
+    def default_store(self) -> DatasetStore:
+        return self.stores[self.default]
+
+    def route(self, lat: float, lon: float, resolution: Optional[float] = None, start=None, stop=None,
+              margin: float = 0.0) -> Optional[DatasetStore]:
+        candidates = [store for store in self.stores.values() if store.covers(lat, lon, margin, start, stop)]
+        if not candidates:
+            return None
+        # Основной продукт — и когда он ещё загружается (тогда запрос получит 503, а не скачивание другого)
+        if self.default_store in candidates:
+            return self.default_store
+        opened = [store for store in candidates if store.blocks is not None]
+        if opened:
+            return min(opened, key=lambda store: store.spec.resolution)
+        fine_enough = [store for store in candidates if resolution is not None and store.spec.resolution <= resolution]
+        if fine_enough:
+            return max(fine_enough, key=lambda store: store.spec.resolution)
+        return min(candidates, key=lambda store: store.spec.resolution)
+
+    def view(self, store: DatasetStore, lat: float, lon: float, margin: float = 0.0) -> Optional[DatasetView]:
+        """Блок продукта с точкой без открытия (None, если продукт закрыт); отмечает использование."""
+        view = store.block(lat, lon, margin)
+        if view is not None:
+            store.last_used = time.monotonic()
+        return view
+
+    def open(self, store: DatasetStore) -> Tuple[DatasetView, ...]:
+        blocks = store.open()
+        with self._lock:
+            opened = [s for s in self.stores.values() if s.blocks is not None and s.spec.name != self.default]
+            for stale in sorted(opened, key=lambda s: s.last_used)[:max(len(opened) - self.max_open, 0)]:
+                if stale is not store:
+                    stale.close()
+        return blocks
+
+    def describe(self) -> List[Dict[str, Any]]:
+        result = []
+        for store in self.stores.values():
+            spec, blocks = store.spec, store.blocks
+            time_axis = blocks[0].data.time.values if blocks else None
+            result.append({
+                'name': spec.name,
+                'dataset_name': spec.dataset_name,
+                'resolution': spec.resolution,
+                'bounds': list(spec.bounds),
+                'dates': spec.dates,
+                'default': spec.name == self.default,
+                'pollutants': [p for p in store.pollutants if spec.pollutants is None or p in spec.pollutants],
+                'index_pollutants': self.index_pollutants,
+                'open': blocks is not None,
+                'areas': ([list(block.area) if block.area is not None else None for block in blocks]
+                          if blocks is not None else None),
+                # Сетка каждого блока: [широты, долготы]
+                'grid': ([[int(block.data.sizes['latitude']), int(block.data.sizes['longitude'])] for block in blocks]
+                         if blocks is not None else None),
+                'time': ([pd.Timestamp(time_axis[0]).isoformat(), pd.Timestamp(time_axis[-1]).isoformat()]
+                         if time_axis is not None and len(time_axis) else None),
+            })
+        return result
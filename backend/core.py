@@ -0,0 +1,606 @@
+"""Ядро расчётов: конвертер единиц, ESGCalculator и загрузчики данных.
+
+Модуль не тянет matplotlib, cartopy и cdsapi, поэтому API и воркеры импортируют
+его без затрат на графический стек; визуализация — в visualization, загрузка из
+CDS — в fetchers.
+"""
+import glob
+import os
+import tempfile
+import uuid
+import zipfile
+from typing import Any, Dict, List, Optional, Sequence
+
+from abc import ABC, abstractmethod
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from metrics import registry, timed
+
+
+class Location:
+    def __init__(self, latitude: float, longitude: float, delta: float = 0.25):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.delta = delta  # Определяет область вокруг точки в градусах
+
+    def get_area(self) -> list:
+        """Вычисляет ограничивающий прямоугольник вокруг местоположения."""
+        north = self.latitude + self.delta
+        south = self.latitude - self.delta
+        east = self.longitude + self.delta
+        west = self.longitude - self.delta
+        return [north, west, south, east]
+
+
+def covering_areas(locations: Sequence[Location], padding: float = 0.0, max_overhead: float = 0.25) -> List[list]:
+    """Минимальный набор прямоугольников [north, west, south, east], покрывающих все локации.
+
+    Каждая локация даёт область Location.get_area(), расширенную на `padding` градусов.
+    Две области объединяются, если их общий прямоугольник не более чем на `max_overhead`
+    больше суммы их площадей, т.е. объединение почти не увеличивает объём загрузки,
+    а также всегда, если они пересекаются или соприкасаются: результат — непересекающиеся
+    области, и каждая точка попадает ровно в один блок данных.
+    """
+    def area(box):
+        return max(box[0] - box[2], 0) * max(box[3] - box[1], 0)
+
+    def overlap(a, b):
+        return a[2] <= b[0] and b[2] <= a[0] and a[1] <= b[3] and b[1] <= a[3]
+
+    boxes = []
+    for location in locations:
+        north, west, south, east = location.get_area()
+        boxes.append([min(north + padding, 90), max(west - padding, -180),
+                      max(south - padding, -90), min(east + padding, 180)])
+
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                a, b = boxes[i], boxes[j]
+                union = [max(a[0], b[0]), min(a[1], b[1]), min(a[2], b[2]), max(a[3], b[3])]
+                if overlap(a, b) or area(union) <= (area(a) + area(b)) * (1 + max_overhead):
+                    boxes[i] = union
+                    del boxes[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return boxes
+
+
+class DataRequest:
+    def __init__(self, dataset_name: str, parameters: dict, area: Optional[list] = None):
+        self.dataset_name = dataset_name
+        self.parameters = parameters
+        self.area = area  # [north, west, south, east]; None — вся доступная область
+
+
+class IPollutantConverter(ABC):
+    @abstractmethod
+    def convert(self, value: float, pollutant: str) -> float:
+        pass
+
+
+class AtmosphericLayerPollutantConverter(IPollutantConverter):
+    def __init__(self, atmospheric_layer_thickness: float = 1000, unit: str = 'μg/m³'):
+        if unit == 'kg/m³':
+            self.unit_conversion = {
+                'no2_conc': 1e12 / atmospheric_layer_thickness,
+                'so2_conc': 1e12 / atmospheric_layer_thickness,
+                'co_conc': 1e12 / atmospheric_layer_thickness,
+                'pm10_conc': 1e12 / atmospheric_layer_thickness,
+                'pm2p5_conc': 1e12 / atmospheric_layer_thickness,
+                'o3_conc': 1e12 / atmospheric_layer_thickness,
+                'nh3_conc': 1e12 / atmospheric_layer_thickness
+            }
+        elif unit == 'μg/m³':
+            self.unit_conversion = {
+                'no2_conc': 1,
+                'so2_conc': 1,
+                'co_conc': 1,
+                'pm10_conc': 1,
+                'pm2p5_conc': 1,
+                'o3_conc': 1,
+                'nh3_conc': 1
+            }
+
+    def convert(self, value: float, pollutant: str) -> float:
+        if pollutant in self.unit_conversion:
+            return value * self.unit_conversion[pollutant]
+        else:
+            raise ValueError(f"Unsupported pollutant: {pollutant}")
+
+
+def nearest_indices(coord: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """Индексы ближайших узлов сетки `coord` для каждого значения из `values`."""
+    coord = np.asarray(coord)
+    values = np.atleast_1d(np.asarray(values, dtype=coord.dtype))
+    if len(coord) == 1:
+        return np.zeros(len(values), dtype=np.intp)
+
+    order = np.argsort(coord, kind='stable')
+    sorted_coord = coord[order]
+    pos = np.clip(np.searchsorted(sorted_coord, values), 1, len(coord) - 1)
+    pos -= (values - sorted_coord[pos - 1]) <= (sorted_coord[pos] - values)
+    return order[pos]
+
+
+def time_window_indices(time: np.ndarray, start=None, stop=None) -> tuple:
+    """Индексы [a, b) шагов времени в окне [start, stop); None — без ограничения с этой стороны."""
+    a = 0 if start is None else int(np.searchsorted(time, _to_datetime64(start), side='left'))
+    b = len(time) if stop is None else int(np.searchsorted(time, _to_datetime64(stop), side='left'))
+    return a, b
+
+
+def _to_datetime64(value) -> np.datetime64:
+    # Время в CAMS — UTC без часового пояса
+    timestamp = pd.Timestamp(value)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.tz_convert(None)
+    return timestamp.to_datetime64()
+
+
+def select_time_window(data: xr.Dataset, start=None, stop=None) -> xr.Dataset:
+    if start is None and stop is None:
+        return data
+    a, b = time_window_indices(data.time.values, start, stop)
+    return data.isel(time=slice(a, b))
+
+
+class IESGCalculator(ABC):
+    @abstractmethod
+    def calculate_indicator(self, data: xr.Dataset) -> Dict[str, Any]:
+        pass
+
+    @abstractmethod
+    def interpret_results(self, esg_results: Dict[str, Any]) -> str:
+        pass
+
+
+class ESGCalculator(IESGCalculator):
+    def __init__(self, pollutant_converter: IPollutantConverter, index_pollutants: Optional[Sequence[str]] = None):
+        self.pollutant_converter = pollutant_converter
+        # Загрязнители, по которым усредняется pollution_index (None — все имеющиеся в данных).
+        # Каталог с несколькими продуктами задаёт их общий набор: иначе индекс глобального
+        # продукта без NH3 и европейского с ним считался бы по разному числу веществ
+        self.index_pollutants = list(index_pollutants) if index_pollutants is not None else None
+        self.who_limits = {
+            'no2_conc': 40,  # NO2 (диоксид азота), среднегодовое значение
+            'so2_conc': 20,  # SO2 (диоксид серы), среднесуточное значение
+            'co_conc': 10000,  # CO (угарный газ), максимальное 8-часовое среднее значение
+            'pm10_conc': 20,  # PM10 (частицы размером до 10 мкм), среднегодовое значение
+            'pm2p5_conc': 10,  # PM2.5 (частицы размером до 2.5 мкм), среднегодовое значение
+            'o3_conc': 100,  # O3 (озон), максимальное 8-часовое среднее значение
+            'nh3_conc': 100,
+            # NH3 (аммиак), среднегодовое значение (это примерное значение, ВОЗ не устанавливает прямой лимит)
+        }
+
+    def calculate_indicator(self, data: xr.Dataset, lat: float, lon: float, delta: float = 0.1,
+                            start=None, stop=None, pyramid=None) -> Dict[str, Any]:
+        # [start, stop) ограничивает период расчёта; pyramid (TemporalPyramid, построенная по data)
+        # позволяет не проходить по всем шагам времени окна
+        if pyramid is not None:
+            return self._calculate_indicator_from_pyramid(pyramid, lat, lon, start, stop)
+        data = select_time_window(data, start, stop)
+
+        # Ограничиваем данные по заданной локации
+        with timed('calculator.nearest_point'):
+            lat_idx = abs(data.latitude - lat).argmin()
+            lon_idx = abs(data.longitude - lon).argmin()
+            data_subset = data.isel(latitude=lat_idx, longitude=lon_idx)
+
+        concentrations = {}
+        with timed('calculator.pollutant_means'):
+            for pollutant in self.who_limits.keys():
+                if pollutant in data:
+                    if 'latitude' in data_subset[pollutant].dims and 'longitude' in data_subset[pollutant].dims:
+                        concentration = data_subset[pollutant].mean(dim=['latitude', 'longitude', 'time'])
+                    else:
+                        concentration = data_subset[pollutant].mean(dim=['time'])
+                    if 'pressure_level' in concentration.dims:
+                        concentration = concentration.mean(dim='pressure_level')
+                    concentrations[pollutant] = float(self.pollutant_converter.convert(concentration, pollutant))
+
+        normalized_concentrations = {p: concentrations[p] / self.who_limits[p] for p in concentrations}
+        pollution_index = self._pollution_index_of(normalized_concentrations)
+        pollution_trend = self._calculate_trend(data)
+
+        return {
+            'pollution_index': pollution_index,
+            'normalized_concentrations': normalized_concentrations,
+            'pollution_trend': pollution_trend
+        }
+
+    def calculate_indicators_batch(self, data: xr.Dataset, lats: Sequence[float], lons: Sequence[float],
+                                   start=None, stop=None, pyramid=None) -> Dict[str, Any]:
+        # Векторизованный аналог calculate_indicator для множества точек: результаты
+        # возвращаются массивами (точка x загрязнитель) без промежуточных словарей.
+        if pyramid is not None:
+            return self._calculate_indicators_from_pyramid(pyramid, lats, lons, start, stop)
+        data = select_time_window(data, start, stop)
+
+        with timed('calculator.nearest_point'):
+            lat_idx = nearest_indices(data.latitude.values, lats)
+            lon_idx = nearest_indices(data.longitude.values, lons)
+            points = dict(latitude=xr.DataArray(lat_idx, dims='site'), longitude=xr.DataArray(lon_idx, dims='site'))
+
+        pollutants = [p for p in self.who_limits if p in data]
+        normalized = np.empty((len(lat_idx), len(pollutants)), dtype=np.float64)
+        with timed('calculator.pollutant_means'):
+            for i, pollutant in enumerate(pollutants):
+                concentration = data[pollutant].isel(points).mean(dim='time')
+                if 'pressure_level' in concentration.dims:
+                    concentration = concentration.mean(dim='pressure_level')
+                concentration = self.pollutant_converter.convert(concentration.values, pollutant)
+                normalized[:, i] = concentration / self.who_limits[pollutant]
+
+        trends = self._calculate_trend(data)
+        return {
+            'pollutants': pollutants,
+            'latitude': data.latitude.values[lat_idx],
+            'longitude': data.longitude.values[lon_idx],
+            'pollution_index': self._pollution_index(normalized, pollutants),
+            'normalized_concentrations': normalized,
+            # Тренд считается по всему набору данных, как и в calculate_indicator
+            'pollution_trend': np.array([trends[p] for p in pollutants], dtype=np.float64),
+        }
+
+    def calculate_timeline(self, pyramid, lats: Sequence[float], lons: Sequence[float], freq: Optional[str] = None,
+                           window: Optional[str] = None, step: Optional[str] = None, start=None,
+                           stop=None) -> Dict[str, Any]:
+        # Индикаторы calculate_indicator по последовательности окон (см. TemporalPyramid.windows)
+        # для множества точек сразу; массивы имеют вид (окно, точка) и (окно, точка, загрязнитель)
+        with timed('calculator.nearest_point'):
+            lat_idx = nearest_indices(pyramid.latitude, lats)
+            lon_idx = nearest_indices(pyramid.longitude, lons)
+
+        with timed('calculator.timeline'):
+            starts, stops = pyramid.windows(freq=freq, window=window, step=step, start=start, stop=stop)
+            means = pyramid.series_window_means(lat_idx, lon_idx, starts, stops)  # (pollutant, окно, точка)
+            normalized = np.stack([
+                self.pollutant_converter.convert(means[i], p) / self.who_limits[p]
+                for i, p in enumerate(pyramid.pollutants)
+            ], axis=-1)
+            slopes = pyramid.window_trends(starts, stops)
+            trends = np.stack([self.pollutant_converter.convert(slopes[i], p)
+                               for i, p in enumerate(pyramid.pollutants)], axis=-1)
+
+        return {
+            'pollutants': list(pyramid.pollutants),
+            'window_start': pyramid.time[starts],
+            'window_stop': pyramid.time[stops - 1],
+            'latitude': pyramid.latitude[lat_idx],
+            'longitude': pyramid.longitude[lon_idx],
+            'pollution_index': self._pollution_index(normalized, pyramid.pollutants),
+            'normalized_concentrations': normalized,
+            'pollution_trend': trends,  # (окно, загрязнитель), по всей сетке, как в calculate_indicator
+        }
+
+    def _calculate_indicators_from_pyramid(self, pyramid, lats: Sequence[float], lons: Sequence[float],
+                                           start=None, stop=None) -> Dict[str, Any]:
+        with timed('calculator.nearest_point'):
+            lat_idx = nearest_indices(pyramid.latitude, lats)
+            lon_idx = nearest_indices(pyramid.longitude, lons)
+
+        with timed('calculator.pollutant_means'):
+            means = pyramid.window_means(lat_idx, lon_idx, start, stop)  # (pollutant, точка)
+            normalized = np.stack([self.pollutant_converter.convert(means[i], p) / self.who_limits[p]
+                                   for i, p in enumerate(pyramid.pollutants)], axis=-1)
+        trends = self._calculate_trend(None, start, stop, pyramid=pyramid)
+        return {
+            'pollutants': list(pyramid.pollutants),
+            'latitude': pyramid.latitude[lat_idx],
+            'longitude': pyramid.longitude[lon_idx],
+            'pollution_index': self._pollution_index(normalized, pyramid.pollutants),
+            'normalized_concentrations': normalized,
+            'pollution_trend': np.array([trends[p] for p in pyramid.pollutants], dtype=np.float64),
+        }
+
+    def _calculate_indicator_from_pyramid(self, pyramid, lat: float, lon: float, start=None,
+                                          stop=None) -> Dict[str, Any]:
+        with timed('calculator.nearest_point'):
+            lat_idx = int(nearest_indices(pyramid.latitude, lat)[0])
+            lon_idx = int(nearest_indices(pyramid.longitude, lon)[0])
+
+        with timed('calculator.pollutant_means'):
+            means = pyramid.window_mean(lat_idx, lon_idx, start, stop)
+            normalized_concentrations = {
+                p: float(self.pollutant_converter.convert(means[i], p)) / self.who_limits[p]
+                for i, p in enumerate(pyramid.pollutants)
+            }
+        pollution_index = self._pollution_index_of(normalized_concentrations)
+        pollution_trend = self._calculate_trend(None, start, stop, pyramid=pyramid)
+
+        return {
+            'pollution_index': pollution_index,
+            'normalized_concentrations': normalized_concentrations,
+            'pollution_trend': pollution_trend
+        }
+
+    def _pollution_index(self, normalized: np.ndarray, pollutants: Sequence[str]) -> np.ndarray:
+        # Среднее нормированных концентраций (последняя ось — загрязнитель) по index_pollutants
+        columns = [i for i, p in enumerate(pollutants) if self.index_pollutants is None or p in self.index_pollutants]
+        return normalized[..., columns].mean(axis=-1)
+
+    def _pollution_index_of(self, normalized_concentrations: Dict[str, float]):
+        return self._pollution_index(np.array(list(normalized_concentrations.values()), dtype=np.float64),
+                                     list(normalized_concentrations))
+
+    def calculate_trend(self, pyramid, start=None, stop=None) -> Dict[str, float]:
+        """pollution_trend по всей сетке за окно [start, stop) из TemporalPyramid."""
+        return self._calculate_trend(None, start, stop, pyramid=pyramid)
+
+    def _calculate_trend(self, data: xr.Dataset, start=None, stop=None, pyramid=None) -> Dict[str, float]:
+        if pyramid is not None:
+            with timed('calculator.trend'):
+                slopes = pyramid.window_trend(start, stop)
+                return {p: float(self.pollutant_converter.convert(slopes[i], p))
+                        for i, p in enumerate(pyramid.pollutants)}
+
+        data = select_time_window(data, start, stop)
+        trends = {}
+        with timed('calculator.trend'):
+            for pollutant in self.who_limits.keys():
+                if pollutant in data:
+                    pollutant_data = data[pollutant].mean(dim=['latitude', 'longitude'])
+                    if 'pressure_level' in pollutant_data.dims:
+                        pollutant_data = pollutant_data.mean(dim='pressure_level')
+                    pollutant_data = self.pollutant_converter.convert(pollutant_data, pollutant)
+
+                    time_index = range(len(pollutant_data))
+                    trend = np.polyfit(time_index, pollutant_data.values, 1)[0]
+                    trends[pollutant] = float(trend)
+        return trends
+
+    def compare_point_to_region(self, data: xr.Dataset, lat: float, lon: float, delta: float = 1,
+                                resolution: Optional[float] = None, pyramid=None) -> str:
+        # pyramid (SpatialPyramid по data) берёт средние по времени из предрасчитанных полей,
+        # а регион усредняет на самом грубом уровне с размером ячейки не больше resolution
+        if pyramid is not None:
+            with timed('calculator.nearest_point'):
+                point_means = pyramid.point_mean(lat, lon)
+            with timed('calculator.region_mean'):
+                region_means = pyramid.region_mean(lat - delta, lat + delta, lon - delta, lon + delta, resolution)
+            point_values = {p: float(point_means[i]) for i, p in enumerate(pyramid.pollutants)}
+            region_values = {p: float(region_means[i]) for i, p in enumerate(pyramid.pollutants)}
+            return self.comparison_result(lat, lon, delta, point_values, region_values)
+
+        # Ограничиваем данные по заданной локации
+        with timed('calculator.nearest_point'):
+            lat_idx = abs(data.latitude - lat).argmin()
+            lon_idx = abs(data.longitude - lon).argmin()
+            point_data = data.isel(latitude=lat_idx, longitude=lon_idx)
+
+        # Ограничиваем данные по региону вокруг заданной локации
+        with timed('calculator.region_mean'):
+            lat_min, lat_max = lat - delta, lat + delta
+            lon_min, lon_max = lon - delta, lon + delta
+            data = data.sortby(['latitude', 'longitude'])
+            region_data = data.sel(latitude=slice(lat_min, lat_max), longitude=slice(lon_min, lon_max))
+            region_data = region_data.mean(dim=['latitude', 'longitude'])
+
+        point_values = {var: point_data[var].mean().item() for var in point_data.keys() if var in self.who_limits}
+        region_values = {var: region_data[var].mean().item() for var in point_values}
+        return self.comparison_result(lat, lon, delta, point_values, region_values)
+
+    def compare_points_to_regions(self, pyramid, lats: Sequence[float], lons: Sequence[float],
+                                  deltas: Sequence[float], resolution: Optional[float] = None) -> List[Dict[str, Any]]:
+        # compare_point_to_region с pyramid для множества точек: средние по всем регионам
+        # берутся из таблиц накопленных сумм за один проход (см. SpatialPyramid.region_means)
+        lats, lons = np.asarray(lats, dtype=np.float64), np.asarray(lons, dtype=np.float64)
+        deltas = np.asarray(deltas, dtype=np.float64)
+        with timed('calculator.nearest_point'):
+            point_means = pyramid.point_means(lats, lons)
+        with timed('calculator.region_mean'):
+            region_means = pyramid.region_means(lats - deltas, lats + deltas, lons - deltas, lons + deltas, resolution)
+        return [
+            self.comparison_result(float(lats[k]), float(lons[k]), float(deltas[k]),
+                                   {p: float(point_means[i, k]) for i, p in enumerate(pyramid.pollutants)},
+                                   {p: float(region_means[i, k]) for i, p in enumerate(pyramid.pollutants)})
+            for k in range(len(lats))
+        ]
+
+    def compare_point_to_zone(self, lat: float, lon: float, zone: str, pyramid, zonal,
+                              zone_pyramids=None) -> Dict[str, Any]:
+        # То же сравнение, что compare_point_to_region, но регион — полигон зоны (ZonalStatistics)
+        # со средним, взвешенным по площади ячеек; zone_pyramids — пирамиды всех блоков данных,
+        # по которым усредняется зона (по умолчанию только pyramid точки)
+        with timed('calculator.nearest_point'):
+            point_means = pyramid.point_mean(lat, lon)
+        with timed('calculator.region_mean'):
+            zone_means = zonal.pyramid_means(zone_pyramids if zone_pyramids is not None else pyramid, [zone])[0]
+        point_values = {p: float(point_means[i]) for i, p in enumerate(pyramid.pollutants)}
+        region_values = {p: float(zone_means[i]) for i, p in enumerate(pyramid.pollutants)}
+        result = self.comparison_result(lat, lon, None, point_values, region_values)
+        result["region"] = zone
+        return result
+
+    def comparison_result(self, lat: float, lon: float, delta: Optional[float], point_values: Dict[str, float],
+                          region_values: Dict[str, float]) -> Dict[str, Any]:
+        """Результат сравнения точки с регионом по уже посчитанным средним (их собирает и router.py по шардам)."""
+        result = {
+            "location": {
+                "latitude": lat,
+                "longitude": lon
+            },
+            "region_delta": delta,
+            "variables": {}
+        }
+
+        for var, point_value in point_values.items():
+            if var in self.who_limits:
+                region_mean = region_values[var]
+                who_limit = self.who_limits[var]
+
+                percent_difference = ((point_value / region_mean) - 1) * 100 if point_value > region_mean else ((
+                                                                                                                            region_mean / point_value) - 1) * 100
+                exceeds_who = point_value > who_limit
+                who_exceedance_percent = ((point_value / who_limit) - 1) * 100 if exceeds_who else None
+
+                result["variables"][var] = {
+                    "point_value": round(point_value, 2),
+                    "region_mean": round(region_mean, 2),
+                    "who_limit": who_limit,
+                    "percent_difference": round(percent_difference, 1),
+                    "comparison": "higher" if point_value > region_mean else "lower",
+                    "exceeds_who_limit": exceeds_who,
+                    "who_exceedance_percent": round(who_exceedance_percent,
+                                                    1) if who_exceedance_percent is not None else None
+                }
+
+        return result
+
+    def interpret_results(self, esg_results: Dict[str, Any]) -> str:
+        interpretation = ""
+        if esg_results['pollution_index'] < 0.5:
+            interpretation += "The company has a low environmental impact. "
+        elif esg_results['pollution_index'] < 1:
+            interpretation += "The company has a moderate environmental impact. "
+        else:
+            interpretation += "The company has a high environmental impact. "
+
+        improving_pollutants = [p for p, t in esg_results['pollution_trend'].items() if t < 0]
+        worsening_pollutants = [p for p, t in esg_results['pollution_trend'].items() if t > 0]
+
+        if improving_pollutants:
+            interpretation += f"Improvements observed in the following pollutants: {', '.join(improving_pollutants)}. "
+        if worsening_pollutants:
+            interpretation += f"Deterioration observed in the following pollutants: {', '.join(worsening_pollutants)}. "
+
+        if esg_results['pollution_index'] >= 1:
+            interpretation += "It is recommended to develop a plan to reduce emissions. "
+        elif worsening_pollutants:
+            interpretation += "It is recommended to pay attention to the increasing concentrations of some pollutants. "
+        else:
+            interpretation += "It is recommended to maintain the current environmental policy and strive for further improvement. "
+
+        return interpretation
+
+
+class CopernicusDataHandler:
+    def __init__(self, zip_file: str):
+        self.zip_file = zip_file
+        self.temp_dir = tempfile.mkdtemp()
+        self.datasets = []
+
+    def extract_and_load_data(self):
+        with timed('loader.extract'), zipfile.ZipFile(self.zip_file, 'r') as zip_ref:
+            zip_ref.extractall(self.temp_dir)
+        registry.inc('esg_data_bytes_loaded_total', os.path.getsize(self.zip_file), source='zip')
+
+        # Находим все .nc файлы в распакованной директории
+        nc_files = glob.glob(os.path.join(self.temp_dir, '*.nc'))
+
+        if not nc_files:
+            print("No NetCDF files found in the extracted data.")
+            return
+
+        # Загружаем каждый .nc файл
+        with timed('loader.open'):
+            for file in nc_files:
+                dataset = xr.open_dataset(file)
+                self.datasets.append(dataset)
+                registry.inc('esg_data_bytes_loaded_total', os.path.getsize(file), source='netcdf')
+                print(f"Variables in {os.path.basename(file)}:", list(dataset.variables))
+
+    def get_combined_data(self):
+        if not self.datasets:
+            print("No datasets loaded.")
+            return None
+
+        # Объединяем все датасеты
+        with timed('loader.merge'):
+            combined_data = xr.merge(self.datasets)
+        registry.set_gauge('esg_dataset_bytes', combined_data.nbytes)
+        return combined_data
+
+    def close_data(self):
+        for dataset in self.datasets:
+            dataset.close()
+        self.datasets.clear()
+
+    def __del__(self):
+        self.close_data()
+        # Очистка временных файлов
+        # for file in os.listdir(self.temp_dir):
+        #     try:
+        #         os.remove(os.path.join(self.temp_dir, file))
+        #     except PermissionError:
+        #         print(f"Could not remove file: {file}")
+        # try:
+        #     os.rmdir(self.temp_dir)
+        # except PermissionError:
+        #     print(f"Could not remove temporary directory: {self.temp_dir}")
+
+
+def compact_dataset(data: xr.Dataset, pollutants: Sequence[str], level: Optional[float] = None,
+                    dtype=np.float32) -> xr.Dataset:
+    """Оставляет только нужные загрязнители, один раз сворачивает уровни давления и приводит тип.
+
+    Все переменные результата (time, latitude, longitude) — срезы одного массива
+    (pollutant, time, latitude, longitude), см. pollutant_stack. `level=None` усредняет
+    по pressure_level, как это делали расчёты при каждом вызове; иначе выбирается уровень.
+    """
+    pollutants = [p for p in pollutants if p in data]
+    dims = ('time', 'latitude', 'longitude')
+    shape = (len(pollutants),) + tuple(data.sizes[dim] for dim in dims)
+    stack = np.empty(shape, dtype=dtype)
+
+    with timed('loader.compact'):
+        # По одной переменной за раз, чтобы пиковая память не превышала stack + одну переменную
+        for i, pollutant in enumerate(pollutants):
+            values = data[pollutant]
+            if 'pressure_level' in values.dims:
+                values = values.mean(dim='pressure_level') if level is None else values.sel(pressure_level=level)
+            stack[i] = values.transpose(*dims).values
+
+    coords = {dim: data[dim].values for dim in dims}
+    compacted = xr.Dataset(
+        {pollutant: (dims, stack[i], data[pollutant].attrs) for i, pollutant in enumerate(pollutants)},
+        coords=coords,
+        attrs=data.attrs,
+    )
+    # Новая версия на каждую загрузку: по ней кэшируются производные структуры (SpatialPyramid)
+    compacted.attrs['dataset_version'] = uuid.uuid4().hex
+    registry.set_gauge('esg_dataset_bytes', stack.nbytes)
+    return compacted
+
+
+def pollutant_stack(data: xr.Dataset, pollutants: Sequence[str]) -> np.ndarray:
+    """Массив (pollutant, time, latitude, longitude) без копирования, если data получен из compact_dataset."""
+    arrays = [data[p].values for p in pollutants]
+    base = arrays[0].base
+    if (isinstance(base, np.ndarray) and base.ndim == 4 and base.shape[0] == len(arrays)
+            and all(a.base is base and a.ctypes.data == base[i].ctypes.data for i, a in enumerate(arrays))):
+        return base
+    return np.stack(arrays)
+
+
+class MultiAreaDataHandler:
+    """Загружает архивы нескольких областей; каждая остаётся отдельным набором данных.
+
+    Области не сливаются в одну плотную сетку: для разнесённых площадок она была бы
+    в основном пустой (две области 3°×3° на разных концах Европы заняли бы столько же
+    памяти, сколько 3°×60°). API строит по каждой области свой блок (catalog.DatasetView)
+    и выбирает блок по точке запроса.
+    """
+
+    def __init__(self, zip_files: Sequence[str]):
+        self.handlers = [CopernicusDataHandler(zip_file) for zip_file in zip_files]
+
+    def extract_and_load_data(self):
+        for handler in self.handlers:
+            handler.extract_and_load_data()
+
+    def get_area_data(self) -> List[Optional[xr.Dataset]]:
+        """Данные каждой области в порядке архивов (None, если в архиве нет данных)."""
+        return [handler.get_combined_data() for handler in self.handlers]
+
+    def close_data(self):
+        for handler in self.handlers:
+            handler.close_data()
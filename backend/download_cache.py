@@ -0,0 +1,201 @@
+import errno
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+from metrics import cache_lookup, registry
+
+# 1 MiB: чтение файлов при подсчёте контрольной суммы
+_CHUNK_SIZE = 1 << 20
+# Блокировки делятся по первым двум hex-символам ключа: не больше 256 файлов на весь кэш
+_LOCK_PREFIX = 2
+
+
+def request_key(dataset_name: str, parameters: Dict[str, Any]) -> str:
+    """Хэш канонической записи запроса; порядок ключей в parameters на ключ не влияет."""
+    canonical = json.dumps({'dataset': dataset_name, 'parameters': parameters}, sort_keys=True,
+                           separators=(',', ':'), default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def _file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DownloadCache:
+    """Кэш скачанных файлов на диске, ключ — хэш запроса (см. request_key).
+
+    Рядом с каждым файлом лежит <key>.json с размером и sha256; запись идёт во
+    временный файл с os.replace, поэтому читатели никогда не видят недокачанный
+    файл. Повреждённые записи удаляются при чтении. Общий размер ограничен
+    max_bytes: вытесняются записи, к которым дольше всего не обращались.
+    Загрузка одного ключа несколькими процессами сериализуется файловой
+    блокировкой (общей для ключей с одинаковым префиксом), так что каждый
+    уникальный запрос скачивается один раз. Вызывающий, которому файл нужен
+    дольше одного вызова, получает его жёсткой ссылкой вне кэша (target):
+    вытеснение такую копию не затрагивает.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = 20 * 1024 ** 3, extension: str = 'zip',
+                 verify: bool = True):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.extension = extension
+        self.verify = verify
+        os.makedirs(os.path.join(cache_dir, '.locks'), exist_ok=True)
+        # Блокировки прежнего формата, по файлу на ключ
+        for path in glob.glob(os.path.join(cache_dir, '*.lock')):
+            _remove_file(path)
+
+    def _data_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f'{key}.{self.extension}')
+
+    def _meta_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f'{key}.json')
+
+    @contextmanager
+    def _lock(self, key: str, blocking: bool = True):
+        """Блокировка ключа; с blocking=False отдаёт False, если она занята."""
+        with open(os.path.join(self.cache_dir, '.locks', f'{key[:_LOCK_PREFIX]}.lock'), 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def get(self, key: str) -> Optional[str]:
+        """Путь к проверенному файлу из кэша или None."""
+        path, meta_path = self._data_path(key), self._meta_path(key)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            size = os.path.getsize(path)
+        except (OSError, ValueError):
+            return None
+
+        if size != meta.get('size') or (self.verify and _file_sha256(path) != meta.get('sha256')):
+            self._remove(key)
+            return None
+
+        # Время последнего обращения для LRU храним в mtime метаданных (atime часто отключён)
+        now = time.time()
+        os.utime(meta_path, (now, now))
+        return path
+
+    def get_or_download(self, key: str, download: Callable[[str], None],
+                        info: Optional[Dict[str, Any]] = None, target: Optional[str] = None) -> str:
+        """Возвращает путь к файлу по ключу, при промахе вызывает download(tmp_path).
+
+        С target файл выкладывается туда жёсткой ссылкой (копией на другой файловой
+        системе) под блокировкой ключа, и возвращается target: этот путь остаётся
+        действительным, даже если запись потом вытеснят.
+        """
+        with self._lock(key):
+            path = self.get(key)
+            if path is not None:
+                cache_lookup('downloads', hit=True)
+            else:
+                cache_lookup('downloads', hit=False)
+                path = self._download(key, download, info)
+            if target is not None:
+                path = _link(path, target)
+
+        self.evict(keep=key)
+        return path
+
+    def _download(self, key: str, download: Callable[[str], None], info: Optional[Dict[str, Any]]) -> str:
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=f'.{key}.', suffix='.part')
+        os.close(fd)
+        try:
+            download(tmp_path)
+            meta = {'size': os.path.getsize(tmp_path), 'sha256': _file_sha256(tmp_path),
+                    'created_at': time.time(), 'request': info}
+            path = self._data_path(key)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        # Метаданные появляются последними: запись без них считается отсутствующей
+        tmp_meta = f'{self._meta_path(key)}.part'
+        with open(tmp_meta, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_meta, self._meta_path(key))
+        registry.inc('esg_download_bytes_total', meta['size'])
+        return path
+
+    def entries(self) -> List[Dict[str, Any]]:
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.json'):
+                continue
+            key = name[:-len('.json')]
+            try:
+                size = os.path.getsize(self._data_path(key))
+                last_used = os.path.getmtime(self._meta_path(key))
+            except OSError:
+                continue
+            entries.append({'key': key, 'size': size, 'last_used': last_used})
+        return entries
+
+    def evict(self, keep: Optional[str] = None) -> None:
+        """Удаляет самые давно использованные записи, пока кэш больше max_bytes.
+
+        Записи, чья блокировка занята (их скачивают или выкладывают), пропускаются.
+        """
+        entries = sorted(self.entries(), key=lambda entry: entry['last_used'])
+        total = sum(entry['size'] for entry in entries)
+        for entry in entries:
+            if total <= self.max_bytes:
+                break
+            if entry['key'] == keep:
+                continue
+            with self._lock(entry['key'], blocking=False) as locked:
+                if not locked:
+                    continue
+                self._remove(entry['key'])
+            total -= entry['size']
+        registry.set_gauge('esg_download_cache_bytes', total)
+
+    def _remove(self, key: str) -> None:
+        for path in (self._meta_path(key), self._data_path(key)):
+            _remove_file(path)
+
+
+def _link(path: str, target: str) -> str:
+    """Жёсткая ссылка на path в target (копия, если это другая файловая система)."""
+    target_dir = os.path.dirname(os.path.abspath(target))
+    os.makedirs(target_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=target_dir, prefix='.', suffix='.part')
+    os.close(fd)
+    os.remove(tmp_path)
+    try:
+        os.link(path, tmp_path)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copyfile(path, tmp_path)
+    os.replace(tmp_path, target)
+    return target
+
+
+def _remove_file(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
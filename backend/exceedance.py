@@ -0,0 +1,163 @@
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from core import IPollutantConverter, nearest_indices, pollutant_stack
+from metrics import timed
+
+# Окно усреднения норматива ВОЗ в часах (см. комментарии к ESGCalculator.who_limits);
+# None — среднегодовой норматив, сравнивается среднее за весь загруженный период
+WHO_AVERAGING_HOURS = {
+    'no2_conc': None,
+    'so2_conc': 24,
+    'co_conc': 8,
+    'pm10_conc': None,
+    'pm2p5_conc': None,
+    'o3_conc': 8,
+    'nh3_conc': None,
+}
+
+# Предел временных массивов при расчёте по сетке: строки широт обрабатываются блоками,
+# чтобы пик памяти не рос с размером сетки (на ячейку — около шести рядов float64 длины T)
+CHUNK_BYTES = 256 * 2 ** 20
+
+
+def rolling_mean(values: np.ndarray, window: int) -> np.ndarray:
+    """Скользящее среднее по оси 0 через кумулятивные суммы: O(T) для любого окна.
+
+    Возвращает T - window + 1 значений; окно, где есть хоть один NaN, даёт NaN.
+    """
+    valid = ~np.isnan(values)
+    zero = np.zeros((1,) + values.shape[1:])
+    sums = np.concatenate([zero, np.cumsum(np.where(valid, values, 0.0), axis=0, dtype=np.float64)])
+    counts = np.concatenate([zero, np.cumsum(valid, axis=0, dtype=np.float64)])
+    window_sums = sums[window:] - sums[:-window]
+    window_counts = counts[window:] - counts[:-window]
+    return np.where(window_counts == window, window_sums / window, np.nan)
+
+
+def run_lengths(mask: np.ndarray) -> np.ndarray:
+    """Длина текущей серии True на каждом шаге по оси 0 (0 там, где False)."""
+    steps = np.arange(len(mask)).reshape((-1,) + (1,) * (mask.ndim - 1))
+    last_false = np.maximum.accumulate(np.where(mask, -1, steps), axis=0)
+    return np.where(mask, steps - last_false, 0)
+
+
+def time_step_hours(time: np.ndarray) -> float:
+    if len(time) < 2:
+        return 1.0
+    return float(np.median(np.diff(time.astype('datetime64[s]')).astype(np.float64)) / 3600.0)
+
+
+class ExceedanceEngine:
+    """Превышения нормативов ВОЗ по всей сетке с правильным окном усреднения.
+
+    Для загрязнителей с 8- и 24-часовыми нормативами считается скользящее среднее
+    по окну (кумулятивные суммы по времени сразу для всех ячеек), события — серии
+    подряд идущих окон выше норматива. По каждой ячейке хранятся максимум
+    скользящего среднего, число событий, суммарная и наибольшая длительность.
+    Сетка обрабатывается блоками строк широт не больше chunk_bytes временных данных.
+    """
+
+    def __init__(self, data: xr.Dataset, pollutant_converter: IPollutantConverter, who_limits: Dict[str, float],
+                 averaging_hours: Optional[Dict[str, Optional[int]]] = None, chunk_bytes: int = CHUNK_BYTES):
+        self.pollutants = [p for p in who_limits if p in data]
+        self.who_limits = {p: who_limits[p] for p in self.pollutants}
+        self.averaging_hours = {p: (averaging_hours or WHO_AVERAGING_HOURS).get(p) for p in self.pollutants}
+        self.pollutant_converter = pollutant_converter
+        self.time = data.time.values
+        self.latitude = data.latitude.values
+        self.longitude = data.longitude.values
+        self.step_hours = time_step_hours(self.time)
+        self.stack = pollutant_stack(data, self.pollutants)  # (pollutant, time, latitude, longitude)
+
+        shape = (len(self.pollutants),) + self.stack.shape[2:]
+        self.max_mean = np.full(shape, np.nan)
+        self.events = np.zeros(shape, dtype=np.int32)
+        self.exceeded_steps = np.zeros(shape, dtype=np.int32)
+        self.longest_steps = np.zeros(shape, dtype=np.int32)
+        rows = max(1, chunk_bytes // (6 * 8 * max(1, len(self.time) * len(self.longitude))))
+        with timed('exceedance.grid'):
+            for i, pollutant in enumerate(self.pollutants):
+                for start in range(0, len(self.latitude), rows):
+                    self._grid_statistics(i, pollutant, slice(start, start + rows))
+
+    def _grid_statistics(self, i: int, pollutant: str, rows: slice) -> None:
+        means = self._window_means(self.stack[i][:, rows], pollutant)
+        with np.errstate(invalid='ignore'):
+            self.max_mean[i, rows] = np.nanmax(means, axis=0) if np.isfinite(means).any() else np.nan
+            exceeded = means > self.who_limits[pollutant]
+        if self.window_steps(pollutant) is None:
+            return  # для нормативов на весь период событий нет, только сравнение среднего
+        starts = exceeded & ~np.concatenate([np.zeros_like(exceeded[:1]), exceeded[:-1]])
+        self.events[i, rows] = starts.sum(axis=0)
+        self.exceeded_steps[i, rows] = exceeded.sum(axis=0)
+        self.longest_steps[i, rows] = run_lengths(exceeded).max(axis=0, initial=0)
+
+    def window_steps(self, pollutant: str) -> Optional[int]:
+        hours = self.averaging_hours[pollutant]
+        if hours is None:
+            return None
+        return max(1, min(len(self.time), int(round(hours / self.step_hours))))
+
+    def _window_means(self, values: np.ndarray, pollutant: str) -> np.ndarray:
+        values = self.pollutant_converter.convert(values.astype(np.float64), pollutant)
+        window = self.window_steps(pollutant)
+        if window is None:
+            with np.errstate(invalid='ignore'):
+                return np.nanmean(values, axis=0, keepdims=True)
+        return rolling_mean(values, window)
+
+    def point(self, lat: float, lon: float) -> Dict[str, Any]:
+        lat_idx = int(nearest_indices(self.latitude, lat)[0])
+        lon_idx = int(nearest_indices(self.longitude, lon)[0])
+        result = {}
+        for i, pollutant in enumerate(self.pollutants):
+            window = self.window_steps(pollutant)
+            hours = self.averaging_hours[pollutant]
+            means = self._window_means(self.stack[i][:, lat_idx, lon_idx], pollutant)
+            result[pollutant] = {
+                'averaging': f'{hours}h' if hours is not None else 'period',
+                'window_steps': window,
+                'who_limit': self.who_limits[pollutant],
+                'max_mean': _finite(self.max_mean[i, lat_idx, lon_idx]),
+                'exceeds_who_limit': bool(self.max_mean[i, lat_idx, lon_idx] > self.who_limits[pollutant]),
+                'events': int(self.events[i, lat_idx, lon_idx]),
+                'exceeded_hours': float(self.exceeded_steps[i, lat_idx, lon_idx] * self.step_hours),
+                'longest_event_hours': float(self.longest_steps[i, lat_idx, lon_idx] * self.step_hours),
+                'event_list': self._events(means, window, self.who_limits[pollutant]),
+            }
+        return {
+            'location': {'latitude': float(self.latitude[lat_idx]), 'longitude': float(self.longitude[lon_idx])},
+            'time_step_hours': self.step_hours,
+            'pollutants': result,
+        }
+
+    def _events(self, means: np.ndarray, window: Optional[int], limit: float) -> List[Dict[str, Any]]:
+        with np.errstate(invalid='ignore'):
+            exceeded = means > limit
+        if window is None or not exceeded.any():
+            return []
+        edges = np.diff(np.concatenate([[0], exceeded.astype(np.int8), [0]]))
+        events = []
+        for first, last in zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)):
+            # Окно i покрывает шаги [i, i + window): событие — от начала первого до конца последнего окна,
+            # длительность — число окон выше норматива, как в exceeded_hours
+            events.append({
+                'start': _timestamp(self.time[first]),
+                'end': _timestamp(self.time[min(last - 1 + window - 1, len(self.time) - 1)]),
+                'peak_mean': float(np.nanmax(means[first:last])),
+                'duration_hours': float((last - first) * self.step_hours),
+            })
+        return events
+
+
+def _finite(value) -> Optional[float]:
+    value = float(value)
+    return value if np.isfinite(value) else None
+
+
+def _timestamp(value) -> str:
+    return pd.Timestamp(value).isoformat()
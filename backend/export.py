@@ -0,0 +1,110 @@
+import argparse
+import io
+from typing import Any, Dict, Optional, Sequence
+
+import numpy as np
+
+from core import AtmosphericLayerPollutantConverter, CopernicusDataHandler, ESGCalculator, compact_dataset
+
+ARROW_MEDIA_TYPE = 'application/vnd.apache.arrow.stream'
+PARQUET_MEDIA_TYPE = 'application/vnd.apache.parquet'
+
+
+# pyarrow is imported inside the functions: api imports this module at startup, but only
+# the /export endpoint and batch_scores jobs need it
+
+
+def scores_table(batch: Dict[str, Any], site_ids: Optional[Sequence[Any]] = None) -> 'pa.Table':
+    """Builds a columnar table from the output of ESGCalculator.calculate_indicators_batch.
+
+    One row per site; normalized concentrations and trends become one column per pollutant.
+    """
+    import pyarrow as pa
+
+    n_sites = len(batch['pollution_index'])
+    columns = {
+        'site_id': pa.array(site_ids) if site_ids is not None else pa.array(np.arange(n_sites)),
+        'latitude': pa.array(batch['latitude']),
+        'longitude': pa.array(batch['longitude']),
+        'pollution_index': pa.array(batch['pollution_index']),
+    }
+    # Slicing a column out of a C-ordered matrix is strided; copy it once so that
+    # Arrow receives a contiguous buffer.
+    normalized = np.asfortranarray(batch['normalized_concentrations'])
+    for i, pollutant in enumerate(batch['pollutants']):
+        columns[f'normalized_{pollutant}'] = pa.array(normalized[:, i])
+    for i, pollutant in enumerate(batch['pollutants']):
+        columns[f'trend_{pollutant}'] = pa.array(np.full(n_sites, batch['pollution_trend'][i]))
+    return pa.table(columns)
+
+
+def concat_scores(tables: Sequence['pa.Table']) -> 'pa.Table':
+    """Tables of scores_table for disjoint subsets of the sites, back in site_id order."""
+    import pyarrow as pa
+
+    return pa.concat_tables(tables).sort_by('site_id')
+
+
+def serialize_table(table: 'pa.Table', fmt: str = 'arrow') -> bytes:
+    import pyarrow.ipc as ipc
+    import pyarrow.parquet as pq
+
+    sink = io.BytesIO()
+    if fmt == 'arrow':
+        with ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+    elif fmt == 'parquet':
+        pq.write_table(table, sink, compression='zstd')
+    else:
+        raise ValueError(f"Unsupported export format: {fmt}")
+    return sink.getvalue()
+
+
+def deserialize_table(content: bytes) -> 'pa.Table':
+    """Reads a table written by serialize_table in the arrow format."""
+    import pyarrow.ipc as ipc
+
+    return ipc.open_stream(content).read_all()
+
+
+def read_sites(path: str) -> 'pa.Table':
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+
+    if path.endswith('.parquet'):
+        return pq.read_table(path)
+    return pa_csv.read_csv(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export portfolio-wide ESG scores as Parquet or Arrow.")
+    parser.add_argument('zip_file', help="CAMS netcdf_zip archive")
+    parser.add_argument('sites', help="CSV or Parquet file with latitude, longitude and optional site_id columns")
+    parser.add_argument('-o', '--output', default='esg_scores.parquet')
+    parser.add_argument('--format', choices=['parquet', 'arrow'], default=None,
+                        help="Defaults to the output file extension")
+    args = parser.parse_args()
+
+    sites = read_sites(args.sites)
+    fmt = args.format or ('arrow' if args.output.endswith(('.arrow', '.arrows')) else 'parquet')
+
+    calculator = ESGCalculator(AtmosphericLayerPollutantConverter())
+
+    data_handler = CopernicusDataHandler(args.zip_file)
+    data_handler.extract_and_load_data()
+    combined_data = compact_dataset(data_handler.get_combined_data(), calculator.who_limits)
+    data_handler.close_data()
+
+    batch = calculator.calculate_indicators_batch(combined_data,
+                                                  sites.column('latitude').to_numpy(),
+                                                  sites.column('longitude').to_numpy())
+    site_ids = sites.column('site_id') if 'site_id' in sites.column_names else None
+    table = scores_table(batch, site_ids)
+
+    with open(args.output, 'wb') as f:
+        f.write(serialize_table(table, fmt))
+    print(f"Exported {table.num_rows} sites to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
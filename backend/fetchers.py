@@ -0,0 +1,73 @@
+import os
+from typing import List, Optional, Sequence
+
+from abc import ABC, abstractmethod
+
+import cdsapi
+
+from core import DataRequest
+from download_cache import DownloadCache, request_key
+
+
+class IDataFetcher(ABC):
+    @abstractmethod
+    def fetch_data(self, data_request: DataRequest):
+        pass
+
+
+class CopernicusDataFetcher(IDataFetcher):
+    def __init__(self, cache: Optional[DownloadCache] = None):
+        self.client = cdsapi.Client()
+        self.cache = cache
+
+    @staticmethod
+    def _parameters(data_request: DataRequest) -> dict:
+        parameters = data_request.parameters.copy()
+        if data_request.area is not None:
+            parameters['area'] = data_request.area
+        return parameters
+
+    def fetch_data(self, data_request: DataRequest):
+        result = self.client.retrieve(
+            data_request.dataset_name,
+            self._parameters(data_request)
+        )
+        return result
+
+    def download(self, data_request: DataRequest, target: Optional[str] = None) -> str:
+        """Скачивает результат запроса и возвращает путь к файлу.
+
+        С кэшем одинаковые запросы скачиваются один раз; без target путь указывает
+        в кэш (и действителен, пока запись не вытеснят), с target файл выкладывается
+        туда жёсткой ссылкой. Без кэша файл пишется в target.
+        """
+        if self.cache is None:
+            if target is None:
+                raise ValueError("target is required when the fetcher has no download cache")
+            self.fetch_data(data_request).download(target)
+            return target
+
+        parameters = self._parameters(data_request)
+        return self.cache.get_or_download(
+            request_key(data_request.dataset_name, parameters),
+            lambda tmp_path: self.fetch_data(data_request).download(tmp_path),
+            info={'dataset_name': data_request.dataset_name, 'parameters': parameters},
+            target=target,
+        )
+
+    def download_to(self, data_request: DataRequest, target_dir: str) -> str:
+        """Скачивает запрос в target_dir/<ключ запроса>.zip: имя меняется только вместе с содержимым."""
+        key = request_key(data_request.dataset_name, self._parameters(data_request))
+        return self.download(data_request, target=os.path.join(target_dir, f'{key}.zip'))
+
+    def fetch_areas(self, data_request: DataRequest, areas: Sequence[Optional[list]], target_dir: str) -> List[str]:
+        # Один подзапрос на каждую область (None — вся область продукта); возвращает пути
+        # к скачанным архивам вне кэша, так что вытеснение при загрузке следующих областей
+        # не трогает уже скачанные
+        os.makedirs(target_dir, exist_ok=True)
+        zip_files = []
+        for area in areas:
+            area_request = DataRequest(data_request.dataset_name, data_request.parameters,
+                                       area=list(area) if area is not None else None)
+            zip_files.append(self.download_to(area_request, target_dir))
+        return zip_files
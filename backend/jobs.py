@@ -0,0 +1,300 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+import numpy as np
+
+from metrics import cache_lookup
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+JOB_CANCELLED = 'cancelled'
+
+ARTIFACT_EXTENSIONS = {
+    'heatmaps': 'png',
+    'animation': 'gif',
+    'animation_mp4': 'mp4',
+    'batch_scores': 'parquet',
+}
+
+
+class JobStore:
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    params TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    artifact TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return _job(row) if row is not None else None
+
+    def claim(self, job_id: str, kind: str, params: Dict[str, Any], artifact: str) -> Tuple[Dict[str, Any], bool]:
+        """Существующая задача с этим id, если её результат ещё пригоден, иначе новая в очереди.
+
+        Поиск и вставка идут в одной транзакции BEGIN IMMEDIATE: из одновременных одинаковых
+        запросов (в том числе из разных процессов) задачу создаёт только один. Возвращает (задача, создана).
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            try:
+                conn.isolation_level = None
+                conn.execute("BEGIN IMMEDIATE")
+                row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+                if row is not None and _reusable(row):
+                    conn.execute("COMMIT")
+                    return _job(row), False
+                conn.execute(
+                    "INSERT OR REPLACE INTO jobs (id, kind, params, status, artifact, error, created_at, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, NULL, ?, ?)",
+                    (job_id, kind, json.dumps(params, sort_keys=True), JOB_QUEUED, artifact, now, now)
+                )
+                row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+                conn.execute("COMMIT")
+                return _job(row), True
+            except BaseException:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
+            finally:
+                conn.close()
+
+    def set_status(self, job_id: str, status: str, error: Optional[str] = None) -> None:
+        with self._lock, self._connect() as conn:
+            conn.execute("UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+                         (status, error, time.time(), job_id))
+
+    def unfinished(self):
+        with self._connect() as conn:
+            rows = conn.execute("SELECT id FROM jobs WHERE status IN (?, ?)", (JOB_QUEUED, JOB_RUNNING)).fetchall()
+        return [row['id'] for row in rows]
+
+
+def _job(row: sqlite3.Row) -> Dict[str, Any]:
+    job = dict(row)
+    job['params'] = json.loads(job['params'])
+    return job
+
+
+def _reusable(row: sqlite3.Row) -> bool:
+    # Задача в работе или готовый артефакт на месте; упавшие и отменённые запускаются заново
+    if row['status'] in (JOB_QUEUED, JOB_RUNNING):
+        return True
+    return row['status'] == JOB_DONE and os.path.exists(row['artifact'])
+
+
+def _data_version(data_files: Sequence[str]) -> list:
+    # Файл, удалённый после публикации данных, даёт версию без размера: задача упадёт
+    # в воркере с понятной ошибкой, а не API на os.stat
+    version = []
+    for path in data_files:
+        try:
+            stat = os.stat(path)
+            version.append([os.path.abspath(path), stat.st_size, stat.st_mtime_ns])
+        except FileNotFoundError:
+            version.append([os.path.abspath(path), None, None])
+    return version
+
+
+def job_id_for(kind: str, params: Dict[str, Any], data_files: Sequence[str], dataset: Optional[str] = None) -> str:
+    # Идентичные задачи над одной и той же версией данных получают один и тот же id
+    key = json.dumps({'kind': kind, 'params': params, 'data': _data_version(data_files), 'dataset': dataset},
+                     sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+
+class JobQueue:
+    def __init__(self, store: JobStore, artifacts_dir: str, max_workers: int = 2):
+        self.store = store
+        self.artifacts_dir = artifacts_dir
+        os.makedirs(artifacts_dir, exist_ok=True)
+        # spawn: the API process runs threads, which fork does not copy safely
+        self.executor = ProcessPoolExecutor(max_workers=max_workers,
+                                            mp_context=multiprocessing.get_context('spawn'))
+
+    def submit(self, kind: str, params: Dict[str, Any], data_files: Sequence[str], spec=None) -> Dict[str, Any]:
+        """spec — catalog.DatasetSpec файлов: воркер приводит данные к тому же виду, что и API."""
+        if kind not in ARTIFACT_EXTENSIONS:
+            raise ValueError(f"Unsupported job kind: {kind}")
+
+        job_id = job_id_for(kind, params, data_files, spec.name if spec is not None else None)
+        artifact = os.path.join(self.artifacts_dir, f"{job_id}.{ARTIFACT_EXTENSIONS[kind]}")
+        job, created = self.store.claim(job_id, kind, params, artifact)
+        cache_lookup('jobs', hit=not created)
+        if not created:
+            return job
+        future = self.executor.submit(run_job, self.store.db_path, job_id, kind, params,
+                                      list(data_files), artifact, spec)
+        future.add_done_callback(lambda f: self._on_done(job_id, f))
+        return job
+
+    def _on_done(self, job_id: str, future) -> None:
+        # Воркер сам обновляет статус; здесь ловим только отмену при остановке и падение процесса пула
+        if future.cancelled():
+            self.store.set_status(job_id, JOB_CANCELLED, error="Cancelled by server shutdown")
+            return
+        error = future.exception()
+        if error is not None:
+            self.store.set_status(job_id, JOB_FAILED, error=str(error))
+
+    def fail_interrupted(self) -> None:
+        for job_id in self.store.unfinished():
+            self.store.set_status(job_id, JOB_FAILED, error="Interrupted by server restart")
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+# Набор данных загружается в воркере один раз и переиспользуется между задачами
+_worker_data = {}
+
+
+def _load_worker_data(data_files: Sequence[str], spec=None):
+    """Блоки данных, как в API: [(обработчики архивов, данные)] — по одному на скачанную область.
+
+    Архивы одной области (начальная загрузка и /ingest) дают одну сетку и сливаются
+    в один блок в порядке data_files, так что более поздние даты замещают ранние.
+    """
+    from core import CopernicusDataHandler, ESGCalculator, compact_dataset
+    from recompute import merge_ingested
+
+    version = _data_version(data_files)
+    missing = [path for path, size, _ in version if size is None]
+    if missing:
+        raise FileNotFoundError(f"Data files are no longer available (the dataset was reloaded): {missing}")
+    key = json.dumps([version, spec.name if spec is not None else None])
+    if key not in _worker_data:
+        _worker_data.clear()
+        who_limits = ESGCalculator(None).who_limits
+        blocks = []
+        for data_file in data_files:
+            data_handler = CopernicusDataHandler(data_file)
+            data_handler.extract_and_load_data()
+            data = data_handler.get_combined_data()
+            if data is None:
+                continue
+            if spec is not None:
+                data = spec.normalize(data)
+            data = compact_dataset(data, who_limits)
+            for i, (handlers, block) in enumerate(blocks):
+                if (np.array_equal(block.latitude.values, data.latitude.values)
+                        and np.array_equal(block.longitude.values, data.longitude.values)):
+                    blocks[i] = (handlers + [data_handler], compact_dataset(merge_ingested(block, data), who_limits))
+                    break
+            else:
+                blocks.append(([data_handler], data))
+        _worker_data[key] = blocks
+    return _worker_data[key]
+
+
+def _block_index(blocks, lat: float, lon: float) -> int:
+    # Блок, сетка которого содержит точку; области блоков не пересекаются (core.covering_areas)
+    for i, (_, data) in enumerate(blocks):
+        lats, lons = data.latitude.values, data.longitude.values
+        if lats.min() <= lat <= lats.max() and lons.min() <= lon <= lons.max():
+            return i
+    raise ValueError(f"Location ({lat}, {lon}) is outside the loaded data areas")
+
+
+def run_job(db_path: str, job_id: str, kind: str, params: Dict[str, Any], data_files: Sequence[str],
+            artifact: str, spec=None) -> None:
+    import matplotlib
+    matplotlib.use('Agg')
+
+    store = JobStore(db_path)
+    store.set_status(job_id, JOB_RUNNING)
+    tmp_artifact = f"{artifact}.tmp.{ARTIFACT_EXTENSIONS[kind]}"
+    try:
+        blocks = _load_worker_data(data_files, spec)
+        _JOB_RUNNERS[kind](blocks, params, tmp_artifact)
+        os.replace(tmp_artifact, artifact)
+    except Exception as e:
+        store.set_status(job_id, JOB_FAILED, error=str(e))
+        if os.path.exists(tmp_artifact):
+            os.remove(tmp_artifact)
+        return
+    store.set_status(job_id, JOB_DONE)
+
+
+def _run_heatmaps(blocks, params, output_file):
+    from core import AtmosphericLayerPollutantConverter, Location
+    from visualization import ESGVisualizer
+
+    location = Location(latitude=params['latitude'], longitude=params['longitude'])
+    _, data = blocks[_block_index(blocks, location.latitude, location.longitude)]
+    visualizer = ESGVisualizer(pollutant_converter=AtmosphericLayerPollutantConverter(), company_location=location)
+    visualizer.plot_heatmaps(data, output_file=output_file, resolution=params.get('resolution'))
+
+
+def _run_animation(blocks, params, output_file):
+    import glob
+    from visualization import DataVisualizer
+
+    # Кадры читаются из NetCDF блока с точкой; без точки — из единственного блока
+    if 'latitude' in params and 'longitude' in params:
+        handlers, _ = blocks[_block_index(blocks, params['latitude'], params['longitude'])]
+    elif len(blocks) == 1:
+        handlers = blocks[0][0]
+    else:
+        raise ValueError("Animations over several data areas require latitude and longitude")
+    nc_files = sorted(f for handler in handlers for f in glob.glob(os.path.join(handler.temp_dir, '*.nc')))
+    if not nc_files:
+        raise ValueError("No NetCDF files available for animation")
+    options = {name: params[name] for name in ('pollutant', 'latitude', 'longitude', 'delta', 'level', 'fps',
+                                                'start', 'stop') if name in params}
+    DataVisualizer().visualize(nc_files, output_file=output_file, **options)
+
+
+def _run_batch_scores(blocks, params, output_file):
+    from export import concat_scores, scores_table, serialize_table
+    from core import AtmosphericLayerPollutantConverter, ESGCalculator
+
+    calculator = ESGCalculator(AtmosphericLayerPollutantConverter(), params.get('index_pollutants'))
+    # Один векторный расчёт на блок; строки собираются обратно в порядке точек (site_id)
+    groups = {}
+    for i, (lat, lon) in enumerate(zip(params['latitudes'], params['longitudes'])):
+        groups.setdefault(_block_index(blocks, lat, lon), []).append(i)
+    tables = []
+    for block, indices in groups.items():
+        data = blocks[block][1]
+        batch = calculator.calculate_indicators_batch(data, [params['latitudes'][i] for i in indices],
+                                                      [params['longitudes'][i] for i in indices])
+        tables.append(scores_table(batch, site_ids=indices))
+    with open(output_file, 'wb') as f:
+        f.write(serialize_table(concat_scores(tables), 'parquet'))
+
+
+_JOB_RUNNERS = {
+    'heatmaps': _run_heatmaps,
+    'animation': _run_animation,
+    'animation_mp4': _run_animation,
+    'batch_scores': _run_batch_scores,
+}
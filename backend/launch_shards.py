@@ -0,0 +1,69 @@
+"""
+Runs a sharded deployment on one machine: rows x cols api.py shards over the given
+bounds plus router.py in front of them, each in its own uvicorn process.
+
+    python launch_shards.py --bounds 30 72 -25 45 --rows 2 --cols 2 --port 8000
+
+Shard i listens on port + 1 + i; the router on port. Ctrl-C stops everything.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from sharding import ShardBounds, split_bounds
+
+
+def shard_env(bounds: ShardBounds, index: int, halo: float, jobs_dir: str) -> dict:
+    env = dict(os.environ)
+    env["SHARD_BOUNDS"] = ",".join(str(value) for value in bounds)
+    env["SHARD_HALO"] = str(halo)
+    env["JOBS_DIR"] = os.path.join(jobs_dir, f"shard_{index}")
+    return env
+
+
+def uvicorn(module: str, host: str, port: int, env: dict) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, "-m", "uvicorn", f"{module}:app", "--host", host, "--port", str(port)],
+                            env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bounds", nargs=4, type=float, metavar=("SOUTH", "NORTH", "WEST", "EAST"),
+                        default=[30.0, 72.0, -25.0, 45.0])
+    parser.add_argument("--rows", type=int, default=2)
+    parser.add_argument("--cols", type=int, default=2)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--halo", type=float, default=1.0, help="degrees loaded around each tile")
+    parser.add_argument("--jobs-dir", default="job_data")
+    args = parser.parse_args()
+
+    tiles = split_bounds(ShardBounds(*args.bounds), args.rows, args.cols)
+    shards = [{"url": f"http://{args.host}:{args.port + 1 + i}", "bounds": list(bounds)}
+              for i, bounds in enumerate(tiles)]
+    processes = [uvicorn("api", args.host, args.port + 1 + i, shard_env(bounds, i, args.halo, args.jobs_dir))
+                 for i, bounds in enumerate(tiles)]
+    router_env = dict(os.environ, SHARDS=json.dumps(shards), SHARD_HALO=str(args.halo))
+    processes.append(uvicorn("router", args.host, args.port, router_env))
+    for shard in shards:
+        print(f"shard {shard['url']} {shard['bounds']}")
+    print(f"router http://{args.host}:{args.port}")
+
+    try:
+        while all(process.poll() is None for process in processes):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+import bisect
+import contextvars
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+
+# Границы корзин гистограмм длительностей, в секундах
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Тайминги этапов текущего запроса для заголовка Server-Timing; None — запрос их не собирает
+_request_timings: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar(
+    'request_timings', default=None)
+
+
+class _Histogram:
+    __slots__ = ('counts', 'count', 'sum')
+
+    def __init__(self, n_buckets: int):
+        self.counts = [0] * (n_buckets + 1)
+        self.count = 0
+        self.sum = 0.0
+
+
+class MetricsRegistry:
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, tuple], float] = {}
+        self._gauges: Dict[Tuple[str, tuple], float] = {}
+        self._histograms: Dict[Tuple[str, tuple], _Histogram] = {}
+        self._help: Dict[str, Tuple[str, str]] = {}
+
+    def describe(self, name: str, kind: str, text: str) -> None:
+        self._help[name] = (kind, text)
+
+    def inc(self, name: str, value: float = 1.0, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + value
+
+    def set_gauge(self, name: str, value: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram(len(self.buckets))
+            histogram.counts[index] += 1
+            histogram.count += 1
+            histogram.sum += value
+
+    def render(self) -> str:
+        """Текст в формате Prometheus exposition 0.0.4."""
+        _update_process_gauges(self)
+        lines = []
+        with self._lock:
+            families: Dict[str, list] = {}
+            for (name, labels), value in self._counters.items():
+                families.setdefault(name, []).append(f"{name}{_labels(labels)} {value}")
+            for (name, labels), value in self._gauges.items():
+                families.setdefault(name, []).append(f"{name}{_labels(labels)} {value}")
+            for (name, labels), histogram in self._histograms.items():
+                samples = families.setdefault(name, [])
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), histogram.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    samples.append(f"{name}_bucket{_labels(labels + (('le', le),))} {cumulative}")
+                samples.append(f"{name}_sum{_labels(labels)} {histogram.sum}")
+                samples.append(f"{name}_count{_labels(labels)} {histogram.count}")
+
+        for name in sorted(families):
+            if name in self._help:
+                kind, text = self._help[name]
+                lines.append(f"# HELP {name} {text}")
+                lines.append(f"# TYPE {name} {kind}")
+            lines.extend(families[name])
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+
+def _update_process_gauges(registry: MetricsRegistry) -> None:
+    # Текущий RSS берём из /proc (Linux), пиковый — из getrusage (в КБ на Linux)
+    try:
+        with open('/proc/self/statm') as f:
+            rss_pages = int(f.read().split()[1])
+        registry.set_gauge('process_resident_memory_bytes', rss_pages * os.sysconf('SC_PAGE_SIZE'))
+    except (OSError, ValueError):
+        pass
+    registry.set_gauge('process_peak_resident_memory_bytes', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+
+
+registry = MetricsRegistry()
+registry.describe('esg_stage_seconds', 'histogram', 'Duration of instrumented hot-path stages.')
+registry.describe('esg_http_request_seconds', 'histogram', 'HTTP request duration by endpoint.')
+registry.describe('esg_http_requests_in_flight', 'gauge', 'HTTP requests currently being served.')
+registry.describe('esg_event_loop_lag_seconds', 'histogram', 'Delay of event loop wake-ups over the expected time.')
+registry.describe('esg_data_bytes_loaded_total', 'counter', 'Bytes read from downloaded archives and NetCDF files.')
+registry.describe('esg_dataset_bytes', 'gauge', 'In-memory size of the loaded data blocks.')
+registry.describe('esg_download_bytes_total', 'counter', 'Bytes downloaded from the CDS into the download cache.')
+registry.describe('esg_download_cache_bytes', 'gauge', 'Total size of files in the download cache.')
+registry.describe('esg_download_areas', 'gauge', 'CDS areas downloaded for the portfolio sites, by dataset.')
+registry.describe('esg_portfolio_sites', 'gauge', 'Portfolio sites the downloaded areas cover, by dataset.')
+registry.describe('esg_companies_checked_total', 'counter', 'Company scores evaluated after data changes.')
+registry.describe('esg_companies_rescored_total', 'counter', 'Company scores saved after data changes.')
+registry.describe('esg_score_alerts_total', 'counter', 'Score changes at or above the alert threshold.')
+registry.describe('esg_coalesced_requests_total', 'counter', 'Requests answered by an identical in-flight request.')
+registry.describe('esg_microbatch_batches_total', 'counter', 'Vectorized calls made by the request micro-batchers.')
+registry.describe('esg_microbatch_items_total', 'counter', 'Requests computed through the micro-batchers.')
+registry.describe('esg_cache_requests_total', 'counter', 'Cache lookups by cache and result (hit/miss).')
+registry.describe('process_resident_memory_bytes', 'gauge', 'Resident set size of the process.')
+registry.describe('process_peak_resident_memory_bytes', 'gauge', 'Peak resident set size of the process.')
+
+
+@contextmanager
+def timed(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        registry.observe('esg_stage_seconds', elapsed, stage=stage)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + elapsed
+
+
+def cache_lookup(cache: str, hit: bool) -> None:
+    registry.inc('esg_cache_requests_total', cache=cache, result='hit' if hit else 'miss')
+
+
+def start_request_timings() -> contextvars.Token:
+    return _request_timings.set({})
+
+
+def current_request_timings() -> Optional[Dict[str, float]]:
+    """Стадии текущего запроса (None, если Server-Timing для него не собирается)."""
+    return _request_timings.get()
+
+
+def finish_request_timings(token: contextvars.Token) -> Dict[str, float]:
+    timings = _request_timings.get() or {}
+    _request_timings.reset(token)
+    return timings
+
+
+def server_timing_header(timings: Dict[str, float]) -> str:
+    return ", ".join(f"{stage.replace('.', '_')};dur={elapsed * 1000:.2f}" for stage, elapsed in timings.items())
@@ -0,0 +1,340 @@
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from core import nearest_indices, pollutant_stack, time_window_indices
+
+
+class TemporalPyramid:
+    """Суммы и количества значений по дням, неделям, месяцам и годам для каждой ячейки и загрязнителя.
+
+    Среднее по произвольному окну [start, stop) складывается из самых крупных целых
+    интервалов, помещающихся в окно, и «хвостов» из исходных шагов по краям, так что
+    стоимость запроса зависит от числа уровней, а не от числа шагов времени.
+    Для тренда хранятся префиксные суммы ряда, усреднённого по сетке, — наклон
+    МНК по любому окну считается за O(1).
+    """
+
+    LEVELS = ('D', 'W', 'M', 'Y')
+
+    def __init__(self, data: xr.Dataset, pollutants: Sequence[str]):
+        self.pollutants = [p for p in pollutants if p in data]
+        self.time = data.time.values
+        self.latitude = data.latitude.values
+        self.longitude = data.longitude.values
+        self.stack = pollutant_stack(data, self.pollutants)  # (pollutant, time, latitude, longitude)
+        self.has_nan = bool(np.isnan(self.stack).any())
+
+        periods = pd.DatetimeIndex(self.time)
+        self.levels = []  # от крупных к мелким: (starts, stops, sums, counts)
+        for freq in reversed(self.LEVELS):
+            codes = periods.to_period(freq).asi8
+            starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+            stops = np.r_[starts[1:], len(codes)]
+            if len(starts) == len(codes):
+                continue  # уровень не крупнее исходных шагов
+            sums, counts = self._reduce_bins(starts)
+            self.levels.append((starts, stops, sums, counts))
+
+        # Ряд, усреднённый по сетке, и его префиксные суммы для тренда
+        with np.errstate(invalid='ignore'):
+            series = np.nanmean(self.stack, axis=(2, 3), dtype=np.float64)  # (pollutant, time)
+        t = np.arange(len(self.time), dtype=np.float64)
+        valid = ~np.isnan(series)
+        series = np.where(valid, series, 0.0)
+        zero = np.zeros((len(self.pollutants), 1))
+        self._cum_n = np.concatenate([zero, np.cumsum(valid, axis=1)], axis=1)
+        self._cum_t = np.concatenate([zero, np.cumsum(valid * t, axis=1)], axis=1)
+        self._cum_tt = np.concatenate([zero, np.cumsum(valid * t * t, axis=1)], axis=1)
+        self._cum_y = np.concatenate([zero, np.cumsum(series, axis=1)], axis=1)
+        self._cum_ty = np.concatenate([zero, np.cumsum(series * t, axis=1)], axis=1)
+
+    def _reduce_bins(self, starts: np.ndarray) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        sums = np.empty((len(self.pollutants), len(starts)) + self.stack.shape[2:], dtype=np.float64)
+        counts = np.empty(sums.shape, dtype=np.int32) if self.has_nan else None
+        for i in range(len(self.pollutants)):
+            values = self.stack[i]
+            if self.has_nan:
+                valid = ~np.isnan(values)
+                values = np.where(valid, values, 0)
+                counts[i] = np.add.reduceat(valid, starts, axis=0)
+            sums[i] = np.add.reduceat(values, starts, axis=0, dtype=np.float64)
+        return sums, counts
+
+    def window_indices(self, start=None, stop=None) -> Tuple[int, int]:
+        return time_window_indices(self.time, start, stop)
+
+    def decompose(self, a: int, b: int) -> List[Tuple[int, int, int]]:
+        """Разбивает [a, b) на куски (уровень, начало, конец); уровень -1 — исходные шаги."""
+        pieces = []
+        pos = a
+        while pos < b:
+            for level, (starts, stops, _, _) in enumerate(self.levels):
+                i = np.searchsorted(starts, pos)
+                if i < len(starts) and starts[i] == pos and stops[i] <= b:
+                    pieces.append((level, i, i + 1))
+                    pos = stops[i]
+                    break
+            else:
+                # Ни один интервал не начинается здесь: идём исходными шагами до начала ближайшего
+                next_pos = b
+                for starts, stops, _, _ in self.levels:
+                    i = np.searchsorted(starts, pos, side='right')
+                    if i < len(starts) and stops[i] <= b:
+                        next_pos = min(next_pos, starts[i])
+                if pieces and pieces[-1][0] == -1 and pieces[-1][2] == pos:
+                    pieces[-1] = (-1, pieces[-1][1], next_pos)
+                else:
+                    pieces.append((-1, pos, next_pos))
+                pos = next_pos
+        return pieces
+
+    def window_mean(self, lat_idx: int, lon_idx: int, start=None, stop=None) -> np.ndarray:
+        """Средние концентрации в ячейке за окно, по одному значению на загрязнитель."""
+        return self.window_means(np.array([lat_idx]), np.array([lon_idx]), start, stop)[:, 0]
+
+    def window_means(self, lat_idx: np.ndarray, lon_idx: np.ndarray, start=None, stop=None) -> np.ndarray:
+        """window_mean для набора ячеек за одно окно: (pollutant, ячейка)."""
+        a, b = self.window_indices(start, stop)
+        total = np.zeros((len(self.pollutants), len(lat_idx)))
+        count = np.zeros((len(self.pollutants), len(lat_idx)))
+        for level, i, j in self.decompose(a, b):
+            if level == -1:
+                values = self.stack[:, i:j, lat_idx, lon_idx]
+                total += np.nansum(values, axis=1)
+                count += np.sum(~np.isnan(values), axis=1)
+            else:
+                starts, stops, sums, counts = self.levels[level]
+                total += sums[:, i:j, lat_idx, lon_idx].sum(axis=1)
+                if counts is None:
+                    count += stops[j - 1] - starts[i]
+                else:
+                    count += counts[:, i:j, lat_idx, lon_idx].sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return total / count
+
+    def windows(self, freq: Optional[str] = None, window: Optional[str] = None, step: Optional[str] = None,
+                start=None, stop=None) -> Tuple[np.ndarray, np.ndarray]:
+        """Границы окон [starts[i], stops[i]) в индексах времени внутри [start, stop).
+
+        freq — календарные периоды ('D', 'W', 'M', 'Y'); window и step (например '30D' и '7D') —
+        скользящие окна фиксированной длины. Пустые окна отбрасываются.
+        """
+        a, b = self.window_indices(start, stop)
+        time = pd.DatetimeIndex(self.time[a:b])
+        if len(time) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        if freq is not None:
+            codes = time.to_period(freq).asi8
+            starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+            stops = np.r_[starts[1:], len(codes)]
+        else:
+            window = pd.Timedelta(window)
+            step = pd.Timedelta(step or window)
+            origins = pd.date_range(time[0], time[-1], freq=step)
+            # Неполные окна в конце периода не показываем (кроме случая, когда окно длиннее всего периода)
+            resolution = time[1] - time[0] if len(time) > 1 else pd.Timedelta(0)
+            complete = origins + window <= time[-1] + resolution
+            origins = origins[complete] if complete.any() else origins[:1]
+            starts = time.searchsorted(origins, side='left')
+            stops = time.searchsorted(origins + window, side='left')
+        keep = stops > starts
+        return starts[keep] + a, stops[keep] + a
+
+    def series_window_means(self, lat_idx: np.ndarray, lon_idx: np.ndarray, starts: np.ndarray,
+                            stops: np.ndarray) -> np.ndarray:
+        """Средние по всем окнам для набора ячеек: (pollutant, окно, ячейка) за O(T) через префиксные суммы."""
+        series = self.stack[:, :, lat_idx, lon_idx].astype(np.float64)  # (pollutant, time, site)
+        valid = ~np.isnan(series)
+        zero = np.zeros((series.shape[0], 1, series.shape[2]))
+        sums = np.concatenate([zero, np.cumsum(np.where(valid, series, 0.0), axis=1)], axis=1)
+        counts = np.concatenate([zero, np.cumsum(valid, axis=1)], axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (sums[:, stops] - sums[:, starts]) / (counts[:, stops] - counts[:, starts])
+
+    def window_trends(self, starts: np.ndarray, stops: np.ndarray) -> np.ndarray:
+        """window_trend сразу для массива окон: (pollutant, окно)."""
+        n = self._cum_n[:, stops] - self._cum_n[:, starts]
+        st = self._cum_t[:, stops] - self._cum_t[:, starts]
+        stt = self._cum_tt[:, stops] - self._cum_tt[:, starts]
+        sy = self._cum_y[:, stops] - self._cum_y[:, starts]
+        sty = self._cum_ty[:, stops] - self._cum_ty[:, starts]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (n * sty - st * sy) / (n * stt - st * st)
+
+    def window_trend(self, start=None, stop=None) -> np.ndarray:
+        """Наклон линейного тренда ряда, усреднённого по сетке, за окно (на шаг времени)."""
+        a, b = self.window_indices(start, stop)
+        n = self._cum_n[:, b] - self._cum_n[:, a]
+        st = self._cum_t[:, b] - self._cum_t[:, a]
+        stt = self._cum_tt[:, b] - self._cum_tt[:, a]
+        sy = self._cum_y[:, b] - self._cum_y[:, a]
+        sty = self._cum_ty[:, b] - self._cum_ty[:, a]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (n * sty - st * sy) / (n * stt - st * st)
+
+
+class SpatialPyramid:
+    """Поля средних по времени концентраций с огрублением сетки в 2, 4 и 8 раз.
+
+    Для каждого уровня хранятся суммы по блокам и число непустых ячеек в блоке, так
+    что среднее по региону на любом уровне — сумма сумм, делённая на сумму количеств.
+    Строится один раз на версию набора данных (см. for_dataset).
+    """
+
+    FACTORS = (1, 2, 4, 8)
+    _cache = {}
+    _CACHE_SIZE = 4
+
+    def __init__(self, data: xr.Dataset, pollutants: Sequence[str]):
+        self.pollutants = [p for p in pollutants if p in data]
+        stack = pollutant_stack(data, self.pollutants)
+        latitude = data.latitude.values.astype(np.float64)
+        longitude = data.longitude.values.astype(np.float64)
+        self.resolution = float(min(np.abs(np.diff(latitude)).min(initial=np.inf),
+                                    np.abs(np.diff(longitude)).min(initial=np.inf)))
+
+        with np.errstate(invalid='ignore'):
+            field = np.nanmean(stack, axis=1, dtype=np.float64)  # (pollutant, latitude, longitude)
+        valid = ~np.isnan(field)
+        sums = np.where(valid, field, 0.0)
+        counts = valid.astype(np.int32)
+        lat_sum, lat_count = np.nan_to_num(latitude), np.ones(len(latitude))
+        lon_sum, lon_count = np.nan_to_num(longitude), np.ones(len(longitude))
+
+        # Уровень: (множитель, суммы, количества, широты центров, долготы центров)
+        self.levels = []
+        factor = 1
+        for target in self.FACTORS:
+            while factor < target:
+                sums, counts = _coarsen2(sums), _coarsen2(counts)
+                lat_sum, lat_count = _coarsen1(lat_sum), _coarsen1(lat_count)
+                lon_sum, lon_count = _coarsen1(lon_sum), _coarsen1(lon_count)
+                factor *= 2
+            self.levels.append((factor, sums, counts, lat_sum / lat_count, lon_sum / lon_count))
+        self._integrals: Dict[int, Tuple[np.ndarray, np.ndarray]] = {}
+
+    @classmethod
+    def for_dataset(cls, data: xr.Dataset, pollutants: Sequence[str]) -> 'SpatialPyramid':
+        # Версию выставляет compact_dataset; для прочих наборов пирамида строится заново
+        version = data.attrs.get('dataset_version')
+        key = (version, tuple(pollutants))
+        if version is None:
+            return cls(data, pollutants)
+        if key not in cls._cache:
+            if len(cls._cache) >= cls._CACHE_SIZE:
+                cls._cache.pop(next(iter(cls._cache)))
+            cls._cache[key] = cls(data, pollutants)
+        return cls._cache[key]
+
+    def level_for(self, resolution: Optional[float]) -> int:
+        """Самый грубый уровень, размер ячейки которого не превышает resolution (в градусах)."""
+        if resolution is None:
+            return 0
+        best = 0
+        for i, (factor, *_rest) in enumerate(self.levels):
+            if factor * self.resolution <= resolution:
+                best = i
+        return best
+
+    def point_mean(self, lat: float, lon: float) -> np.ndarray:
+        _, sums, counts, latitude, longitude = self.levels[0]
+        i = int(np.abs(latitude - lat).argmin())
+        j = int(np.abs(longitude - lon).argmin())
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return sums[:, i, j] / counts[:, i, j]
+
+    def point_means(self, lats: Sequence[float], lons: Sequence[float]) -> np.ndarray:
+        """point_mean для набора точек: (pollutant, точка)."""
+        _, sums, counts, latitude, longitude = self.levels[0]
+        i = nearest_indices(latitude, lats)
+        j = nearest_indices(longitude, lons)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return sums[:, i, j] / counts[:, i, j]
+
+    def region_sums(self, lat_min: float, lat_max: float, lon_min: float, lon_max: float,
+                    resolution: Optional[float] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Суммы и количества по региону для каждого загрязнителя; суммы по разным регионам
+        (например, по шардам сетки) складываются, а среднее — их отношение."""
+        _, sums, counts, latitude, longitude = self.levels[self.level_for(resolution)]
+        rows = np.flatnonzero((latitude >= lat_min) & (latitude <= lat_max))
+        cols = np.flatnonzero((longitude >= lon_min) & (longitude <= lon_max))
+        if len(rows) == 0 or len(cols) == 0:
+            return np.zeros(len(self.pollutants)), np.zeros(len(self.pollutants), dtype=np.int64)
+        block = np.ix_(np.arange(len(self.pollutants)), rows, cols)
+        return sums[block].sum(axis=(1, 2)), counts[block].sum(axis=(1, 2), dtype=np.int64)
+
+    def region_mean(self, lat_min: float, lat_max: float, lon_min: float, lon_max: float,
+                    resolution: Optional[float] = None) -> np.ndarray:
+        sums, counts = self.region_sums(lat_min, lat_max, lon_min, lon_max, resolution)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return sums / counts
+
+    def region_means(self, lat_min: np.ndarray, lat_max: np.ndarray, lon_min: np.ndarray, lon_max: np.ndarray,
+                     resolution: Optional[float] = None) -> np.ndarray:
+        """region_mean для набора регионов: (pollutant, регион).
+
+        Регионы — непрерывные диапазоны строк и столбцов монотонной сетки, поэтому
+        сумма по каждому — четыре обращения к таблице накопленных сумм уровня.
+        """
+        level = self.level_for(resolution)
+        _, sums, counts, latitude, longitude = self.levels[level]
+        rows = _axis_ranges(latitude, lat_min, lat_max)
+        cols = _axis_ranges(longitude, lon_min, lon_max)
+        if rows is None or cols is None:
+            # Немонотонная ось: по одному региону
+            parts = [self.region_sums(*box, resolution) for box in zip(lat_min, lat_max, lon_min, lon_max)]
+            total = np.stack([p[0] for p in parts], axis=1)
+            count = np.stack([p[1] for p in parts], axis=1)
+        else:
+            sum_table, count_table = self._integral(level)
+            (r0, r1), (c0, c1) = rows, cols
+            total = sum_table[:, r1, c1] - sum_table[:, r0, c1] - sum_table[:, r1, c0] + sum_table[:, r0, c0]
+            count = count_table[:, r1, c1] - count_table[:, r0, c1] - count_table[:, r1, c0] + count_table[:, r0, c0]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return total / count
+
+    def _integral(self, level: int) -> Tuple[np.ndarray, np.ndarray]:
+        # Накопленные суммы по обеим осям с нулевой первой строкой и столбцом; строятся при первом запросе
+        if level not in self._integrals:
+            _, sums, counts, _, _ = self.levels[level]
+            pad = ((0, 0), (1, 0), (1, 0))
+            self._integrals[level] = (np.pad(sums.cumsum(axis=1).cumsum(axis=2), pad),
+                                      np.pad(counts.cumsum(axis=1, dtype=np.int64).cumsum(axis=2), pad))
+        return self._integrals[level]
+
+    def field(self, pollutant: str, resolution: Optional[float] = None) -> xr.DataArray:
+        _, sums, counts, latitude, longitude = self.levels[self.level_for(resolution)]
+        i = self.pollutants.index(pollutant)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            values = sums[i] / counts[i]
+        return xr.DataArray(values, dims=('latitude', 'longitude'),
+                            coords={'latitude': latitude, 'longitude': longitude}, name=pollutant)
+
+
+def _axis_ranges(axis: np.ndarray, lo: np.ndarray, hi: np.ndarray) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    # Диапазоны [a, b) узлов монотонной оси с lo <= axis <= hi; None, если ось не монотонна
+    lo, hi = np.asarray(lo, dtype=np.float64), np.asarray(hi, dtype=np.float64)
+    step = np.diff(axis)
+    if np.all(step > 0):
+        a, b = np.searchsorted(axis, lo, side='left'), np.searchsorted(axis, hi, side='right')
+    elif np.all(step < 0):
+        a, b = np.searchsorted(-axis, -hi, side='left'), np.searchsorted(-axis, -lo, side='right')
+    else:
+        return None
+    return a, np.maximum(a, b)
+
+
+def _coarsen1(values: np.ndarray) -> np.ndarray:
+    if len(values) % 2:
+        values = np.r_[values, 0]
+    return values[0::2] + values[1::2]
+
+
+def _coarsen2(values: np.ndarray) -> np.ndarray:
+    # Суммы блоков 2x2 по двум последним осям; нечётный край дополняется нулями
+    pad = [(0, 0)] * (values.ndim - 2) + [(0, values.shape[-2] % 2), (0, values.shape[-1] % 2)]
+    values = np.pad(values, pad)
+    return values[..., 0::2, 0::2] + values[..., 1::2, 0::2] + values[..., 0::2, 1::2] + values[..., 1::2, 1::2]
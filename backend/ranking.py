@@ -0,0 +1,114 @@
+import bisect
+import itertools
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+PEER_DIMENSIONS = ('industry', 'size', 'country')
+
+# Значение измерения, которое объединяет все группы по нему (например, вся отрасль без учёта размера)
+ANY = '*'
+
+
+class _SortedGroup:
+    __slots__ = ('scores', 'entries')
+
+    def __init__(self):
+        self.scores: List[float] = []  # по возрастанию, для bisect по значению
+        self.entries: List[Tuple[float, str]] = []  # (score, company_id) в том же порядке
+
+    def add(self, company_id: str, score: float) -> None:
+        i = bisect.bisect_left(self.entries, (score, company_id))
+        self.entries.insert(i, (score, company_id))
+        self.scores.insert(i, score)
+
+    def remove(self, company_id: str, score: float) -> None:
+        i = bisect.bisect_left(self.entries, (score, company_id))
+        del self.entries[i]
+        del self.scores[i]
+
+
+class PeerRanking:
+    """Отсортированные индексы оценок по группам отрасль × размер × страна.
+
+    Каждая компания входит в 2^3 группы (меньше, если часть измерений не задана):
+    свою и все её обобщения с ANY вместо части измерений, поэтому сравнение «со всей отраслью» или «со всеми
+    компаниями страны» не требует пересортировки. Обновление оценки — двоичный
+    поиск и вставка в каждый из этих списков; перцентиль и ранг — bisect, топ-k —
+    срез с конца списка.
+    """
+
+    def __init__(self):
+        self._groups: Dict[tuple, _SortedGroup] = {}
+        self._companies: Dict[str, Tuple[tuple, float]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _rollups(key: tuple) -> set:
+        # Измерения, уже равные ANY, дают одинаковые обобщения — каждая группа учитывается один раз
+        return {tuple(ANY if wildcard else value for value, wildcard in zip(key, mask))
+                for mask in itertools.product((False, True), repeat=len(key))}
+
+    @staticmethod
+    def group_key(industry: str = ANY, size: str = ANY, country: str = ANY) -> tuple:
+        return industry, size, country
+
+    def update(self, company_id: str, score: float, industry: str, size: str, country: str) -> None:
+        key = self.group_key(industry, size, country)
+        with self._lock:
+            self._remove(company_id)
+            for group_key in self._rollups(key):
+                self._groups.setdefault(group_key, _SortedGroup()).add(company_id, score)
+            self._companies[company_id] = (key, score)
+
+    def update_many(self, records: Sequence[dict]) -> None:
+        for record in records:
+            self.update(record['company_id'], record['score'],
+                        *(record.get(dimension) or ANY for dimension in PEER_DIMENSIONS))
+
+    def remove(self, company_id: str) -> None:
+        with self._lock:
+            self._remove(company_id)
+
+    def _remove(self, company_id: str) -> None:
+        previous = self._companies.pop(company_id, None)
+        if previous is None:
+            return
+        key, score = previous
+        for group_key in self._rollups(key):
+            group = self._groups[group_key]
+            group.remove(company_id, score)
+            if not group.entries:
+                del self._groups[group_key]
+
+    def peer_key(self, company_id: str, by: Sequence[str] = PEER_DIMENSIONS) -> tuple:
+        key, _ = self._companies[company_id]
+        return tuple(value if dimension in by else ANY for dimension, value in zip(PEER_DIMENSIONS, key))
+
+    def percentile(self, company_id: str, by: Sequence[str] = PEER_DIMENSIONS) -> Optional[dict]:
+        """Место компании среди пиров; percentile — доля пиров ниже плюс половина равных, в процентах."""
+        with self._lock:
+            if company_id not in self._companies:
+                return None
+            _, score = self._companies[company_id]
+            group_key = self.peer_key(company_id, by)
+            scores = self._groups[group_key].scores
+            below = bisect.bisect_left(scores, score)
+            equal = bisect.bisect_right(scores, score) - below
+            n = len(scores)
+        return {
+            'company_id': company_id,
+            'score': score,
+            'group': dict(zip(PEER_DIMENSIONS, group_key)),
+            'peers': n,
+            'rank': n - below - equal + 1,  # 1 — лучшая оценка в группе
+            'percentile': 100.0 * (below + 0.5 * equal) / n,
+        }
+
+    def top(self, k: int = 10, industry: str = ANY, size: str = ANY, country: str = ANY) -> List[dict]:
+        with self._lock:
+            group = self._groups.get(self.group_key(industry, size, country))
+            entries = group.entries[-k:][::-1] if group is not None and k > 0 else []
+        return [{'company_id': company_id, 'score': score} for score, company_id in entries]
+
+    def __len__(self) -> int:
+        return len(self._companies)
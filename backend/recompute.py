@@ -0,0 +1,319 @@
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from core import ESGCalculator, nearest_indices, pollutant_stack
+from metrics import registry, timed
+
+# Изменение pollution_index, начиная с которого запись в журнале помечается как alert
+ALERT_THRESHOLD = 0.05
+# Изменение pollution_index, меньше которого пересчёт после загрузки не сохраняется, если не
+# поменялась и интерпретация: новые дни сдвигают средние за период на доли процента, и без
+# допуска каждая ежедневная загрузка переписывала бы оценки всего портфеля
+SCORE_TOLERANCE = 0.01
+BATCH_SIZE = 5000
+
+
+class ChangeSet(NamedTuple):
+    """Что затронула загрузка: маска ячеек (latitude, longitude) и диапазон времени [start, stop]."""
+
+    cells: np.ndarray
+    start: Optional[np.datetime64]
+    stop: Optional[np.datetime64]
+
+    @property
+    def n_cells(self) -> int:
+        return int(self.cells.sum())
+
+
+def merge_ingested(current: xr.Dataset, ingested: xr.Dataset) -> xr.Dataset:
+    """Новые данные поверх текущих: совпадающие шаги времени заменяются, новые добавляются."""
+    merged = ingested.combine_first(current).sortby('time')
+    # combine_first сортирует координаты по возрастанию; порядок сетки (широта по убыванию в CAMS) сохраняем
+    for dim in ('latitude', 'longitude'):
+        if len(merged[dim]) == len(current[dim]) and np.isin(merged[dim].values, current[dim].values).all():
+            merged = merged.reindex({dim: current[dim].values})
+    return merged
+
+
+def detect_changes(current: xr.Dataset, merged: xr.Dataset, pollutants: Sequence[str]) -> ChangeSet:
+    """Ячейки и диапазон времени, в которых merged отличается от current.
+
+    Если сетка изменилась, затронутыми считаются все ячейки.
+    """
+    shape = (merged.sizes['latitude'], merged.sizes['longitude'])
+    same_grid = (np.array_equal(current.latitude.values, merged.latitude.values)
+                 and np.array_equal(current.longitude.values, merged.longitude.values))
+    pollutants = [p for p in pollutants if p in merged]
+    if not same_grid or any(p not in current for p in pollutants):
+        return ChangeSet(np.ones(shape, dtype=bool), merged.time.values[0], merged.time.values[-1])
+
+    # Шаги, которых не было, и шаги, значения в которых поменялись
+    old = pollutant_stack(current.reindex(time=merged.time), pollutants)  # (pollutant, time, lat, lon)
+    new = pollutant_stack(merged, pollutants)
+    differs = ~((old == new) | (np.isnan(old) & np.isnan(new)))
+    cells = differs.any(axis=(0, 1))
+    steps = np.flatnonzero(differs.any(axis=(0, 2, 3)))
+    if len(steps) == 0:
+        return ChangeSet(cells, None, None)
+    return ChangeSet(cells, merged.time.values[steps[0]], merged.time.values[steps[-1]])
+
+
+class ScoreStore:
+    """Последние оценки компаний и журнал их изменений (sqlite, как JobStore)."""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS company_scores (
+                    company_id TEXT PRIMARY KEY,
+                    latitude REAL NOT NULL,
+                    longitude REAL NOT NULL,
+                    pollution_index REAL,
+                    result TEXT NOT NULL,
+                    updated_seq INTEGER NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS score_changes (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    company_id TEXT NOT NULL,
+                    previous REAL,
+                    current REAL,
+                    delta REAL,
+                    alert INTEGER NOT NULL,
+                    created_at REAL NOT NULL
+                )
+                """
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def latest(self, company_ids: Sequence[str]) -> Dict[str, Dict[str, Any]]:
+        """Сохранённые pollution_index и интерпретация компаний (только уже оценённых)."""
+        result = {}
+        with self._connect() as conn:
+            for start in range(0, len(company_ids), 500):
+                chunk = list(company_ids[start:start + 500])
+                rows = conn.execute(
+                    f"SELECT company_id, pollution_index, result FROM company_scores "
+                    f"WHERE company_id IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+                result.update((row['company_id'], {'pollution_index': row['pollution_index'],
+                                                   'interpretation': json.loads(row['result']).get('interpretation')})
+                              for row in rows)
+        return result
+
+    def save(self, records: List[Dict[str, Any]], alert_threshold: float) -> int:
+        """Сохраняет оценки и журнал изменений одной транзакцией; возвращает последний seq."""
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM score_changes").fetchone()[0]
+            for record in records:
+                previous, current = record['previous'], record['pollution_index']
+                delta = current - previous if previous is not None and current is not None else None
+                cursor = conn.execute(
+                    "INSERT INTO score_changes (company_id, previous, current, delta, alert, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (record['company_id'], previous, current, delta,
+                     int(delta is not None and abs(delta) >= alert_threshold), now)
+                )
+                seq = cursor.lastrowid
+                conn.execute(
+                    "INSERT OR REPLACE INTO company_scores "
+                    "(company_id, latitude, longitude, pollution_index, result, updated_seq, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (record['company_id'], record['latitude'], record['longitude'], current,
+                     json.dumps(record['result']), seq, now)
+                )
+        return seq
+
+    def scores(self, since: int = 0) -> List[Dict[str, Any]]:
+        with self._connect() as conn:
+            rows = conn.execute("SELECT * FROM company_scores WHERE updated_seq > ? ORDER BY updated_seq",
+                                (since,)).fetchall()
+        return [dict(row, result=json.loads(row['result'])) for row in rows]
+
+    def changes(self, since: int = 0, limit: int = 1000, alerts_only: bool = False) -> List[Dict[str, Any]]:
+        query = "SELECT * FROM score_changes WHERE seq > ?" + (" AND alert = 1" if alerts_only else "")
+        with self._connect() as conn:
+            rows = conn.execute(query + " ORDER BY seq LIMIT ?", (since, limit)).fetchall()
+        return [dict(row, alert=bool(row['alert'])) for row in rows]
+
+    def last_seq(self) -> int:
+        with self._connect() as conn:
+            return conn.execute("SELECT COALESCE(MAX(seq), 0) FROM score_changes").fetchone()[0]
+
+
+class RecomputeScheduler:
+    """Пересчёт оценок только тех компаний, чьи ячейки затронула загрузка.
+
+    Данные приходят блоками (catalog.DatasetView, по блоку на скачанную область);
+    компания считается в блоке, внутри области которого лежит, и привязана к ближайшей
+    ячейке его сетки (как в calculate_indicator). Индекс ячейка → компании строится
+    один раз на сетку блока. Затронутые компании считаются пачками через
+    calculate_indicators_batch, результаты и изменения pollution_index пишутся
+    в ScoreStore, откуда их забирают дашборд и алерты.
+
+    После загрузки (заданы changes) затронутые ячейками компании только проверяются:
+    сохраняются те, у кого pollution_index сдвинулся не меньше чем на tolerance или
+    поменялась интерпретация (уровень воздействия, знаки трендов). Расчёт идёт по
+    TemporalPyramid блока, так что проверка всего портфеля не проходит по шагам времени.
+    """
+
+    def __init__(self, calculator: ESGCalculator, store: ScoreStore, batch_size: int = BATCH_SIZE,
+                 alert_threshold: float = ALERT_THRESHOLD, tolerance: float = SCORE_TOLERANCE):
+        self.calculator = calculator
+        self.store = store
+        self.batch_size = batch_size
+        self.alert_threshold = alert_threshold
+        self.tolerance = tolerance
+        self.company_ids: List[str] = []
+        self.latitudes = np.zeros(0)
+        self.longitudes = np.zeros(0)
+        # (область, сетка) блока -> (индексы компаний в области, плоские индексы их ячеек)
+        self._cells: Dict[tuple, Tuple[np.ndarray, np.ndarray]] = {}
+        self._lock = threading.Lock()
+
+    def set_companies(self, companies: Sequence[Dict[str, Any]]) -> List[str]:
+        """Добавляет или перемещает компании {"company_id", "latitude", "longitude"}; возвращает новые и перемещённые."""
+        with self._lock:
+            positions = {cid: (lat, lon) for cid, lat, lon in zip(self.company_ids, self.latitudes, self.longitudes)}
+            changed = [c['company_id'] for c in companies
+                       if positions.get(c['company_id']) != (c['latitude'], c['longitude'])]
+            positions.update((c['company_id'], (c['latitude'], c['longitude'])) for c in companies)
+            self.company_ids = list(positions)
+            self.latitudes = np.array([positions[cid][0] for cid in self.company_ids], dtype=np.float64)
+            self.longitudes = np.array([positions[cid][1] for cid in self.company_ids], dtype=np.float64)
+            self._cells = {}
+        return changed
+
+    def _block_companies(self, view) -> Tuple[np.ndarray, np.ndarray]:
+        """Индексы компаний внутри области блока и плоские индексы их ближайших ячеек в его сетке."""
+        latitude, longitude = view.data.latitude.values, view.data.longitude.values
+        key = (view.area, latitude.tobytes(), longitude.tobytes())
+        if key not in self._cells:
+            area = view.area
+            if area is None:
+                companies = np.arange(len(self.company_ids))
+            else:
+                companies = np.flatnonzero((self.latitudes >= area.south) & (self.latitudes <= area.north)
+                                           & (self.longitudes >= area.west) & (self.longitudes <= area.east))
+            lat_idx = nearest_indices(latitude, self.latitudes[companies])
+            lon_idx = nearest_indices(longitude, self.longitudes[companies])
+            self._cells[key] = (companies, lat_idx * len(longitude) + lon_idx)
+        return self._cells[key]
+
+    def rescore(self, views: Sequence[Any], changes: Optional[Sequence[Optional[ChangeSet]]] = None,
+                company_ids: Optional[Sequence[str]] = None) -> Dict[str, Any]:
+        """Пересчитывает затронутые компании (все, если не заданы ни changes, ни company_ids).
+
+        views — блоки данных, changes[i] — изменения блока views[i] (None — блок не менялся).
+        Компании вне всех блоков не оцениваются. В сводке checked — проверенные компании,
+        companies — те, чьи оценки сохранены.
+        """
+        with self._lock:
+            wanted = set(company_ids) if company_ids is not None else None
+            assigned = np.zeros(len(self.company_ids), dtype=bool)
+            plan = []
+            for i, view in enumerate(views):
+                companies, cells = self._block_companies(view)
+                keep = ~assigned[companies]
+                if wanted is not None:
+                    keep &= np.array([self.company_ids[c] in wanted for c in companies], dtype=bool)
+                elif changes is not None:
+                    keep &= changes[i].cells.ravel()[cells] if changes[i] is not None else False
+                selected = companies[keep]
+                assigned[selected] = True
+                plan.append((view, [self.company_ids[c] for c in selected], self.latitudes[selected],
+                             self.longitudes[selected]))
+
+        seq = self.store.last_seq()
+        alerts = scored = checked = 0
+        with timed('recompute.rescore'):
+            for view, ids, lats, lons in plan:
+                for start in range(0, len(ids), self.batch_size):
+                    seq, batch_scored, batch_alerts = self._rescore_batch(
+                        view, ids[start:start + self.batch_size], lats[start:start + self.batch_size],
+                        lons[start:start + self.batch_size], seq, changes is not None)
+                    scored += batch_scored
+                    alerts += batch_alerts
+                checked += len(ids)
+
+        registry.inc('esg_companies_checked_total', checked)
+        registry.inc('esg_companies_rescored_total', scored)
+        registry.inc('esg_score_alerts_total', alerts)
+        changed = [change for change in changes or () if change is not None and change.start is not None]
+        return {
+            'companies': scored,
+            'checked': checked,
+            'portfolio': len(self.company_ids),
+            'alerts': alerts,
+            'seq': seq,
+            'cells': sum(change.n_cells for change in changes if change is not None) if changes is not None else None,
+            'start': _timestamp(min(change.start for change in changed)) if changed else None,
+            'stop': _timestamp(max(change.stop for change in changed)) if changed else None,
+        }
+
+    def _rescore_batch(self, view, ids: List[str], lats: np.ndarray, lons: np.ndarray, seq: int,
+                       only_changed: bool = False) -> Tuple[int, int, int]:
+        batch = self.calculator.calculate_indicators_batch(view.data, lats, lons, pyramid=view.temporal_pyramid)
+        trend = dict(zip(batch['pollutants'], batch['pollution_trend'].tolist()))
+        latest = self.store.latest(ids)
+        records = []
+        for i, company_id in enumerate(ids):
+            normalized = dict(zip(batch['pollutants'], batch['normalized_concentrations'][i].tolist()))
+            result = {
+                'pollution_index': float(batch['pollution_index'][i]),
+                'normalized_concentrations': normalized,
+                # Тренд по блоку данных компании (её скачанной области)
+                'pollution_trend': trend,
+            }
+            result['interpretation'] = self.calculator.interpret_results(result)
+            pollution_index = _finite(result['pollution_index'])
+            previous = latest.get(company_id)
+            if only_changed and not self._changed(previous, pollution_index, result['interpretation']):
+                continue
+            records.append({
+                'company_id': company_id,
+                'latitude': float(lats[i]),
+                'longitude': float(lons[i]),
+                'pollution_index': pollution_index,
+                'previous': previous['pollution_index'] if previous is not None else None,
+                'result': result,
+            })
+        if records:
+            seq = self.store.save(records, self.alert_threshold)
+        alerts = sum(1 for r in records if r['previous'] is not None and r['pollution_index'] is not None
+                     and abs(r['pollution_index'] - r['previous']) >= self.alert_threshold)
+        return seq, len(records), alerts
+
+    def _changed(self, previous: Optional[Dict[str, Any]], pollution_index: Optional[float],
+                 interpretation: str) -> bool:
+        if previous is None or previous['interpretation'] != interpretation:
+            return True
+        if previous['pollution_index'] is None or pollution_index is None:
+            return previous['pollution_index'] != pollution_index
+        return abs(pollution_index - previous['pollution_index']) >= self.tolerance
+
+
+def _finite(value: float) -> Optional[float]:
+    return value if np.isfinite(value) else None
+
+
+def _timestamp(value) -> Optional[str]:
+    return pd.Timestamp(value).isoformat() if value is not None else None
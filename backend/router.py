@@ -0,0 +1,392 @@
+"""
+Router in front of spatially sharded api.py nodes (see SHARD_BOUNDS in api.py).
+
+Point requests go to the shard owning the location; batches are split by owner
+and their NDJSON streams merged back with the request's indices; comparison
+regions that do not fit into the owner's halo are assembled from per-shard
+sums and counts (/shard/region_sums), so the result equals a single-node run
+on the native grid. Shards are configured with SHARDS: a JSON list of
+{"url", "bounds": [south, north, west, east]} or a path to such a file.
+
+/export and PUT /scores/companies are split by owner like batches, /ingest is sent
+to every shard and /datasets lists every shard's catalog. Peer ranking is not
+spatial, so all /peers requests go to the first shard, which keeps the one index.
+
+Shard-local, not served by the router: /jobs (job ids and artifacts live on the
+shard that ran them), /scores and /scores/changes (each shard numbers its score
+changes with its own seq) and /metrics. Clients call those on the shard URLs
+listed by /shards.
+"""
+
+import asyncio
+import json
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import Response, StreamingResponse
+
+from core import AtmosphericLayerPollutantConverter, ESGCalculator
+from export import ARROW_MEDIA_TYPE, PARQUET_MEDIA_TYPE, concat_scores, deserialize_table, serialize_table
+from sharding import Shard, ShardMap, merge_region_sums
+
+app = FastAPI()
+
+SHARDS = os.environ.get("SHARDS", "shards.json")
+# Must not exceed the SHARD_HALO the shards were started with
+SHARD_HALO = float(os.environ.get("SHARD_HALO", 1.0))
+SHARD_TIMEOUT = float(os.environ.get("SHARD_TIMEOUT", 120))
+REGION_DELTA = 1.0
+MAX_SWEEP_POINTS = 10000
+
+# Endpoints answered entirely by the shard that owns (latitude, longitude)
+POINT_ENDPOINTS = ("esg_results", "interpretation", "exceedance", "timeseries", "zonal_comparison")
+
+shard_map: Optional[ShardMap] = None
+client: Optional[httpx.AsyncClient] = None
+calculator = ESGCalculator(AtmosphericLayerPollutantConverter())
+
+
+@app.on_event("startup")
+async def startup_event():
+    global shard_map, client
+    shard_map = ShardMap.load(SHARDS, SHARD_HALO)
+    # One pooled client for all shards: connections are reused between requests
+    client = httpx.AsyncClient(timeout=httpx.Timeout(SHARD_TIMEOUT, connect=5.0),
+                               limits=httpx.Limits(max_connections=100, max_keepalive_connections=20))
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await client.aclose()
+
+
+def _coordinates(payload: Dict[str, Any]) -> Tuple[float, float]:
+    try:
+        return float(payload["latitude"]), float(payload["longitude"])
+    except (KeyError, TypeError, ValueError):
+        raise HTTPException(status_code=422, detail="latitude and longitude are required.")
+
+
+def _owner(lat: float, lon: float) -> Shard:
+    shard = shard_map.owner(lat, lon)
+    if shard is None:
+        raise HTTPException(status_code=404, detail="No shard serves this location.")
+    return shard
+
+
+async def _post_json(shard: Shard, endpoint: str, payload: Dict[str, Any]) -> Any:
+    return (await _send(shard, "POST", endpoint, payload)).json()
+
+
+async def _send(shard: Shard, method: str, endpoint: str, payload: Optional[Dict[str, Any]] = None,
+                params=None) -> httpx.Response:
+    try:
+        response = await client.request(method, f"{shard.url}/{endpoint}", json=payload, params=params)
+    except httpx.HTTPError as e:
+        raise HTTPException(status_code=502, detail=f"Shard {shard.url} unavailable: {e}")
+    if response.status_code != 200:
+        # 503 (data still loading) and client errors pass through unchanged
+        status = response.status_code if response.status_code < 500 or response.status_code == 503 else 502
+        try:
+            detail = response.json().get("detail", response.text)
+        except ValueError:
+            detail = response.text
+        raise HTTPException(status_code=status, detail=detail)
+    return response
+
+
+async def _forward(shard: Shard, endpoint: str, payload: Optional[Dict[str, Any]], method: str = "POST",
+                   params=None) -> Response:
+    try:
+        response = await client.request(method, f"{shard.url}/{endpoint}", json=payload, params=params)
+    except httpx.HTTPError as e:
+        raise HTTPException(status_code=502, detail=f"Shard {shard.url} unavailable: {e}")
+    return Response(content=response.content, status_code=response.status_code,
+                    media_type=response.headers.get("content-type"))
+
+
+def _point_route(endpoint: str):
+    async def route(request: Request):
+        payload = await request.json()
+        return await _forward(_owner(*_coordinates(payload)), endpoint, payload)
+    route.__name__ = f"route_{endpoint}"
+    return route
+
+
+for _endpoint in POINT_ENDPOINTS:
+    app.add_api_route(f"/{_endpoint}", _point_route(_endpoint), methods=["POST"])
+
+
+def _region_box(lat: float, lon: float, delta: float) -> Tuple[float, float, float, float]:
+    return lat - delta, lat + delta, lon - delta, lon + delta
+
+
+async def _merged_comparison(owner: Shard, lat: float, lon: float, delta: float) -> Dict[str, Any]:
+    # Point values from the owner, region mean from the sums and counts of every shard it overlaps
+    box = _region_box(lat, lon, delta)
+    box_payload = dict(zip(("lat_min", "lat_max", "lon_min", "lon_max"), box))
+    point, *parts = await asyncio.gather(
+        _post_json(owner, "shard/point_mean", {"latitude": lat, "longitude": lon}),
+        *(_post_json(shard, "shard/region_sums", box_payload) for shard in shard_map.overlapping(*box)),
+    )
+    point_values = {p: float("nan") if v is None else v for p, v in point["means"].items()}
+    return calculator.comparison_result(lat, lon, delta, point_values, merge_region_sums(parts))
+
+
+def _covered(shard: Shard, lat: float, lon: float, delta: float) -> bool:
+    return shard.bounds.covers(*_region_box(lat, lon, delta), shard_map.halo)
+
+
+@app.post("/comparison")
+async def get_comparison(request: Request):
+    payload = await request.json()
+    lat, lon = _coordinates(payload)
+    owner = _owner(lat, lon)
+    delta = float(payload.get("region_delta", REGION_DELTA))
+    if _covered(owner, lat, lon, delta):
+        return await _forward(owner, "comparison", payload)
+    # Cross-shard regions are averaged on the native grid (resolution is not applied)
+    return {"comparison": await _merged_comparison(owner, lat, lon, delta)}
+
+
+async def _merge_streams(jobs: List[Tuple[Shard, str, Dict[str, Any], List[int]]], orphans: List[Dict[str, Any]],
+                         fixup=None):
+    # Streams every shard's NDJSON concurrently; a row's "index" is mapped from the
+    # sub-batch position back to the position in the original request
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def run(shard: Shard, endpoint: str, payload: Dict[str, Any], indices: List[int]):
+        pending = set(indices)
+        try:
+            async with client.stream("POST", f"{shard.url}/{endpoint}", json=payload) as response:
+                if response.status_code != 200:
+                    raise RuntimeError(f"shard returned {response.status_code}")
+                async for line in response.aiter_lines():
+                    if not line:
+                        continue
+                    row = json.loads(line)
+                    row["index"] = indices[row["index"]]
+                    if fixup is not None and "error" not in row:
+                        try:
+                            await fixup(shard, row)
+                        except HTTPException as e:
+                            row["error"] = e.detail
+                    await queue.put(row)
+                    pending.discard(row["index"])
+        except Exception as e:
+            for index in sorted(pending):
+                await queue.put({"index": index, "error": f"Shard {shard.url} failed: {e}"})
+        finally:
+            await queue.put(None)
+
+    for row in orphans:
+        yield json.dumps(row) + "\n"
+    tasks = [asyncio.ensure_future(run(*job)) for job in jobs]
+    try:
+        remaining = len(tasks)
+        while remaining:
+            row = await queue.get()
+            if row is None:
+                remaining -= 1
+            else:
+                yield json.dumps(row) + "\n"
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+@app.post("/sites/stream")
+async def stream_sites(request: Request):
+    payload = await request.json()
+    locations = payload.get("locations") or []
+    if not locations:
+        raise HTTPException(status_code=422, detail="locations must not be empty.")
+
+    points = [_coordinates(location) for location in locations]
+    groups, orphan_indices = shard_map.group(points)
+    jobs = [(shard, "sites/stream", {"locations": [locations[i] for i in indices]}, indices)
+            for shard, indices in groups.items()]
+    orphans = [{"index": i, "latitude": points[i][0], "longitude": points[i][1],
+                "error": "No shard serves this location."} for i in orphan_indices]
+
+    async def fixup(shard: Shard, row: Dict[str, Any]):
+        # The shard only sees its tile plus the halo; wider regions are merged across shards
+        lat, lon = points[row["index"]]
+        delta = float(locations[row["index"]].get("region_delta", REGION_DELTA))
+        if not _covered(shard, lat, lon, delta):
+            row["comparison"] = {"comparison": await _merged_comparison(shard, lat, lon, delta)}
+
+    return StreamingResponse(_merge_streams(jobs, orphans, fixup), media_type="application/x-ndjson")
+
+
+@app.post("/region_sweep/stream")
+async def stream_region_sweep(request: Request):
+    sweep = await request.json()
+    try:
+        north, south, west, east = (float(sweep[key]) for key in ("north", "south", "west", "east"))
+        step = float(sweep.get("step", 0.5))
+    except (KeyError, TypeError, ValueError):
+        raise HTTPException(status_code=422, detail="north, south, west and east are required.")
+    if south > north or west > east or step <= 0:
+        raise HTTPException(status_code=422, detail="Invalid sweep bounds.")
+
+    # Same grid of points as api.py; each shard gets the sub-rectangle of points it owns
+    n_lat = int((north - south) / step) + 1
+    n_lon = int((east - west) / step) + 1
+    if n_lat * n_lon > MAX_SWEEP_POINTS:
+        raise HTTPException(status_code=422, detail=f"Sweep exceeds {MAX_SWEEP_POINTS} points, increase the step.")
+    lats = [south + i * step for i in range(n_lat)]
+    lons = [west + j * step for j in range(n_lon)]
+
+    jobs, owned = [], set()
+    for shard in shard_map.shards:
+        rows = [i for i, lat in enumerate(lats) if shard.bounds.contains(lat, shard.bounds.west)]
+        cols = [j for j, lon in enumerate(lons) if shard.bounds.contains(shard.bounds.south, lon)]
+        if not rows or not cols:
+            continue
+        sub_sweep = dict(sweep, south=lats[rows[0]], north=min(lats[rows[-1]] + step * 1e-6, 90),
+                         west=lons[cols[0]], east=min(lons[cols[-1]] + step * 1e-6, 180))
+        indices = [i * n_lon + j for i in rows for j in cols]
+        owned.update(indices)
+        jobs.append((shard, "region_sweep/stream", sub_sweep, indices))
+    orphans = [{"index": k, "latitude": lats[k // n_lon], "longitude": lons[k % n_lon],
+                "error": "No shard serves this location."} for k in range(n_lat * n_lon) if k not in owned]
+    return StreamingResponse(_merge_streams(jobs, orphans), media_type="application/x-ndjson")
+
+
+@app.post("/timeline")
+async def get_timeline(request: Request):
+    payload = await request.json()
+    locations = payload.get("locations") or []
+    if not locations:
+        raise HTTPException(status_code=422, detail="locations must not be empty.")
+
+    groups, orphans = shard_map.group([_coordinates(location) for location in locations])
+    if orphans:
+        raise HTTPException(status_code=404, detail=f"No shard serves locations {orphans[:10]}.")
+    shards = list(groups)
+    results = await asyncio.gather(*(
+        _post_json(shard, "timeline", dict(payload, locations=[locations[i] for i in groups[shard]]))
+        for shard in shards
+    ))
+    # Shards hold the same time axis, so the windows agree; every site carries the trend of its own
+    # data block, and sites are put back in order
+    sites: List[Optional[Dict[str, Any]]] = [None] * len(locations)
+    for shard, result in zip(shards, results):
+        for i, site in zip(groups[shard], result["sites"]):
+            sites[i] = site
+    return dict(results[0], sites=sites)
+
+
+@app.post("/region_mean")
+async def get_region_mean(request: Request):
+    box = await request.json()
+    try:
+        lat_min, lat_max, lon_min, lon_max = (float(box[key]) for key in ("lat_min", "lat_max", "lon_min", "lon_max"))
+    except (KeyError, TypeError, ValueError):
+        raise HTTPException(status_code=422, detail="lat_min, lat_max, lon_min and lon_max are required.")
+
+    shards = shard_map.overlapping(lat_min, lat_max, lon_min, lon_max)
+    parts = await asyncio.gather(*(_post_json(shard, "shard/region_sums", box) for shard in shards))
+    means = merge_region_sums(parts)
+    return {"means": {p: value if value == value else None for p, value in means.items()}, "shards": len(shards)}
+
+
+@app.get("/shards")
+async def get_shards():
+    async def status(shard: Shard):
+        try:
+            response = await client.get(f"{shard.url}/shard", timeout=5.0)
+            return response.json()
+        except httpx.HTTPError as e:
+            return {"error": str(e)}
+
+    statuses = await asyncio.gather(*(status(shard) for shard in shard_map.shards))
+    return [{"url": shard.url, "bounds": list(shard.bounds), **info} for shard, info in zip(shard_map.shards, statuses)]
+
+
+def _split_by_owner(items: List[Dict[str, Any]]) -> Dict[Shard, List[int]]:
+    if not items:
+        raise HTTPException(status_code=422, detail="The batch must not be empty.")
+    groups, orphans = shard_map.group([_coordinates(item) for item in items])
+    if orphans:
+        raise HTTPException(status_code=404, detail=f"No shard serves locations {orphans[:10]}.")
+    return groups
+
+
+@app.post("/export")
+async def export_scores(request: Request, format: str = Query("arrow", pattern="^(arrow|parquet)$")):
+    payload = await request.json()
+    locations = payload.get("locations") or []
+    groups = _split_by_owner(locations)
+    shards = list(groups)
+    responses = await asyncio.gather(*(
+        _send(shard, "POST", "export", {"locations": [locations[i] for i in groups[shard]]}, {"format": "arrow"})
+        for shard in shards
+    ))
+    import pyarrow as pa
+
+    # Shards number their rows 0..n-1 within their sub-batch; site_id goes back to the request position
+    tables = []
+    for shard, response in zip(shards, responses):
+        table = deserialize_table(response.content)
+        site_ids = [groups[shard][i] for i in table.column("site_id").to_pylist()]
+        tables.append(table.set_column(0, "site_id", pa.array(site_ids)))
+    content = serialize_table(concat_scores(tables), format)
+    return Response(content=content, media_type=ARROW_MEDIA_TYPE if format == "arrow" else PARQUET_MEDIA_TYPE,
+                    headers={"Content-Disposition": f"attachment; filename=esg_scores.{format}"})
+
+
+@app.put("/scores/companies")
+async def register_companies(request: Request):
+    # Every shard scores the companies it owns; the summaries are added up
+    payload = await request.json()
+    companies = payload.get("companies") or []
+    groups = _split_by_owner(companies)
+    results = await asyncio.gather(*(
+        _send(shard, "PUT", "scores/companies", {"companies": [companies[i] for i in indices]})
+        for shard, indices in groups.items()
+    ))
+    summaries = [response.json() for response in results]
+    return {"companies": sum(summary["companies"] for summary in summaries),
+            "shards": [dict(summary, url=shard.url) for shard, summary in zip(groups, summaries)]}
+
+
+@app.post("/ingest")
+async def ingest_data(request: Request):
+    # Every shard ingests the date for its own tile; one failing shard does not hide the others' results
+    payload = await request.json()
+    results = await asyncio.gather(*(_post_json(shard, "ingest", payload) for shard in shard_map.shards),
+                                   return_exceptions=True)
+    return {"shards": [
+        {"url": shard.url, **result} if not isinstance(result, Exception)
+        else {"url": shard.url, "error": result.detail if isinstance(result, HTTPException) else str(result)}
+        for shard, result in zip(shard_map.shards, results)
+    ]}
+
+
+@app.get("/datasets")
+async def get_datasets():
+    async def datasets(shard: Shard):
+        try:
+            return {"datasets": (await _send(shard, "GET", "datasets")).json()}
+        except HTTPException as e:
+            return {"error": e.detail}
+
+    results = await asyncio.gather(*(datasets(shard) for shard in shard_map.shards))
+    return [{"url": shard.url, "bounds": list(shard.bounds), **result} for shard, result in zip(shard_map.shards, results)]
+
+
+@app.get("/datasets/route")
+async def route_dataset(request: Request):
+    params = list(request.query_params.multi_items())
+    return await _forward(_owner(*_coordinates(dict(params))), "datasets/route", None, "GET", params)
+
+
+@app.api_route("/peers/{path:path}", methods=["GET", "POST", "PUT"])
+async def route_peers(path: str, request: Request):
+    payload = await request.json() if request.method != "GET" else None
+    return await _forward(shard_map.shards[0], f"peers/{path}", payload, request.method,
+                          list(request.query_params.multi_items()))
@@ -0,0 +1,122 @@
+import json
+import os
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+class ShardBounds(NamedTuple):
+    """Тайл сетки, которым владеет шард: [south, north) × [west, east).
+
+    Верхние границы включаются только на краю мира (90° и 180°), так что каждая
+    ячейка принадлежит ровно одному шарду и суммы по регионам не задваиваются.
+    """
+
+    south: float
+    north: float
+    west: float
+    east: float
+
+    @classmethod
+    def parse(cls, text: str) -> 'ShardBounds':
+        """Из строки "south,north,west,east" (формат SHARD_BOUNDS)."""
+        values = [float(value) for value in text.split(',')]
+        if len(values) != 4:
+            raise ValueError(f"Expected south,north,west,east, got {text!r}")
+        bounds = cls(*values)
+        if bounds.south >= bounds.north or bounds.west >= bounds.east:
+            raise ValueError(f"Empty shard bounds: {text!r}")
+        return bounds
+
+    @classmethod
+    def from_area(cls, area: Sequence[float]) -> 'ShardBounds':
+        """Из области загрузки CDS [north, west, south, east]."""
+        north, west, south, east = area
+        return cls(south, north, west, east)
+
+    def contains(self, lat: float, lon: float) -> bool:
+        in_lat = self.south <= lat < self.north or (self.north >= 90 and lat == self.north)
+        in_lon = self.west <= lon < self.east or (self.east >= 180 and lon == self.east)
+        return in_lat and in_lon
+
+    def covers(self, lat_min: float, lat_max: float, lon_min: float, lon_max: float, halo: float) -> bool:
+        """Помещается ли регион в загруженную шардом область (тайл плюс halo градусов)."""
+        return (lat_min >= self.south - halo and lat_max <= self.north + halo
+                and lon_min >= self.west - halo and lon_max <= self.east + halo)
+
+    def clip(self, lat_min: float, lat_max: float, lon_min: float,
+             lon_max: float) -> Optional[Tuple[float, float, float, float]]:
+        """Часть региона (с включёнными границами, как в SpatialPyramid.region_sums) внутри тайла."""
+        north = self.north if self.north >= 90 else np.nextafter(self.north, -np.inf)
+        east = self.east if self.east >= 180 else np.nextafter(self.east, -np.inf)
+        box = (max(lat_min, self.south), min(lat_max, north), max(lon_min, self.west), min(lon_max, east))
+        if box[0] > box[1] or box[2] > box[3]:
+            return None
+        return box
+
+    def area(self, halo: float = 0.0) -> list:
+        """Область загрузки [north, west, south, east] для CDS с полями halo."""
+        return [min(self.north + halo, 90), max(self.west - halo, -180),
+                max(self.south - halo, -90), min(self.east + halo, 180)]
+
+
+class Shard(NamedTuple):
+    url: str
+    bounds: ShardBounds
+
+
+class ShardMap:
+    """Какие шарды владеют точкой или пересекают регион (для маршрутизатора)."""
+
+    def __init__(self, shards: Sequence[Shard], halo: float):
+        self.shards = list(shards)
+        self.halo = halo
+
+    @classmethod
+    def load(cls, config: str, halo: float) -> 'ShardMap':
+        """config — JSON-список {"url", "bounds": [south, north, west, east]} или путь к файлу с ним."""
+        if os.path.exists(config):
+            with open(config) as f:
+                config = f.read()
+        return cls([Shard(entry['url'].rstrip('/'), ShardBounds(*entry['bounds'])) for entry in json.loads(config)],
+                   halo)
+
+    def owner(self, lat: float, lon: float) -> Optional[Shard]:
+        for shard in self.shards:
+            if shard.bounds.contains(lat, lon):
+                return shard
+        return None
+
+    def overlapping(self, lat_min: float, lat_max: float, lon_min: float, lon_max: float) -> List[Shard]:
+        return [shard for shard in self.shards if shard.bounds.clip(lat_min, lat_max, lon_min, lon_max) is not None]
+
+    def group(self, points: Sequence[Tuple[float, float]]) -> Tuple[Dict[Shard, List[int]], List[int]]:
+        """Индексы точек по шардам-владельцам и индексы точек вне всех шардов."""
+        groups: Dict[Shard, List[int]] = {}
+        orphans = []
+        for i, (lat, lon) in enumerate(points):
+            shard = self.owner(lat, lon)
+            if shard is None:
+                orphans.append(i)
+            else:
+                groups.setdefault(shard, []).append(i)
+        return groups, orphans
+
+
+def split_bounds(bounds: ShardBounds, rows: int, cols: int) -> List[ShardBounds]:
+    """Разбиение области на rows × cols тайлов одинакового размера в градусах."""
+    lats = np.linspace(bounds.south, bounds.north, rows + 1)
+    lons = np.linspace(bounds.west, bounds.east, cols + 1)
+    return [ShardBounds(float(lats[i]), float(lats[i + 1]), float(lons[j]), float(lons[j + 1]))
+            for i in range(rows) for j in range(cols)]
+
+
+def merge_region_sums(parts: Sequence[dict]) -> Dict[str, float]:
+    """Среднее по региону из ответов /shard/region_sums нескольких шардов."""
+    sums: Dict[str, float] = {}
+    counts: Dict[str, int] = {}
+    for part in parts:
+        for pollutant, value in part['sums'].items():
+            sums[pollutant] = sums.get(pollutant, 0.0) + value
+            counts[pollutant] = counts.get(pollutant, 0) + part['counts'][pollutant]
+    return {p: sums[p] / counts[p] if counts[p] else float('nan') for p in sums}
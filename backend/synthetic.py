@@ -0,0 +1,72 @@
+import os
+import tempfile
+import zipfile
+from typing import Optional, Sequence
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+# Порядок величин типичных концентраций (μg/m³) в данных CAMS
+POLLUTANT_SCALES = {
+    'no2_conc': 15.0,
+    'so2_conc': 3.0,
+    'co_conc': 200.0,
+    'pm10_conc': 15.0,
+    'pm2p5_conc': 9.0,
+    'o3_conc': 60.0,
+    'nh3_conc': 4.0,
+    'dust': 5.0,
+    'nmvoc_conc': 10.0,
+    'hcho_conc': 1.5,
+    'no_conc': 5.0,
+    'pm2p5_total_om_conc': 3.0,
+    'pm10_wildfires_conc': 1.0,
+    'sia_conc': 4.0,
+}
+
+
+def make_cams_dataset(n_lat: int = 100, n_lon: int = 150, n_time: int = 24 * 20, n_levels: int = 1,
+                      pollutants: Optional[Sequence[str]] = None, freq: str = 'h',
+                      start: str = '2024-08-01', seed: int = 0) -> xr.Dataset:
+    """Синтетический набор данных с той же структурой, что и выгрузка CAMS Europe.
+
+    Сетка покрывает Европу (широта по убыванию, как в CAMS), значения содержат
+    суточный цикл, линейный тренд и шум.
+    """
+    rng = np.random.default_rng(seed)
+    pollutants = list(pollutants or POLLUTANT_SCALES)
+
+    latitude = np.linspace(71.95, 30.05, n_lat)
+    longitude = np.linspace(-24.95, 44.95, n_lon)
+    time = pd.date_range(start, periods=n_time, freq=freq)
+    pressure_level = np.arange(n_levels, dtype=np.float64) * 50.0
+
+    hours = (time - time[0]) / pd.Timedelta(hours=1)
+    diurnal = 1 + 0.3 * np.sin(2 * np.pi * np.asarray(hours) / 24.0)
+    trend = 1 + 0.1 * np.linspace(0, 1, n_time)
+    temporal = (diurnal * trend).astype(np.float32)[:, None, None, None]
+
+    data_vars = {}
+    for pollutant in pollutants:
+        scale = POLLUTANT_SCALES.get(pollutant, 10.0)
+        spatial = rng.lognormal(mean=0.0, sigma=0.5, size=(1, 1, n_lat, n_lon)).astype(np.float32)
+        noise = rng.random((n_time, n_levels, n_lat, n_lon), dtype=np.float32)
+        values = scale * spatial * temporal * (0.8 + 0.4 * noise)
+        data_vars[pollutant] = (('time', 'pressure_level', 'latitude', 'longitude'), values,
+                                {'units': 'µg m-3'})
+
+    return xr.Dataset(
+        data_vars,
+        coords={'time': time, 'pressure_level': pressure_level, 'latitude': latitude, 'longitude': longitude},
+    )
+
+
+def write_cams_zip(dataset: xr.Dataset, zip_file: str) -> str:
+    """Сохраняет набор данных в netcdf_zip: по одному .nc файлу на переменную, как отдаёт CDS."""
+    with tempfile.TemporaryDirectory() as directory, zipfile.ZipFile(zip_file, 'w') as zip_ref:
+        for var in dataset.data_vars:
+            nc_file = os.path.join(directory, f'{var}.nc')
+            dataset[[var]].to_netcdf(nc_file)
+            zip_ref.write(nc_file, arcname=os.path.basename(nc_file))
+    return zip_file
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Модули бэкенда импортируются по имени (from core import ...), как при запуске из backend/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,50 @@
+import asyncio
+
+import pytest
+
+from batching import MicroBatcher, compute_groups
+from metrics import finish_request_timings, start_request_timings, timed
+
+
+def _square(items):
+    if any(item < 0 for item in items):
+        raise ValueError("negative item")
+    return [item * item for item in items]
+
+
+def test_compute_groups_isolates_failing_items():
+    calls = []
+
+    def compute(items):
+        calls.append(list(items))
+        return _square(items)
+
+    results = compute_groups([1, -2, 3, 4], lambda item: item % 2, compute)
+    assert results[0] == 1 and results[2] == 9 and results[3] == 16
+    assert isinstance(results[1], ValueError)
+    # Нечётные посчитаны одной группой, чётная группа с ошибкой — по одному
+    assert calls == [[1, 3], [-2, 4], [-2], [4]]
+
+
+def test_microbatch_errors_and_timings_reach_each_caller():
+    def compute(items):
+        with timed('batch.stage'):
+            return compute_groups(items, lambda item: 0, _square)
+
+    async def request(batcher, item):
+        token = start_request_timings()
+        try:
+            result = await batcher.submit(item)
+        except ValueError as e:
+            result = e
+        return result, finish_request_timings(token)
+
+    async def main():
+        batcher = MicroBatcher("test", compute, window=0.01)
+        return await asyncio.gather(*(request(batcher, item) for item in (2, -1, 3)))
+
+    (first, first_timings), (failed, failed_timings), (last, last_timings) = asyncio.run(main())
+    assert (first, last) == (4, 9)
+    assert isinstance(failed, ValueError)
+    for timings in (first_timings, failed_timings, last_timings):
+        assert timings['batch.stage'] == pytest.approx(first_timings['batch.stage'])
@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from catalog import DatasetCatalog, load_specs
+from core import ESGCalculator, IPollutantConverter, Location, covering_areas
+from sharding import ShardBounds
+from pyramid import TemporalPyramid
+
+
+class IdentityConverter(IPollutantConverter):
+    def convert(self, data, pollutant):
+        return data
+
+
+def _catalog(loader=None):
+    pollutants = list(ESGCalculator(None).who_limits)
+    return DatasetCatalog(load_specs(None, '2024-08-01/2024-08-02'), loader=loader, pollutants=pollutants)
+
+
+def _area_data(south, north, west, east):
+    latitude, longitude = np.arange(north, south - 0.05, -0.1), np.arange(west, east + 0.05, 0.1)
+    time = pd.date_range('2024-08-01', periods=2, freq='D')
+    return xr.Dataset({'no2_conc': (('time', 'latitude', 'longitude'),
+                                    np.ones((2, len(latitude), len(longitude)), dtype=np.float32))},
+                      coords={'time': time, 'latitude': latitude, 'longitude': longitude})
+
+
+def test_index_pollutants_are_common_to_every_product():
+    catalog = _catalog()
+    assert catalog.index_pollutants == ['no2_conc', 'so2_conc', 'co_conc', 'pm10_conc', 'pm2p5_conc', 'o3_conc']
+    described = {entry['name']: entry for entry in catalog.describe()}
+    assert 'nh3_conc' in described['cams-europe']['pollutants']
+    assert 'nh3_conc' not in described['cams-global']['pollutants']
+    assert described['cams-global']['index_pollutants'] == catalog.index_pollutants
+
+
+def test_pollution_index_ignores_pollutants_outside_the_common_set():
+    time = pd.date_range('2024-08-01', periods=4, freq='6h')
+    limits = ESGCalculator(None).who_limits
+    # Каждый загрязнитель ровно на своём нормативе, кроме NH3 — вдесятеро выше
+    levels = {p: limit * (10 if p == 'nh3_conc' else 1) for p, limit in limits.items()}
+    data = xr.Dataset({p: (('time', 'latitude', 'longitude'), np.full((4, 2, 2), level, dtype=np.float32))
+                       for p, level in levels.items()},
+                      coords={'time': time, 'latitude': [48.0, 47.9], 'longitude': [2.0, 2.1]})
+    pyramid = TemporalPyramid(data, list(limits))
+    calculator = ESGCalculator(IdentityConverter(), index_pollutants=_catalog().index_pollutants)
+
+    assert calculator.calculate_indicator(data, 48.0, 2.0)['pollution_index'] == pytest.approx(1.0)
+    assert calculator.calculate_indicator(data, 48.0, 2.0, pyramid=pyramid)['pollution_index'] == pytest.approx(1.0)
+    np.testing.assert_allclose(calculator.calculate_indicators_batch(data, [48.0], [2.0])['pollution_index'], [1.0])
+    np.testing.assert_allclose(
+        calculator.calculate_indicators_batch(data, [48.0], [2.0], pyramid=pyramid)['pollution_index'], [1.0])
+    # NH3 по-прежнему в нормированных концентрациях, но не в индексе
+    assert calculator.calculate_indicator(data, 48.0, 2.0)['normalized_concentrations']['nh3_conc'] == 10.0
+    assert ESGCalculator(IdentityConverter()).calculate_indicator(data, 48.0, 2.0)['pollution_index'] > 1.0
+
+
+def test_downloaded_areas_are_separate_blocks_routed_by_point():
+    paris, warsaw = ShardBounds(47.0, 50.0, 1.0, 4.0), ShardBounds(51.0, 54.0, 19.0, 22.0)
+    catalog = _catalog(loader=lambda spec: [(_area_data(*paris), paris), (_area_data(*warsaw), warsaw)])
+    store = catalog.default_store
+    catalog.open(store)
+
+    # Каждый блок — только своя сетка, без пустого пространства между областями
+    assert [block.data.sizes['longitude'] for block in store.blocks] == [31, 31]
+    assert store.block(48.8, 2.3).area == paris
+    assert store.block(52.2, 21.0).area == warsaw
+    assert store.block(50.5, 10.0) is None
+    # Регион сравнения должен целиком лежать в одном блоке
+    assert store.block(49.5, 2.3, margin=1.0) is None
+    assert catalog.view(store, 52.2, 21.0, margin=1.0).area == warsaw
+    described = {entry['name']: entry for entry in catalog.describe()}['cams-europe']
+    assert described['areas'] == [list(paris), list(warsaw)]
+    assert described['grid'] == [[31, 31], [31, 31]]
+
+
+def test_covering_areas_merge_overlapping_boxes():
+    # Диагонально пересекающиеся области: общий прямоугольник больше суммы их площадей
+    sites = [Location(48.8, 2.3, 0.1), Location(50.0, 3.5, 0.1), Location(52.2, 21.0, 0.1)]
+    areas = [ShardBounds.from_area(area) for area in covering_areas(sites, padding=1.1, max_overhead=0.0)]
+    assert len(areas) == 2
+    for i, a in enumerate(areas):
+        for b in areas[i + 1:]:
+            assert a.north < b.south or b.north < a.south or a.east < b.west or b.east < a.west
@@ -0,0 +1,41 @@
+import os
+
+from download_cache import DownloadCache, request_key
+
+
+def _writer(content):
+    def download(path):
+        with open(path, 'wb') as f:
+            f.write(content)
+    return download
+
+
+def test_checked_out_files_survive_eviction(tmp_path):
+    cache = DownloadCache(str(tmp_path / 'cache'), max_bytes=10, verify=True)
+    first = cache.get_or_download('aa01', _writer(b'x' * 8), target=str(tmp_path / 'areas' / 'first.zip'))
+    # Второй файл выталкивает первый из кэша, но выложенная копия остаётся
+    second = cache.get_or_download('bb02', _writer(b'y' * 8), target=str(tmp_path / 'areas' / 'second.zip'))
+    assert cache.get('aa01') is None and cache.get('bb02') is not None
+    assert open(first, 'rb').read() == b'x' * 8 and open(second, 'rb').read() == b'y' * 8
+
+
+def test_hits_do_not_download_and_locks_are_shared(tmp_path):
+    cache_dir = tmp_path / 'cache'
+    cache_dir.mkdir()
+    (cache_dir / 'legacy.lock').write_text('')
+    cache = DownloadCache(str(cache_dir))
+    assert not (cache_dir / 'legacy.lock').exists()
+
+    keys = [request_key('product', {'day': day}) for day in range(40)]
+    for key in keys:
+        cache.get_or_download(key, _writer(key.encode()))
+
+    def fail(path):
+        raise AssertionError("cached request downloaded again")
+
+    target = str(tmp_path / 'out.zip')
+    assert cache.get_or_download(keys[0], fail, target=target) == target
+    assert open(target).read() == keys[0]
+    # Блокировки — по префиксу ключа, а не по файлу на каждый ключ
+    assert len(os.listdir(cache_dir / '.locks')) == len({key[:2] for key in keys})
+    assert not [name for name in os.listdir(cache_dir) if name.endswith('.lock')]
@@ -0,0 +1,89 @@
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from core import IPollutantConverter
+from exceedance import ExceedanceEngine, rolling_mean, run_lengths, time_step_hours
+
+
+class IdentityConverter(IPollutantConverter):
+    def convert(self, data, pollutant):
+        return data
+
+
+def test_rolling_mean_matches_convolution_and_propagates_nan():
+    values = np.arange(10, dtype=np.float64)[:, None] * np.array([1.0, 2.0])
+    np.testing.assert_allclose(rolling_mean(values, 3)[:, 1], np.convolve(values[:, 1], np.ones(3) / 3, 'valid'))
+    values[4, 0] = np.nan
+    means = rolling_mean(values, 3)[:, 0]
+    assert np.isnan(means[2:5]).all()
+    assert np.isfinite(np.delete(means, [2, 3, 4])).all()
+
+
+def test_run_lengths_counts_current_streak():
+    mask = np.array([True, True, False, True, True, True, False])
+    np.testing.assert_array_equal(run_lengths(mask), [1, 2, 0, 1, 2, 3, 0])
+
+
+def test_time_step_hours():
+    assert time_step_hours(pd.date_range('2024-01-01', periods=5, freq='3h').values) == 3.0
+    assert time_step_hours(pd.date_range('2024-01-01', periods=1, freq='h').values) == 1.0
+
+
+@pytest.fixture
+def engine():
+    # Одна ячейка 1×1, часовые шаги: SO2 (24 ч) выше нормы 20 в часы 30..89, O3 (8 ч) — два всплеска
+    time = pd.date_range('2024-08-01', periods=120, freq='h')
+    so2 = np.full(120, 10.0)
+    so2[30:90] = 40.0
+    o3 = np.full(120, 50.0)
+    o3[10:20] = 200.0
+    o3[60:64] = 300.0
+    data = xr.Dataset(
+        {'so2_conc': (('time', 'latitude', 'longitude'), so2[:, None, None]),
+         'o3_conc': (('time', 'latitude', 'longitude'), o3[:, None, None]),
+         'no2_conc': (('time', 'latitude', 'longitude'), np.full((120, 1, 1), 50.0))},
+        coords={'time': time, 'latitude': [48.0], 'longitude': [2.0]})
+    return ExceedanceEngine(data, IdentityConverter(), {'so2_conc': 20, 'o3_conc': 100, 'no2_conc': 40})
+
+
+def test_events_use_the_who_averaging_window(engine):
+    result = engine.point(48.0, 2.0)['pollutants']
+    so2 = result['so2_conc']
+    assert so2['window_steps'] == 24
+    means = rolling_mean(engine.stack[engine.pollutants.index('so2_conc')][:, 0, 0].astype(np.float64), 24)
+    assert so2['events'] == 1
+    assert so2['exceeded_hours'] == float((means > 20).sum())
+    assert so2['max_mean'] == pytest.approx(40.0)
+    assert so2['event_list'][0]['duration_hours'] == so2['longest_event_hours'] == so2['exceeded_hours']
+
+    o3 = result['o3_conc']
+    assert o3['window_steps'] == 8
+    assert o3['events'] == 2
+    assert [event['peak_mean'] for event in o3['event_list']] == pytest.approx([200.0, 50 + 250 * 4 / 8])
+
+
+def test_period_limits_compare_the_mean_without_events(engine):
+    no2 = engine.point(48.0, 2.0)['pollutants']['no2_conc']
+    assert no2['averaging'] == 'period'
+    assert no2['window_steps'] is None
+    assert no2['exceeds_who_limit'] is True
+    assert no2['events'] == 0 and no2['event_list'] == []
+
+
+def test_grid_statistics_do_not_depend_on_chunking():
+    rng = np.random.default_rng(0)
+    values = rng.gamma(2.0, 15.0, size=(72, 5, 3))
+    values[10:20, 2, 1] = np.nan
+    data = xr.Dataset(
+        {'so2_conc': (('time', 'latitude', 'longitude'), values),
+         'no2_conc': (('time', 'latitude', 'longitude'), values[::-1])},
+        coords={'time': pd.date_range('2024-08-01', periods=72, freq='h'),
+                'latitude': np.arange(5.0), 'longitude': np.arange(3.0)})
+    limits = {'so2_conc': 40, 'no2_conc': 30}
+    whole = ExceedanceEngine(data, IdentityConverter(), limits)
+    # Бюджет на одну строку широт: пять блоков вместо одного
+    chunked = ExceedanceEngine(data, IdentityConverter(), limits, chunk_bytes=1)
+    for name in ('max_mean', 'events', 'exceeded_steps', 'longest_steps'):
+        np.testing.assert_array_equal(getattr(chunked, name), getattr(whole, name))
@@ -0,0 +1,68 @@
+import threading
+from concurrent.futures import Future
+
+from jobs import JOB_CANCELLED, JOB_DONE, JOB_FAILED, JOB_QUEUED, JobQueue, JobStore, job_id_for
+
+
+def test_concurrent_identical_claims_create_one_job(tmp_path):
+    db_path = str(tmp_path / 'jobs.db')
+    JobStore(db_path)
+    barrier = threading.Barrier(8)
+    created = []
+
+    def claim():
+        # Отдельный JobStore на поток: атомарность должна держаться на транзакции, а не на общем Lock
+        store = JobStore(db_path)
+        barrier.wait()
+        created.append(store.claim('job', 'heatmaps', {'latitude': 1.0}, str(tmp_path / 'job.png'))[1])
+
+    threads = [threading.Thread(target=claim) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(created) == [False] * 7 + [True]
+
+
+def test_finished_jobs_are_reused_only_while_the_artifact_exists(tmp_path):
+    store = JobStore(str(tmp_path / 'jobs.db'))
+    artifact = tmp_path / 'job.png'
+    job, created = store.claim('job', 'heatmaps', {}, str(artifact))
+    assert created and job['status'] == JOB_QUEUED
+
+    store.set_status('job', JOB_DONE)
+    artifact.write_bytes(b'png')
+    assert store.claim('job', 'heatmaps', {}, str(artifact))[1] is False
+    artifact.unlink()
+    assert store.claim('job', 'heatmaps', {}, str(artifact))[1] is True
+
+    store.set_status('job', JOB_FAILED, error='boom')
+    job, created = store.claim('job', 'heatmaps', {}, str(artifact))
+    assert created and job['status'] == JOB_QUEUED and job['error'] is None
+
+
+def test_cancelled_future_marks_job_cancelled(tmp_path):
+    store = JobStore(str(tmp_path / 'jobs.db'))
+    queue = JobQueue(store, str(tmp_path / 'artifacts'), max_workers=1)
+    try:
+        store.claim('job', 'heatmaps', {}, str(tmp_path / 'job.png'))
+        future = Future()
+        assert future.cancel()
+        queue._on_done('job', future)
+        assert store.get('job')['status'] == JOB_CANCELLED
+
+        store.claim('other', 'heatmaps', {}, str(tmp_path / 'other.png'))
+        future = Future()
+        future.set_exception(RuntimeError('worker died'))
+        queue._on_done('other', future)
+        assert store.get('other')['status'] == JOB_FAILED and store.get('other')['error'] == 'worker died'
+    finally:
+        queue.shutdown()
+
+
+def test_job_id_tolerates_deleted_data_files(tmp_path):
+    data_file = tmp_path / 'area.zip'
+    data_file.write_bytes(b'zip')
+    present = job_id_for('heatmaps', {}, [str(data_file)])
+    data_file.unlink()
+    assert job_id_for('heatmaps', {}, [str(data_file)]) != present
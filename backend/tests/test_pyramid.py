@@ -0,0 +1,122 @@
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from pyramid import SpatialPyramid, TemporalPyramid
+
+POLLUTANTS = ['no2_conc', 'pm10_conc']
+
+
+@pytest.fixture(scope='module')
+def data():
+    # Часовые шаги через границы недель и месяцев, широта по убыванию (как в CAMS), немного NaN
+    rng = np.random.default_rng(0)
+    time = pd.date_range('2024-07-20', '2024-09-10', freq='6h', inclusive='left')
+    latitude = np.arange(50.0, 47.9, -0.25)
+    longitude = np.arange(1.0, 3.6, 0.25)
+    shape = (len(time), len(latitude), len(longitude))
+    variables = {}
+    for k, name in enumerate(POLLUTANTS):
+        values = rng.uniform(5, 50, shape) + np.linspace(0, 10 * (k + 1), len(time))[:, None, None]
+        values[rng.random(shape) < 0.05] = np.nan
+        variables[name] = (('time', 'latitude', 'longitude'), values.astype(np.float32))
+    return xr.Dataset(variables, coords={'time': time, 'latitude': latitude, 'longitude': longitude})
+
+
+WINDOWS = [
+    (None, None),
+    ('2024-07-22', '2024-07-23'),
+    ('2024-07-25T06:00', '2024-08-14T18:00'),
+    ('2024-07-31', '2024-09-01'),
+    ('2024-08-05', None),
+]
+
+
+@pytest.mark.parametrize('start, stop', WINDOWS)
+def test_window_mean_matches_direct_mean(data, start, stop):
+    pyramid = TemporalPyramid(data, POLLUTANTS)
+    window = data.sel(time=slice(start, pd.Timestamp(stop) - pd.Timedelta('1ns') if stop else None))
+    for lat_idx, lon_idx in [(0, 0), (3, 7), (8, 10)]:
+        expected = [float(window[p].isel(latitude=lat_idx, longitude=lon_idx).mean(skipna=True)) for p in POLLUTANTS]
+        np.testing.assert_allclose(pyramid.window_mean(lat_idx, lon_idx, start, stop), expected, rtol=1e-5)
+
+
+def test_window_means_matches_single_cells(data):
+    pyramid = TemporalPyramid(data, POLLUTANTS)
+    lat_idx, lon_idx = np.array([0, 2, 5]), np.array([1, 4, 9])
+    batch = pyramid.window_means(lat_idx, lon_idx, '2024-07-27', '2024-08-30')
+    for k in range(3):
+        np.testing.assert_allclose(batch[:, k], pyramid.window_mean(lat_idx[k], lon_idx[k], '2024-07-27', '2024-08-30'))
+
+
+def test_decompose_covers_window_exactly(data):
+    pyramid = TemporalPyramid(data, POLLUTANTS)
+    a, b = pyramid.window_indices('2024-07-25T06:00', '2024-08-14T18:00')
+    covered = []
+    for level, i, j in pyramid.decompose(a, b):
+        if level == -1:
+            covered.extend(range(i, j))
+        else:
+            starts, stops = pyramid.levels[level][:2]
+            covered.extend(range(starts[i], stops[j - 1]))
+    assert covered == list(range(a, b))
+
+
+@pytest.mark.parametrize('start, stop', WINDOWS)
+def test_window_trend_matches_polyfit(data, start, stop):
+    pyramid = TemporalPyramid(data, POLLUTANTS)
+    a, b = pyramid.window_indices(start, stop)
+    for k, p in enumerate(POLLUTANTS):
+        series = data[p].astype(np.float64).mean(dim=['latitude', 'longitude'], skipna=True).values[a:b]
+        expected = np.polyfit(np.arange(a, b), series, 1)[0]
+        assert pyramid.window_trend(start, stop)[k] == pytest.approx(expected, rel=1e-6)
+
+
+def test_series_window_means_and_calendar_windows(data):
+    pyramid = TemporalPyramid(data, POLLUTANTS)
+    starts, stops = pyramid.windows(freq='W', start='2024-08-01', stop='2024-09-01')
+    assert starts[0] == pyramid.window_indices('2024-08-01')[0]
+    assert np.all(stops[:-1] == starts[1:])
+    means = pyramid.series_window_means(np.array([4]), np.array([6]), starts, stops)
+    for w, (a, b) in enumerate(zip(starts, stops)):
+        np.testing.assert_allclose(means[:, w, 0], pyramid.window_mean(4, 6, pyramid.time[a], pyramid.time[b - 1]
+                                                                       + np.timedelta64(1, 'ns')), rtol=1e-6)
+
+
+def test_rolling_windows_drop_incomplete_tail(data):
+    pyramid = TemporalPyramid(data, POLLUTANTS)
+    starts, stops = pyramid.windows(window='7D', step='7D')
+    assert np.all(stops - starts == 28)  # 7 дней по 4 шага
+
+
+def test_spatial_region_mean_matches_direct_mean(data):
+    spatial = SpatialPyramid(data, POLLUTANTS)
+    field = data.mean(dim='time', skipna=True)
+    box = (48.5, 49.5, 1.5, 3.0)
+    region = field.sel(latitude=slice(box[1], box[0]), longitude=slice(box[2], box[3]))
+    expected = [float(region[p].mean()) for p in POLLUTANTS]
+    np.testing.assert_allclose(spatial.region_mean(*box), expected, rtol=1e-6)
+    np.testing.assert_allclose(spatial.point_mean(49.0, 2.0),
+                               [float(field[p].sel(latitude=49.0, longitude=2.0)) for p in POLLUTANTS], rtol=1e-6)
+
+
+@pytest.mark.parametrize('resolution', [None, 0.5, 1.0, 5.0])
+def test_region_means_matches_region_mean(data, resolution):
+    spatial = SpatialPyramid(data, POLLUTANTS)
+    lat_min, lat_max = np.array([48.0, 48.6, 49.2]), np.array([49.0, 50.0, 49.2])
+    lon_min, lon_max = np.array([1.0, 2.1, 2.5]), np.array([2.0, 3.5, 2.5])
+    batch = spatial.region_means(lat_min, lat_max, lon_min, lon_max, resolution)
+    for k in range(3):
+        np.testing.assert_allclose(batch[:, k], spatial.region_mean(lat_min[k], lat_max[k], lon_min[k], lon_max[k],
+                                                                    resolution), rtol=1e-9)
+
+
+def test_level_for_picks_coarsest_level_within_resolution(data):
+    spatial = SpatialPyramid(data, POLLUTANTS)
+    assert spatial.resolution == pytest.approx(0.25)
+    assert spatial.level_for(None) == 0
+    assert spatial.level_for(0.3) == 0
+    assert spatial.level_for(0.5) == 1
+    assert spatial.level_for(1.9) == 2
+    assert spatial.level_for(10) == 3
@@ -0,0 +1,56 @@
+import pytest
+
+from ranking import ANY, PeerRanking
+
+
+def _ranking(records):
+    ranking = PeerRanking()
+    ranking.update_many(records)
+    return ranking
+
+
+def test_percentile_within_full_group():
+    ranking = _ranking([
+        {'company_id': 'a', 'score': 0.2, 'industry': 'energy', 'size': 'large', 'country': 'FR'},
+        {'company_id': 'b', 'score': 0.5, 'industry': 'energy', 'size': 'large', 'country': 'FR'},
+        {'company_id': 'c', 'score': 0.9, 'industry': 'energy', 'size': 'large', 'country': 'FR'},
+    ])
+    result = ranking.percentile('b')
+    assert result['peers'] == 3
+    assert result['rank'] == 2
+    assert result['percentile'] == pytest.approx(50.0)
+
+
+def test_rollup_groups_across_dimensions():
+    ranking = _ranking([
+        {'company_id': 'a', 'score': 0.2, 'industry': 'energy', 'size': 'large', 'country': 'FR'},
+        {'company_id': 'b', 'score': 0.7, 'industry': 'energy', 'size': 'small', 'country': 'DE'},
+        {'company_id': 'c', 'score': 0.4, 'industry': 'retail', 'size': 'large', 'country': 'FR'},
+    ])
+    assert [r['company_id'] for r in ranking.top(industry='energy')] == ['b', 'a']
+    assert [r['company_id'] for r in ranking.top(country='FR')] == ['c', 'a']
+    assert ranking.percentile('a', by=('industry',))['peers'] == 2
+    assert ranking.percentile('a', by=())['peers'] == 3
+
+
+def test_partial_dimensions_are_counted_once():
+    ranking = _ranking([
+        {'company_id': 'a', 'score': 0.1, 'industry': 'x', 'size': None, 'country': None},
+        {'company_id': 'b', 'score': 0.9, 'industry': 'x'},
+    ])
+    assert ranking.top(industry='x') == [{'company_id': 'b', 'score': 0.9}, {'company_id': 'a', 'score': 0.1}]
+    result = ranking.percentile('a')
+    assert result['group'] == {'industry': 'x', 'size': ANY, 'country': ANY}
+    assert (result['peers'], result['rank']) == (2, 2)
+    assert len(ranking.top(k=10)) == 2
+
+
+def test_update_moves_company_and_remove_drops_empty_groups():
+    ranking = _ranking([{'company_id': 'a', 'score': 0.1, 'industry': 'x'}])
+    ranking.update('a', 0.3, 'y', ANY, ANY)
+    assert ranking.top(industry='x') == []
+    assert ranking.top(industry='y') == [{'company_id': 'a', 'score': 0.3}]
+    ranking.remove('a')
+    assert len(ranking) == 0
+    assert ranking._groups == {}
+    assert ranking.percentile('a') is None
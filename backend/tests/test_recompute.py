@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from catalog import DatasetView
+from core import ESGCalculator, IPollutantConverter
+from recompute import ChangeSet, RecomputeScheduler, ScoreStore
+from sharding import ShardBounds
+
+
+class IdentityConverter(IPollutantConverter):
+    def convert(self, data, pollutant):
+        return data
+
+
+def _block(area, level):
+    limits = ESGCalculator(None).who_limits
+    latitude, longitude = np.arange(area.north, area.south - 0.05, -0.5), np.arange(area.west, area.east + 0.05, 0.5)
+    time = pd.date_range('2024-08-01', periods=3, freq='D')
+    data = xr.Dataset({p: (('time', 'latitude', 'longitude'),
+                           np.full((3, len(latitude), len(longitude)), limit * level, dtype=np.float32))
+                       for p, limit in limits.items()},
+                      coords={'time': time, 'latitude': latitude, 'longitude': longitude})
+    return DatasetView.build('test', data, list(limits), area)
+
+
+def test_companies_are_rescored_in_their_own_block(tmp_path):
+    paris, warsaw = ShardBounds(47.0, 50.0, 1.0, 4.0), ShardBounds(51.0, 54.0, 19.0, 22.0)
+    blocks = [_block(paris, 1.0), _block(warsaw, 2.0)]
+    scheduler = RecomputeScheduler(ESGCalculator(IdentityConverter()), ScoreStore(str(tmp_path / 'scores.db')))
+    scheduler.set_companies([{'company_id': 'paris', 'latitude': 48.8, 'longitude': 2.3},
+                             {'company_id': 'warsaw', 'latitude': 52.2, 'longitude': 21.0},
+                             {'company_id': 'berlin', 'latitude': 52.5, 'longitude': 13.4}])
+
+    summary = scheduler.rescore(blocks)
+    # Берлин вне скачанных областей и не оценивается
+    assert summary['companies'] == 2
+    scores = {row['company_id']: row for row in scheduler.store.scores()}
+    assert set(scores) == {'paris', 'warsaw'}
+    assert scores['paris']['pollution_index'] == 1.0 and scores['warsaw']['pollution_index'] == 2.0
+    assert set(scores['warsaw']['result']['pollution_trend']) == set(ESGCalculator(None).who_limits)
+
+    # Изменения только в блоке Варшавы пересчитывают только её
+    changed = np.ones((blocks[1].data.sizes['latitude'], blocks[1].data.sizes['longitude']), dtype=bool)
+    summary = scheduler.rescore([blocks[0], _block(warsaw, 3.0)], [None, ChangeSet(changed, None, None)])
+    assert summary['companies'] == 1
+    assert [row['company_id'] for row in scheduler.store.scores(since=2)] == ['warsaw']
+
+
+def test_ingestion_saves_only_scores_that_moved(tmp_path):
+    area = ShardBounds(47.0, 50.0, 1.0, 4.0)
+    block = _block(area, 1.0)
+    scheduler = RecomputeScheduler(ESGCalculator(IdentityConverter()), ScoreStore(str(tmp_path / 'scores.db')),
+                                   tolerance=0.05)
+    scheduler.set_companies([{'company_id': 'paris', 'latitude': 48.8, 'longitude': 2.3},
+                             {'company_id': 'lyon', 'latitude': 47.5, 'longitude': 3.0}])
+    scheduler.rescore([block])
+    seq = scheduler.store.last_seq()
+
+    # Новые дни почти не сдвигают Лион, но поднимают Париж выше допуска
+    data = block.data.copy(deep=True)
+    data['no2_conc'].loc[dict(latitude=49.0, longitude=2.5)] *= 3
+    data['no2_conc'].loc[dict(latitude=47.5, longitude=3.0)] *= 1.01
+    updated = DatasetView.build('test', data, list(ESGCalculator(None).who_limits), area)
+    all_cells = np.ones((data.sizes['latitude'], data.sizes['longitude']), dtype=bool)
+    summary = scheduler.rescore([updated], [ChangeSet(all_cells, None, None)])
+
+    assert summary['checked'] == 2 and summary['companies'] == 1
+    assert [row['company_id'] for row in scheduler.store.scores(since=seq)] == ['paris']
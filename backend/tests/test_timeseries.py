@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from core import IPollutantConverter
+from pyramid import TemporalPyramid
+from timeseries import downsample, encode_series, lttb, minmax, pollutant_series, round_significant
+
+
+class IdentityConverter(IPollutantConverter):
+    def convert(self, data, pollutant):
+        return data
+
+
+def _reference_lttb(x, y, points):
+    # Прямая реализация по описанию алгоритма: корзины как в lttb, средние следующей корзины по циклу
+    n = len(x)
+    edges = np.floor(np.linspace(1, n - 1, points - 1)).astype(int)
+    selected, a = [0], 0
+    for i in range(points - 2):
+        lo, hi = edges[i], edges[i + 1]
+        nlo, nhi = (edges[i + 1], edges[i + 2]) if i + 2 < len(edges) else (n - 1, n)
+        ax, ay = x[nlo:nhi].mean(), y[nlo:nhi].mean()
+        areas = [abs((x[a] - ax) * (y[j] - y[a]) - (x[a] - x[j]) * (ay - y[a])) for j in range(lo, hi)]
+        a = lo + int(np.argmax(areas))
+        selected.append(a)
+    return selected + [n - 1]
+
+
+def test_lttb_matches_reference_and_keeps_spikes():
+    rng = np.random.default_rng(1)
+    x = np.arange(1000, dtype=np.float64)
+    y = rng.normal(size=1000)
+    y[637] = 25.0
+    chosen = lttb(x, y, 50)
+    assert len(chosen) == 50 and chosen[0] == 0 and chosen[-1] == 999
+    assert np.all(np.diff(chosen) > 0)
+    assert 637 in chosen
+    np.testing.assert_array_equal(chosen, _reference_lttb(x, y, 50))
+
+
+def test_short_series_are_returned_whole():
+    np.testing.assert_array_equal(lttb(np.arange(5.0), np.arange(5.0), 10), np.arange(5))
+    np.testing.assert_array_equal(minmax(np.arange(5.0), 10), np.arange(5))
+
+
+def test_minmax_keeps_bucket_extremes():
+    y = np.sin(np.linspace(0, 20, 2000))
+    chosen = minmax(y, 42)
+    assert chosen[0] == 0 and chosen[-1] == 1999
+    assert len(chosen) <= 42
+    assert y[chosen].max() == y.max() and y[chosen].min() == y.min()
+
+
+def test_downsample_skips_nan_and_rejects_unknown_method():
+    time = pd.date_range('2024-08-01', periods=100, freq='h').values
+    values = np.arange(100, dtype=np.float64)
+    values[::7] = np.nan
+    chosen = downsample(time, values, 20)
+    assert np.isfinite(values[chosen]).all()
+    with pytest.raises(ValueError):
+        downsample(time, values, 20, method='mean')
+
+
+def test_encoding_rounds_to_significant_digits():
+    np.testing.assert_allclose(round_significant(np.array([12.3456, 0.0012345, -98766.0, 0.0, np.nan])),
+                               [12.35, 0.001234, -98770.0, 0.0, np.nan])
+    time = pd.date_range('2024-08-01', periods=3, freq='h').values
+    encoded = encode_series(time, np.array([1.23456, 2.0, 3.0]), np.array([0, 2]), time[0])
+    assert encoded == {'t': [0, 7200], 'v': [1.235, 3.0]}
+
+
+def test_pollutant_series_from_pyramid():
+    time = pd.date_range('2024-08-01', periods=500, freq='h')
+    values = np.linspace(0, 50, 500)[:, None, None] * np.ones((1, 2, 2))
+    data = xr.Dataset({'no2_conc': (('time', 'latitude', 'longitude'), values)},
+                      coords={'time': time, 'latitude': [49.0, 48.0], 'longitude': [2.0, 3.0]})
+    pyramid = TemporalPyramid(data, ['no2_conc'])
+    result = pollutant_series(pyramid, IdentityConverter(), 1, 0, {'no2_conc': 40}, 100, start='2024-08-05')
+    series = result['series']['no2_conc']
+    assert result['t0'] == '2024-08-05T00:00:00'
+    assert series['original_points'] == 500 - 96
+    assert len(series['t']) == len(series['v']) == 100
+    assert series['t'][0] == 0 and series['who_limit'] == 40
@@ -0,0 +1,114 @@
+from typing import Any, Dict
+
+import numpy as np
+import pandas as pd
+
+# Значащих цифр в передаваемых значениях: точнее, чем видно на графике, и вдвое короче repr(float)
+SIGNIFICANT_DIGITS = 4
+
+
+def lttb(x: np.ndarray, y: np.ndarray, points: int) -> np.ndarray:
+    """Индексы точек, выбранных Largest-Triangle-Three-Buckets.
+
+    Первая и последняя точки сохраняются, остальные делятся на points - 2 корзины;
+    из каждой берётся точка, образующая наибольший треугольник с точкой, выбранной
+    в предыдущей корзине, и средним следующей. Пики и провалы сохраняются лучше,
+    чем при прореживании или усреднении. Работа O(N).
+    """
+    n = len(x)
+    if points >= n or n <= 2:
+        return np.arange(n)
+    points = max(points, 3)
+    edges = np.floor(np.linspace(1, n - 1, points - 1)).astype(np.int64)
+    # Средние по корзинам нужны для следующей корзины: считаем все сразу
+    cum_x = np.concatenate([[0.0], np.cumsum(x)])
+    cum_y = np.concatenate([[0.0], np.cumsum(y)])
+    next_starts = np.r_[edges[1:-1], n - 1]
+    next_stops = np.r_[edges[2:], n]
+    avg_x = (cum_x[next_stops] - cum_x[next_starts]) / (next_stops - next_starts)
+    avg_y = (cum_y[next_stops] - cum_y[next_starts]) / (next_stops - next_starts)
+
+    selected = np.empty(points, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(points - 2):
+        lo, hi = edges[i], edges[i + 1]
+        area = np.abs((x[a] - avg_x[i]) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y[i] - y[a]))
+        a = lo + int(np.argmax(area))
+        selected[i + 1] = a
+    return selected
+
+
+def minmax(y: np.ndarray, points: int) -> np.ndarray:
+    """Индексы минимума и максимума в каждой из (points - 2) / 2 корзин плюс концы ряда."""
+    n = len(y)
+    if points >= n or n <= 2:
+        return np.arange(n)
+    buckets = max((points - 2) // 2, 1)
+    bucket = np.arange(n) * buckets // n
+    order = np.lexsort((y, bucket))
+    sorted_bucket = bucket[order]
+    first = np.r_[True, sorted_bucket[1:] != sorted_bucket[:-1]]
+    last = np.r_[sorted_bucket[1:] != sorted_bucket[:-1], True]
+    return np.unique(np.r_[0, order[first], order[last], n - 1])
+
+
+def downsample(time: np.ndarray, values: np.ndarray, points: int, method: str = 'lttb') -> np.ndarray:
+    """Индексы точек ряда (без NaN), оставляемых при сжатии до points точек."""
+    valid = np.flatnonzero(~np.isnan(values))
+    if method == 'lttb':
+        x = (time[valid] - time[0]) / np.timedelta64(1, 's') if len(valid) else np.zeros(0)
+        chosen = lttb(x.astype(np.float64), values[valid].astype(np.float64), points)
+    elif method == 'minmax':
+        chosen = minmax(values[valid], points)
+    else:
+        raise ValueError(f"Unknown downsampling method: {method}")
+    return valid[chosen]
+
+
+def round_significant(values: np.ndarray, digits: int = SIGNIFICANT_DIGITS) -> np.ndarray:
+    """Округление каждого значения до digits значащих цифр по его собственному порядку.
+
+    Малые значения ряда не обнуляются рядом с большими; нули, NaN и inf остаются как есть.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    magnitude = np.abs(values)
+    nonzero = np.isfinite(values) & (magnitude > 0)
+    decimals = np.zeros(values.shape, dtype=np.int64)
+    decimals[nonzero] = digits - 1 - np.floor(np.log10(magnitude[nonzero])).astype(np.int64)
+    # Множитель 10**|d| точен для целых степеней, поэтому делим при d < 0 вместо умножения на 10**d
+    factor = 10.0 ** np.abs(decimals)
+    return np.where(decimals >= 0, np.round(values * factor) / factor, np.round(values / factor) * factor)
+
+
+def encode_series(time: np.ndarray, values: np.ndarray, indices: np.ndarray,
+                  t0: np.datetime64) -> Dict[str, Any]:
+    # Время — целые секунды от общего t0, значения округлены: JSON в несколько раз короче
+    offsets = ((time[indices] - t0) // np.timedelta64(1, 's')).astype(np.int64)
+    return {
+        't': offsets.tolist(),
+        'v': round_significant(values[indices].astype(np.float64)).tolist(),
+    }
+
+
+def pollutant_series(pyramid, converter, lat_idx: int, lon_idx: int, who_limits: Dict[str, float],
+                     points: int, method: str = 'lttb', start=None, stop=None) -> Dict[str, Any]:
+    """Ряды всех загрязнителей в ячейке, сжатые до points точек каждый (см. downsample)."""
+    a, b = pyramid.window_indices(start, stop)
+    time = pyramid.time[a:b]
+    t0 = time[0] if len(time) else np.datetime64('1970-01-01T00:00:00')
+    series = {}
+    for i, pollutant in enumerate(pyramid.pollutants):
+        values = converter.convert(pyramid.stack[i, a:b, lat_idx, lon_idx].astype(np.float64), pollutant)
+        indices = downsample(time, values, points, method)
+        series[pollutant] = {
+            'who_limit': who_limits[pollutant],
+            'original_points': int(len(values)),
+            **encode_series(time, values, indices, t0),
+        }
+    return {
+        't0': pd.Timestamp(t0).isoformat(),
+        'time_unit': 's',
+        'method': method,
+        'series': series,
+    }
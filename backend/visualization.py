@@ -0,0 +1,171 @@
+from typing import Optional
+
+from abc import ABC, abstractmethod
+
+import numpy as np
+import xarray as xr
+import matplotlib.pyplot as plt
+import cartopy.crs as ccrs
+import cartopy.feature as cfeature
+
+from core import IPollutantConverter, Location
+
+
+class DataVisualizer:
+    def visualize(self, data_file: str, output_file: str = 'no2_concentration_paris.gif', pollutant: str = 'no2',
+                  latitude: float = 48.75, longitude: float = 2.35, delta: float = 0.35,
+                  level: Optional[float] = 500.0, fps: int = 2, start=None, stop=None) -> dict:
+        # Кадры читаются из файла по одному и сразу уходят в ffmpeg (см. animation.render_animation);
+        # по умолчанию — NO₂ вокруг Парижа на уровне 500 гПа
+        from animation import LazyFrames, render_animation
+
+        data_files = [data_file] if isinstance(data_file, str) else list(data_file)
+        frames = LazyFrames(data_files, pollutant, latitude, longitude, delta, level, start, stop)
+        try:
+            return render_animation(frames, output_file, fps=fps)
+        finally:
+            frames.close()
+
+
+class IVisualizer(ABC):
+    @abstractmethod
+    def visualize(self, data: xr.Dataset) -> None:
+        pass
+
+
+class ESGVisualizer(IVisualizer):
+    def __init__(self, pollutant_converter: IPollutantConverter, company_location: Location):
+        self.pollutant_converter = pollutant_converter
+        self.company_location = company_location
+        self.who_limits = {
+            'no2_conc': 40,  # NO2 (диоксид азота), среднегодовое значение
+            'so2_conc': 20,  # SO2 (диоксид серы), среднесуточное значение
+            'co_conc': 10000,  # CO (угарный газ), максимальное 8-часовое среднее значение
+            'pm10_conc': 20,  # PM10 (частицы размером до 10 мкм), среднегодовое значение
+            'pm2p5_conc': 10,  # PM2.5 (частицы размером до 2.5 мкм), среднегодовое значение
+            'o3_conc': 100,  # O3 (озон), максимальное 8-часовое среднее значение
+            'nh3_conc': 100,
+            # NH3 (аммиак), среднегодовое значение (это примерное значение, ВОЗ не устанавливает прямой лимит)
+        }
+
+    def visualize(self, data: xr.Dataset, lat: float, lon: float, delta: float = 0.1) -> None:
+        self.plot_pollutant_dynamics(data, lat, lon, delta)
+        # self.plot_who_comparison(data)
+        # self.plot_heatmaps(data)
+
+    def plot_pollutant_dynamics(self, data: xr.Dataset, lat: float, lon: float, delta: float = 0.1,
+                                output_file: str = 'pollutant_dynamics.png') -> None:
+        # Ограничиваем данные по заданной локации
+        lat_idx = abs(data.latitude - lat).argmin()
+        lon_idx = abs(data.longitude - lon).argmin()
+        data_subset = data.isel(latitude=lat_idx, longitude=lon_idx)
+
+        pollutants = [var for var in data_subset.variables if var in self.who_limits]
+        fig, axes = plt.subplots(len(pollutants), 1, figsize=(20, 6 * len(pollutants)))
+        if len(pollutants) == 1:
+            axes = [axes]
+
+        for i, pollutant in enumerate(pollutants):
+            if 'latitude' in data_subset.dims and 'longitude' in data_subset.dims:
+                data_series = data_subset[pollutant].mean(dim=['latitude', 'longitude'])
+            else:
+                data_series = data_subset[pollutant]
+            if 'pressure_level' in data_series.dims:
+                data_series = data_series.mean(dim='pressure_level')
+            data_series = self.pollutant_converter.convert(data_series, pollutant)
+
+            if np.isnan(data_series.values).all():
+                print(f"Warning: All values for {pollutant} are NaN. Skipping this pollutant.")
+                continue
+
+            data_series.plot(ax=axes[i], x='time')
+            axes[i].axhline(y=self.who_limits[pollutant], color='r', linestyle='--', label='WHO Limit')
+            axes[i].set_title(
+                f'{pollutant.upper()} Average Concentration Over Time\nLocation: {lat:.2f}°N, {lon:.2f}°E (±{delta:.2f}°)')
+            axes[i].set_ylabel('Concentration (μg/m³)')
+            axes[i].legend()
+
+        plt.tight_layout()
+        plt.savefig(output_file)
+        plt.close()
+
+    def plot_who_comparison(self, data: xr.Dataset, output_file: str = 'who_comparison.png') -> None:
+        pollutants = [var for var in data.variables if var in self.who_limits]
+        fig, ax = plt.subplots(figsize=(12, 6))
+
+        avg_concentrations = []
+        for pollutant in pollutants:
+            data_avg = data[pollutant].mean(dim=['latitude', 'longitude', 'time'])
+            if 'pressure_level' in data_avg.dims:
+                data_avg = data_avg.mean(dim='pressure_level')
+            data_avg = self.pollutant_converter.convert(data_avg, pollutant)
+
+            if np.isnan(data_avg.values).all():
+                print(f"Warning: All values for {pollutant} are NaN. Skipping this pollutant.")
+                avg_concentrations.append(0)
+            else:
+                avg_concentrations.append(data_avg.values)
+
+        x = range(len(pollutants))
+        ax.bar(x, avg_concentrations, align='center', alpha=0.8, label='Average Concentration')
+        ax.bar(x, [self.who_limits[p] for p in pollutants], align='center', alpha=0.5, label='WHO Limit')
+
+        ax.set_ylabel('Concentration (μg/m³)')
+        ax.set_title('Average Pollutant Concentrations vs WHO Limits')
+        ax.set_xticks(x)
+        ax.set_xticklabels(pollutants)
+        ax.legend()
+
+        plt.tight_layout()
+        plt.savefig(output_file)
+        plt.close()
+
+    def plot_heatmaps(self, data: xr.Dataset, output_file: str = 'pollution_heatmaps.png',
+                      resolution: Optional[float] = None) -> None:
+        # resolution (в градусах) — рисуем самый грубый уровень SpatialPyramid, который ему удовлетворяет
+        pollutants = [var for var in data.variables if var in self.who_limits]
+        spatial_pyramid = None
+        if resolution is not None:
+            from pyramid import SpatialPyramid
+            spatial_pyramid = SpatialPyramid.for_dataset(data, pollutants)
+        fig, axes = plt.subplots(len(pollutants), 1, figsize=(20, 10 * len(pollutants)),
+                                 subplot_kw={'projection': ccrs.PlateCarree()})
+        if len(pollutants) == 1:
+            axes = [axes]
+
+        for i, pollutant in enumerate(pollutants):
+            if spatial_pyramid is not None:
+                data_subset = spatial_pyramid.field(pollutant, resolution)
+            else:
+                data_subset = data[pollutant]
+                if 'pressure_level' in data_subset.dims:
+                    data_subset = data_subset.mean(dim='pressure_level')
+                data_subset = data_subset.mean(dim='time')
+            data_subset = self.pollutant_converter.convert(data_subset, pollutant)
+
+            if np.isnan(data_subset.values).all():
+                print(f"Warning: All values for {pollutant} are NaN. Skipping this pollutant.")
+                continue
+
+            im = data_subset.plot(
+                ax=axes[i],
+                transform=ccrs.PlateCarree(),
+                cmap='viridis',
+                add_colorbar=False
+            )
+
+            axes[i].set_global()
+            axes[i].coastlines()
+            axes[i].add_feature(cfeature.BORDERS, linestyle=':')
+
+            company_marker = plt.Circle((self.company_location.longitude, self.company_location.latitude),
+                                        radius=0.1, color='red', transform=ccrs.PlateCarree())
+            axes[i].add_artist(company_marker)
+
+            plt.colorbar(im, ax=axes[i], orientation='vertical', pad=0.05,
+                         label=f'{pollutant.upper()} Concentration (μg/m³)')
+            axes[i].set_title(f'{pollutant.upper()} Heatmap')
+
+        plt.tight_layout()
+        plt.savefig(output_file)
+        plt.close()
@@ -0,0 +1,216 @@
+import hashlib
+import json
+import os
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from scipy import sparse
+
+from metrics import timed
+
+# Точек на сторону ячейки при растеризации: доля покрытия ячейки полигоном считается по SUPERSAMPLE² точкам
+SUPERSAMPLE = 16
+
+# Полигон — список колец [(lon, lat), ...]: первое внешнее, остальные дыры; зона — список полигонов
+Polygon = List[np.ndarray]
+
+
+def load_geojson(path: str, name_property: str = 'name') -> Dict[str, List[Polygon]]:
+    """Зоны из GeoJSON FeatureCollection с геометриями Polygon и MultiPolygon.
+
+    Имя зоны берётся из свойства name_property; объекты с одинаковым именем
+    объединяются в одну зону.
+    """
+    with open(path, encoding='utf-8') as f:
+        collection = json.load(f)
+    zones: Dict[str, List[Polygon]] = {}
+    for i, feature in enumerate(collection.get('features', [])):
+        geometry = feature.get('geometry') or {}
+        if geometry.get('type') == 'Polygon':
+            polygons = [geometry['coordinates']]
+        elif geometry.get('type') == 'MultiPolygon':
+            polygons = geometry['coordinates']
+        else:
+            continue
+        name = str((feature.get('properties') or {}).get(name_property, i))
+        zones.setdefault(name, []).extend(
+            [np.asarray(ring, dtype=np.float64)[:, :2] for ring in polygon] for polygon in polygons
+        )
+    return zones
+
+
+def grid_version(latitude: np.ndarray, longitude: np.ndarray) -> str:
+    digest = hashlib.sha256()
+    for axis in (latitude, longitude):
+        digest.update(np.ascontiguousarray(axis, dtype=np.float64).tobytes())
+    return digest.hexdigest()[:16]
+
+
+def _cell_edges(centers: np.ndarray) -> np.ndarray:
+    # Границы ячеек — середины между центрами, крайние ячейки симметричны соседним
+    centers = np.asarray(centers, dtype=np.float64)
+    if len(centers) == 1:
+        return np.array([centers[0] - 0.5, centers[0] + 0.5])
+    middle = (centers[1:] + centers[:-1]) / 2
+    return np.r_[2 * centers[0] - middle[0], middle, 2 * centers[-1] - middle[-1]]
+
+
+def _inside(polygons: List[Polygon], points: np.ndarray) -> np.ndarray:
+    # Правило чётности по кольцам полигона (дыры вычитаются), объединение по полигонам.
+    # matplotlib импортируется здесь: api импортирует zonal при старте, а маски строятся редко и кэшируются
+    from matplotlib.path import Path
+
+    inside = np.zeros(len(points), dtype=bool)
+    for rings in polygons:
+        hit = np.zeros(len(points), dtype=bool)
+        for ring in rings:
+            hit ^= Path(ring).contains_points(points)
+        inside |= hit
+    return inside
+
+
+def _bbox(polygons: List[Polygon]) -> Tuple[float, float, float, float]:
+    exteriors = np.concatenate([rings[0] for rings in polygons])
+    return exteriors[:, 0].min(), exteriors[:, 0].max(), exteriors[:, 1].min(), exteriors[:, 1].max()
+
+
+def rasterize(zones: Dict[str, List[Polygon]], latitude: np.ndarray, longitude: np.ndarray,
+              supersample: int = SUPERSAMPLE) -> sparse.csr_matrix:
+    """Веса зона × ячейка (ячейки в порядке latitude, longitude, как в reshape поля).
+
+    Вес — площадь части ячейки внутри зоны: доля покрытия (по supersample² точкам)
+    на площадь ячейки, пропорциональную косинусу широты. Долготы полигонов и сетки
+    должны быть в одной конвенции.
+    """
+    lat_edges, lon_edges = _cell_edges(latitude), _cell_edges(longitude)
+    lat_lo, lat_hi = np.minimum(lat_edges[:-1], lat_edges[1:]), np.maximum(lat_edges[:-1], lat_edges[1:])
+    lon_lo, lon_hi = np.minimum(lon_edges[:-1], lon_edges[1:]), np.maximum(lon_edges[:-1], lon_edges[1:])
+    # Площадь ячейки на сфере (в градусах² на экваторе): разность синусов широт границ
+    lat_area = np.abs(np.sin(np.radians(lat_hi)) - np.sin(np.radians(lat_lo))) * np.degrees(1)
+    lon_width = lon_hi - lon_lo
+    offsets = (np.arange(supersample) + 0.5) / supersample
+
+    rows, cols, values = [], [], []
+    for z, polygons in enumerate(zones.values()):
+        lon_min, lon_max, lat_min, lat_max = _bbox(polygons)
+        i = np.flatnonzero((lat_hi > lat_min) & (lat_lo < lat_max))
+        j = np.flatnonzero((lon_hi > lon_min) & (lon_lo < lon_max))
+        if len(i) == 0 or len(j) == 0:
+            continue
+        # Подточки всех ячеек-кандидатов: (ячейка широты, ячейка долготы, подточка широты, подточка долготы)
+        sub_lat = lat_lo[i, None] + offsets[None, :] * (lat_hi - lat_lo)[i, None]
+        sub_lon = lon_lo[j, None] + offsets[None, :] * lon_width[j, None]
+        points = np.stack(np.broadcast_arrays(sub_lon[None, :, None, :], sub_lat[:, None, :, None]), axis=-1)
+        coverage = _inside(polygons, points.reshape(-1, 2)).reshape(points.shape[:-1]).mean(axis=(2, 3))
+        ii, jj = np.nonzero(coverage)
+        rows.append(np.full(len(ii), z))
+        cols.append(i[ii] * len(longitude) + j[jj])
+        values.append(coverage[ii, jj] * lat_area[i[ii]] * lon_width[j[jj]])
+
+    shape = (len(zones), len(latitude) * len(longitude))
+    if not rows:
+        return sparse.csr_matrix(shape, dtype=np.float64)
+    return sparse.csr_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))), shape=shape)
+
+
+class ZonalStatistics:
+    """Средние по произвольным полигонам (муниципалитеты, страны) с весами по площади.
+
+    Полигоны растеризуются в разреженную матрицу весов зона × ячейка один раз на
+    версию сетки (и при cache_dir сохраняются на диск), после чего средние всех зон
+    по всем загрязнителям — одно произведение разреженной матрицы на плотную
+    (ячейки × столбцы, где столбцы — загрязнители и, при необходимости, шаги времени).
+    """
+
+    def __init__(self, zones: Dict[str, List[Polygon]], cache_dir: Optional[str] = None,
+                 version: Optional[str] = None):
+        self.zones = zones
+        self.names = list(zones)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.cache_dir = cache_dir
+        self.version = version
+        self.bboxes = np.array([_bbox(polygons) for polygons in zones.values()]).reshape(-1, 4)
+        self._weights: Dict[str, sparse.csr_matrix] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_geojson(cls, path: str, name_property: str = 'name',
+                     cache_dir: Optional[str] = None) -> 'ZonalStatistics':
+        with open(path, 'rb') as f:
+            version = hashlib.sha256(f.read() + name_property.encode()).hexdigest()[:16]
+        return cls(load_geojson(path, name_property), cache_dir=cache_dir, version=version)
+
+    def weights(self, latitude: np.ndarray, longitude: np.ndarray) -> sparse.csr_matrix:
+        key = grid_version(latitude, longitude)
+        with self._lock:
+            if key not in self._weights:
+                self._weights[key] = self._load_or_rasterize(key, latitude, longitude)
+            return self._weights[key]
+
+    def _load_or_rasterize(self, key: str, latitude: np.ndarray, longitude: np.ndarray) -> sparse.csr_matrix:
+        path = None
+        if self.cache_dir and self.version:
+            path = os.path.join(self.cache_dir, f'zones-{self.version}-{key}.npz')
+            if os.path.exists(path):
+                return sparse.load_npz(path).tocsr()
+        with timed('zonal.rasterize'):
+            weights = rasterize(self.zones, latitude, longitude)
+        if path is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+            sparse.save_npz(tmp_path, weights)
+            os.replace(tmp_path, path)
+        return weights
+
+    def means(self, values: np.ndarray, latitude: np.ndarray, longitude: np.ndarray,
+              zones: Optional[Sequence[str]] = None) -> np.ndarray:
+        """Средние по зонам для values (..., latitude, longitude): результат (зона, ...).
+
+        NaN не учитываются: их вес исключается и из числителя, и из знаменателя.
+        """
+        sums, totals = self.sums(values, latitude, longitude, zones)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return sums / totals
+
+    def sums(self, values: np.ndarray, latitude: np.ndarray, longitude: np.ndarray,
+             zones: Optional[Sequence[str]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Взвешенные суммы и суммы весов без NaN (зона, ...): складываются по непересекающимся сеткам."""
+        weights = self.weights(latitude, longitude)
+        if zones is not None:
+            weights = weights[[self.index[name] for name in zones]]
+        lead = values.shape[:-2]
+        columns = values.reshape(-1, values.shape[-2] * values.shape[-1]).T  # (ячейки, столбцы)
+        valid = ~np.isnan(columns)
+        with timed('zonal.means'):
+            sums = weights @ np.where(valid, columns, 0.0)
+            totals = weights @ valid.astype(np.float64)
+        shape = (weights.shape[0],) + lead
+        return sums.reshape(shape), totals.reshape(shape)
+
+    def pyramid_means(self, pyramids, zones: Optional[Sequence[str]] = None) -> np.ndarray:
+        """Средние по времени концентрации (зона, загрязнитель) по базовому уровню SpatialPyramid.
+
+        pyramids — одна пирамида или несколько по непересекающимся сеткам (блоки данных):
+        зона, попадающая в несколько блоков, усредняется по всем её ячейкам.
+        """
+        if not isinstance(pyramids, (list, tuple)):
+            pyramids = [pyramids]
+        sums = totals = 0.0
+        for pyramid in pyramids:
+            _, level_sums, counts, latitude, longitude = pyramid.levels[0]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                field = level_sums / counts
+            block_sums, block_totals = self.sums(field, latitude, longitude, zones)
+            sums, totals = sums + block_sums, totals + block_totals
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return sums / totals
+
+    def zones_containing(self, lat: float, lon: float) -> List[str]:
+        """Зоны, внутри которых лежит точка, от наименьшей (по охватывающему прямоугольнику) к наибольшей."""
+        lon_min, lon_max, lat_min, lat_max = self.bboxes.T if len(self.bboxes) else (np.zeros(0),) * 4
+        candidates = np.flatnonzero((lon_min <= lon) & (lon <= lon_max) & (lat_min <= lat) & (lat <= lat_max))
+        point = np.array([[lon, lat]])
+        found = [z for z in candidates if _inside(self.zones[self.names[z]], point)[0]]
+        areas = (lon_max - lon_min) * (lat_max - lat_min)
+        return [self.names[z] for z in sorted(found, key=lambda z: areas[z])]
@@ -7,9 +7,13 @@ import streamlit as st
 import pandas as pd
 import plotly.express as px
 import requests
+import hashlib
 import json
 import os
 
+import api_client
+from scoring import ScoringEngine, air_pollution_score
+
 # Set page config
 st.set_page_config(
     page_title="ESG Dashboard",
@@ -18,83 +22,148 @@ st.set_page_config(
     initial_sidebar_state="expanded",
 )
 
+DATA_FILE = 'esg_data.json'
+
+
 # Function to fetch data from API and save it
 def fetch_and_save_data():
-    api_endpoints = {
-        'esg_results': 'http://35.228.76.200:8000/esg_results',
-        'interpretation': 'http://35.228.76.200:8000/interpretation',
-        'comparison': 'http://35.228.76.200:8000/comparison'
-    }
-
     companies = [
-        {"name": "TechInnovate", "latitude": 51.5074, "longitude": -0.1278, "size": "Large", "industry": "Technology"},
-        {"name": "EcoSolutions", "latitude": 48.8566, "longitude": 2.3522, "size": "Medium",
+        {"name": "TechInnovate", "latitude": 51.5074, "longitude": -0.1278, "size": "Large", "country": "GB",
+         "industry": "Technology"},
+        {"name": "EcoSolutions", "latitude": 48.8566, "longitude": 2.3522, "size": "Medium", "country": "FR",
          "industry": "Environmental"},
-        {"name": "GreenEnergy", "latitude": 52.5200, "longitude": 13.4050, "size": "Large", "industry": "Energy"},
-        {"name": "BioInnovate", "latitude": 41.9028, "longitude": 12.4964, "size": "Small",
+        {"name": "GreenEnergy", "latitude": 52.5200, "longitude": 13.4050, "size": "Large", "country": "DE",
+         "industry": "Energy"},
+        {"name": "BioInnovate", "latitude": 41.9028, "longitude": 12.4964, "size": "Small", "country": "IT",
          "industry": "Biotechnology"},
-        {"name": "SmartManufacturing", "latitude": 59.3293, "longitude": 18.0686, "size": "Large",
+        {"name": "SmartManufacturing", "latitude": 59.3293, "longitude": 18.0686, "size": "Large", "country": "SE",
          "industry": "Manufacturing"},
-        {"name": "CleanWaterTech", "latitude": 52.3676, "longitude": 4.9041, "size": "Medium",
+        {"name": "CleanWaterTech", "latitude": 52.3676, "longitude": 4.9041, "size": "Medium", "country": "NL",
          "industry": "Water Treatment"},
-        {"name": "SustainableFashion", "latitude": 55.6761, "longitude": 12.5683, "size": "Small",
+        {"name": "SustainableFashion", "latitude": 55.6761, "longitude": 12.5683, "size": "Small", "country": "DK",
          "industry": "Retail"},
-        {"name": "GreenTransport", "latitude": 48.2082, "longitude": 16.3738, "size": "Medium",
+        {"name": "GreenTransport", "latitude": 48.2082, "longitude": 16.3738, "size": "Medium", "country": "AT",
          "industry": "Transportation"},
-        {"name": "EcoAgriculture", "latitude": 50.8503, "longitude": 4.3517, "size": "Large",
+        {"name": "EcoAgriculture", "latitude": 50.8503, "longitude": 4.3517, "size": "Large", "country": "BE",
          "industry": "Agriculture"},
-        {"name": "RenewableMaterials", "latitude": 45.4642, "longitude": 9.1900, "size": "Small",
+        {"name": "RenewableMaterials", "latitude": 45.4642, "longitude": 9.1900, "size": "Small", "country": "IT",
          "industry": "Materials"},
-        {"name": "CircularEconomy", "latitude": 40.4168, "longitude": -3.7038, "size": "Medium",
+        {"name": "CircularEconomy", "latitude": 40.4168, "longitude": -3.7038, "size": "Medium", "country": "ES",
          "industry": "Recycling"},
-        {"name": "EfficientBuildings", "latitude": 52.2297, "longitude": 21.0122, "size": "Large",
+        {"name": "EfficientBuildings", "latitude": 52.2297, "longitude": 21.0122, "size": "Large", "country": "PL",
          "industry": "Construction"},
-        {"name": "SustainableFinance", "latitude": 47.3769, "longitude": 8.5417, "size": "Large",
+        {"name": "SustainableFinance", "latitude": 47.3769, "longitude": 8.5417, "size": "Large", "country": "CH",
          "industry": "Finance"},
-        {"name": "EcoTourism", "latitude": 38.7223, "longitude": -9.1393, "size": "Small", "industry": "Tourism"},
-        {"name": "HealthTech", "latitude": 55.7558, "longitude": 37.6173, "size": "Medium", "industry": "Healthcare"}
+        {"name": "EcoTourism", "latitude": 38.7223, "longitude": -9.1393, "size": "Small", "country": "PT",
+         "industry": "Tourism"},
+        {"name": "HealthTech", "latitude": 55.7558, "longitude": 37.6173, "size": "Medium", "country": "RU",
+         "industry": "Healthcare"}
     ]
 
-    all_data = []
-
-    for company in companies:
-        company_data = {
-            "Company Name": company["name"],
-            "Size": company["size"],
-            "Industry": company["industry"]
-        }
-        api_data = {
-            "latitude": company["latitude"],
-            "longitude": company["longitude"],
-            "delta": 0.1
-        }
-
-        for key, url in api_endpoints.items():
-            try:
-                response = requests.post(url, json=api_data)
-                response.raise_for_status()
-                company_data[key] = response.json()
-            except requests.exceptions.RequestException as e:
-                print(f"Error fetching data for {company['name']}: {e}")
-                break
-
-        if len(company_data) == 6:  # If we successfully got all 3 API responses + name, size, industry
-            all_data.append(company_data)
-
-    # Save data to file
-    with open('esg_data.json', 'w') as f:
-        json.dump(all_data, f)
+    results = {}
+    progress = st.empty()
+
+    # Results are streamed per company as soon as the backend has computed them
+    try:
+        for row in api_client.stream_site_results(companies):
+            company = companies[row["index"]]
+            if "error" in row:
+                print(f"Error fetching data for {company['name']}: {row['error']}")
+                continue
+
+            results[row["index"]] = {
+                "Company Name": company["name"],
+                "Size": company["size"],
+                "Industry": company["industry"],
+                "Country": company["country"],
+                "esg_results": row["esg_results"],
+                "interpretation": row["interpretation"],
+                "comparison": row["comparison"],
+            }
+            progress.dataframe(pd.DataFrame([
+                {
+                    'Company Name': item['Company Name'],
+                    'Pollution Index': item['esg_results']['pollution_index'],
+                    'Industry': item['Industry'],
+                    'Company Size': item['Size'],
+                }
+                for item in results.values()
+            ]))
+    except requests.exceptions.RequestException as e:
+        # Partial results are shown but not saved, so the next run fetches everything again
+        print(f"Error fetching data: {e}")
+        st.warning(f"Fetched {len(results)} of {len(companies)} companies: {e}")
+        progress.empty()
+        return [results[i] for i in sorted(results)]
+    progress.empty()
+
+    # Rows arrive in completion order; they are saved in the order of the company list.
+    # Score updates are pulled after change 0, i.e. all of them
+    all_data = [results[i] for i in sorted(results)]
+    save_data(all_data, 0)
 
     return all_data
 
 
+def save_data(companies, seq):
+    # seq is the last /scores change already applied to the companies. The file is replaced
+    # in one step, so an interrupted write never leaves a truncated esg_data.json behind
+    tmp_file = f"{DATA_FILE}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump({"seq": seq, "companies": companies}, f)
+    os.replace(tmp_file, DATA_FILE)
+
+
+def _site(item):
+    location = item['comparison']['comparison']['location']
+    return {"company_id": item['Company Name'], "latitude": location['latitude'], "longitude": location['longitude']}
+
+
+# The backend rescores registered companies when ingested data changes their scores;
+# only those updates are pulled, instead of fetching every company again
+def refresh_scores(companies, seq):
+    try:
+        if not st.session_state.get('scores_registered'):
+            api_client.register_companies([_site(item) for item in companies])
+            st.session_state['scores_registered'] = True
+        result = api_client.scores(since=seq)
+    except requests.exceptions.RequestException as e:
+        st.sidebar.warning(f"Score updates unavailable: {e}")
+        return companies
+
+    by_name = {item['Company Name']: item for item in companies}
+    for score in result['scores']:
+        item = by_name.get(score['company_id'])
+        if item is None or score['pollution_index'] is None:
+            continue
+        rescored = score['result']
+        item['esg_results'] = dict(item['esg_results'], pollution_index=rescored['pollution_index'],
+                                   normalized_concentrations=rescored['normalized_concentrations'],
+                                   pollution_trend=rescored['pollution_trend'])
+        item['interpretation'] = {"interpretation": rescored['interpretation']}
+    if result['seq'] != seq:
+        save_data(companies, result['seq'])
+    return companies
+
+
 # Function to load data from file or fetch if file doesn't exist
 def get_data():
-    if os.path.exists('esg_data.json'):
-        with open('esg_data.json', 'r') as f:
-            return json.load(f)
+    if os.path.exists(DATA_FILE):
+        with open(DATA_FILE, 'r') as f:
+            saved = json.load(f)
+        # Files saved before score updates were pulled hold just the list of companies
+        if isinstance(saved, list):
+            saved = {"seq": 0, "companies": saved}
+        return refresh_scores(saved['companies'], saved['seq'])
     else:
-        return fetch_and_save_data()
+        data = fetch_and_save_data()
+        # A failed fetch is not saved, and neither are score updates applied to it
+        return refresh_scores(data, 0) if os.path.exists(DATA_FILE) else data
+
+
+@st.cache_resource
+def get_scoring_engine():
+    return ScoringEngine()
 
 
 # Load data
@@ -108,11 +177,82 @@ df = pd.DataFrame([
         'Location': f"{item['comparison']['comparison']['location']['latitude']}, {item['comparison']['comparison']['location']['longitude']}",
         'Industry': item['Industry'],
         'Company Size': item['Size'],
-        'ESG Score': 100 - (item['esg_results']['pollution_index'] * 100),  # Inverse of pollution index
+        'Country': item.get('Country', 'Unknown'),
     }
     for item in data
 ])
 
+# Composite scores for the whole portfolio in one pass (see Methodolody.md);
+# only the satellite air-quality indicator is available for now
+scores = get_scoring_engine().score(
+    df['Industry'].tolist(),
+    {'Air Pollution': air_pollution_score(df['Pollution Index'].to_numpy())},
+)
+df['E Score'] = scores['E'] * 100
+df['ESG Score'] = scores['ESG'] * 100
+
+
+# Peer ranking lives in the backend so percentiles stay consistent across sessions
+# and are updated incrementally instead of re-sorting the table on every rerun
+def add_peer_percentiles(df, by):
+    scores = [
+        {"company_id": row['Company Name'], "score": row['ESG Score'], "industry": row['Industry'],
+         "size": row['Company Size'], "country": row['Country']}
+        for _, row in df.iterrows()
+    ]
+    # Reruns (filter changes and the like) only query; the index is updated when the scores change
+    scores_hash = hashlib.sha256(json.dumps(scores, sort_keys=True).encode()).hexdigest()
+    try:
+        if st.session_state.get('peer_scores_hash') != scores_hash:
+            api_client.update_peer_scores(scores)
+            st.session_state['peer_scores_hash'] = scores_hash
+        results = api_client.peer_percentiles(df['Company Name'], by)
+    except requests.exceptions.RequestException as e:
+        st.sidebar.warning(f"Peer ranking unavailable: {e}")
+        return df
+    df['Peer Percentile'] = [result['percentile'] if result else None for result in results]
+    df['Peers'] = [result['peers'] if result else None for result in results]
+    return df
+
+
+HISTORY_WINDOWS = {"Daily": "D", "Weekly": "W", "Monthly": "M"}
+
+
+# One /timeline call returns every window for every company; the backend computes
+# all windows from prefix sums along time instead of one snapshot per window
+@st.cache_data(ttl=3600)
+def get_score_history(df, freq):
+    sites = [
+        dict(zip(("latitude", "longitude"), map(float, location.split(", "))))
+        for location in df['Location']
+    ]
+    try:
+        timeline = api_client.timeline(sites, freq=freq)
+    except requests.exceptions.RequestException as e:
+        st.sidebar.warning(f"Score history unavailable: {e}")
+        return pd.DataFrame()
+
+    engine = get_scoring_engine()
+    rows = []
+    for (_, company), site in zip(df.iterrows(), timeline['sites']):
+        pollution_index = pd.Series(site['pollution_index'], dtype=float).to_numpy()
+        scores = engine.score([company['Industry']] * len(pollution_index),
+                              {'Air Pollution': air_pollution_score(pollution_index)})
+        for window_start, pi, esg in zip(timeline['window_start'], pollution_index, scores['ESG'] * 100):
+            rows.append({'Company Name': company['Company Name'], 'Industry': company['Industry'],
+                         'Window Start': pd.Timestamp(window_start), 'Pollution Index': pi, 'ESG Score': esg})
+    return pd.DataFrame(rows)
+
+
+@st.cache_data(ttl=3600)
+def get_pollutant_series(lat, lon):
+    try:
+        return api_client.timeseries(lat, lon, points=500)
+    except requests.exceptions.RequestException as e:
+        print(f"Error fetching time series: {e}")
+        return {}
+
+
 # Streamlit app
 st.title("European ESG Data Dashboard")
 st.write("Collabse Open ESG reporting for European Companies")
@@ -130,6 +270,14 @@ selected_industry = st.sidebar.multiselect(
     default=df['Industry'].unique()
 )
 
+peer_dimensions = st.sidebar.multiselect(
+    "Compare peers by",
+    options=["industry", "size", "country"],
+    default=["industry"],
+)
+df = add_peer_percentiles(df, peer_dimensions)
+history_window = st.sidebar.selectbox("Score history window", options=list(HISTORY_WINDOWS), index=1)
+
 # Filter dataframe
 filtered_df = df[
     (df['Company Size'].isin(selected_size)) &
@@ -151,6 +299,33 @@ fig_esg = px.bar(
 )
 st.plotly_chart(fig_esg, use_container_width=True)
 
+score_history = get_score_history(df, HISTORY_WINDOWS[history_window])
+if not score_history.empty:
+    st.write("### ESG Score History")
+    fig_history = px.line(
+        score_history[score_history['Company Name'].isin(filtered_df['Company Name'])],
+        x='Window Start',
+        y='ESG Score',
+        color='Company Name',
+        markers=True,
+        title=f"{history_window} ESG Score by Company",
+        hover_data=['Industry', 'Pollution Index']
+    )
+    st.plotly_chart(fig_history, use_container_width=True)
+
+if 'Peer Percentile' in filtered_df:
+    st.write("### Peer Percentile")
+    fig_peers = px.bar(
+        filtered_df,
+        x='Company Name',
+        y='Peer Percentile',
+        color='Industry',
+        title="ESG Score percentile among peers (" + (" × ".join(peer_dimensions) or "all companies") + ")",
+        hover_data=['Company Size', 'Country', 'Peers']
+    )
+    fig_peers.update_layout(yaxis_range=[0, 100])
+    st.plotly_chart(fig_peers, use_container_width=True)
+
 st.write("### Pollution Index")
 fig_pollution = px.bar(
     filtered_df,
@@ -182,6 +357,20 @@ for company in filtered_df['Company Name']:
     fig_trend = px.line(pollution_trend, x='Pollutant', y='Trend', title=f"Pollution Trend - {company}")
     st.plotly_chart(fig_trend, use_container_width=True)
 
+    # Pollutant Dynamics, downsampled by the backend for interactive plotting
+    location = company_data['comparison']['comparison']['location']
+    series = get_pollutant_series(location['latitude'], location['longitude'])
+    if series:
+        st.write("#### Pollutant Dynamics")
+        dynamics = pd.concat([
+            frame.assign(Pollutant=pollutant.replace("_conc", "").upper(), **{'Normalized': frame['value'] / limit})
+            for pollutant, (frame, limit) in series.items()
+        ])
+        fig_dynamics = px.line(dynamics, x='time', y='Normalized', color='Pollutant',
+                               title=f"Concentrations relative to WHO limits - {company}", render_mode='webgl')
+        fig_dynamics.add_hline(y=1, line_dash="dash", line_color="red", annotation_text="WHO Limit")
+        st.plotly_chart(fig_dynamics, use_container_width=True)
+
     # Interpretation
     st.write("#### Interpretation")
     st.write(company_data['interpretation']['interpretation'])
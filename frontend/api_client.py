@@ -0,0 +1,94 @@
+import json
+import os
+
+import pandas as pd
+import requests
+
+API_URL = os.environ.get("ESG_API_URL", "http://35.228.76.200:8000")
+
+# (connect, read) timeouts in seconds. The read timeout applies between streamed
+# lines, not to the whole response.
+REQUEST_TIMEOUT = (5, 120)
+
+
+def post(endpoint, payload):
+    response = requests.post(f"{API_URL}/{endpoint}", json=payload, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+
+def _stream(endpoint, payload):
+    with requests.post(f"{API_URL}/{endpoint}", json=payload, stream=True, timeout=REQUEST_TIMEOUT) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if line:
+                yield json.loads(line)
+
+
+def stream_site_results(sites):
+    """Yields per-site results from /sites/stream as soon as each site is computed.
+
+    Rows arrive in completion order; row["index"] is the position in `sites`.
+    """
+    payload = {"locations": [
+        {"latitude": site["latitude"], "longitude": site["longitude"], "delta": site.get("delta", 0.1)}
+        for site in sites
+    ]}
+    yield from _stream("sites/stream", payload)
+
+
+def stream_region_sweep(north, south, west, east, step=0.5, delta=0.1):
+    payload = {"north": north, "south": south, "west": west, "east": east, "step": step, "delta": delta}
+    yield from _stream("region_sweep/stream", payload)
+
+
+def update_peer_scores(scores):
+    """Upserts {"company_id", "score", "industry", "size", "country"} records in the backend peer index."""
+    response = requests.put(f"{API_URL}/peers/scores", json={"scores": scores}, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+
+def register_companies(companies):
+    """Registers {"company_id", "latitude", "longitude"} records with the backend score store.
+
+    New and moved companies are scored right away; the rest are rescored only when ingested data changes them.
+    """
+    response = requests.put(f"{API_URL}/scores/companies", json={"companies": companies}, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+
+def scores(since=0):
+    """{"seq", "scores"} from /scores: latest results of companies rescored after change `since`."""
+    response = requests.get(f"{API_URL}/scores", params={"since": since}, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+
+def peer_percentiles(company_ids, by=("industry", "size", "country")):
+    return post("peers/percentiles", {"company_ids": list(company_ids), "by": list(by)})["results"]
+
+
+def timeline(sites, freq=None, window=None, step=None):
+    """Windowed pollution index series from /timeline for each {"latitude", "longitude"} in `sites`.
+
+    Either freq ("D", "W", "M", "Y") or a sliding window ("30D", with an optional step) is required.
+    """
+    payload = {"locations": [{"latitude": site["latitude"], "longitude": site["longitude"]} for site in sites],
+               "freq": freq, "window": window, "step": step}
+    return post("timeline", payload)
+
+
+def timeseries(latitude, longitude, points=1000, method="lttb", start=None, stop=None):
+    """Downsampled per-pollutant series from /timeseries as {pollutant: (DataFrame[time, value], who_limit)}."""
+    payload = {"latitude": latitude, "longitude": longitude, "points": points, "method": method,
+               "start": start, "stop": stop}
+    result = post("timeseries", payload)
+    t0 = pd.Timestamp(result["t0"])
+    return {
+        pollutant: (pd.DataFrame({"time": t0 + pd.to_timedelta(series["t"], unit=result["time_unit"]),
+                                  "value": series["v"]}),
+                    series["who_limit"])
+        for pollutant, series in result["series"].items()
+    }
@@ -0,0 +1,149 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from openai import OpenAI
+
+SYSTEM_PROMPT = (
+    "You are an AI assistant specialized in ESG (Environmental, Social, and Governance) and CSR "
+    "(Corporate Social Responsibility) topics. Provide accurate and helpful information on these subjects."
+)
+
+USER_PROMPT = (
+    "Answer the question: {question}. If it's not related to ESG or CSR topics, politely inform that the question "
+    "should be related to those topics and provide a brief explanation of what ESG and CSR are."
+)
+
+SUMMARY_PROMPT = (
+    "Summarize the conversation below in a few sentences, keeping the facts, companies and numbers "
+    "the user may refer back to.\n\n{conversation}"
+)
+
+# Any OpenAI-compatible endpoint works; base_url=None means api.openai.com
+PROVIDERS = {
+    "groq": {"base_url": "https://api.groq.com/openai/v1", "model": "llama3-8b-8192"},
+    "openai": {"base_url": None, "model": "gpt-4o-mini"},
+}
+
+# Recent messages sent verbatim; older ones are folded into a running summary
+HISTORY_MESSAGES = 6
+CACHE_SIZE = 256
+
+
+def normalize_question(question):
+    return re.sub(r"\s+", " ", question).strip().rstrip("?!. ").casefold()
+
+
+class ChatSession:
+    """Conversation state kept per user (e.g. in st.session_state)."""
+
+    def __init__(self):
+        self.messages = []
+        self.summary = ""
+        self.summarized = 0  # messages[:summarized] are covered by the summary
+
+
+class ChatBackend:
+    """Chat completions over one reused OpenAI-compatible client.
+
+    The client keeps its HTTP connection pool between questions, answers are
+    streamed token by token, the prompt carries only the last HISTORY_MESSAGES
+    messages plus a summary of the rest, and answers to standalone questions
+    (no earlier conversation) are cached by normalized question.
+    """
+
+    def __init__(self, api_key, provider="groq", base_url=None, model=None, temperature=0.5, max_tokens=500,
+                 history_messages=HISTORY_MESSAGES, cache_size=CACHE_SIZE, timeout=60.0):
+        defaults = PROVIDERS.get(provider, {})
+        self.model = model or defaults["model"]
+        self.client = OpenAI(api_key=api_key, base_url=base_url or defaults.get("base_url"), timeout=timeout)
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.history_messages = history_messages
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def build_messages(self, session, question):
+        messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+        if session.summary:
+            messages.append({"role": "system", "content": f"Summary of the earlier conversation: {session.summary}"})
+        messages.extend(session.messages[session.summarized:])
+        messages.append({"role": "user", "content": USER_PROMPT.format(question=question)})
+        return messages
+
+    def stream_answer(self, session, question):
+        """Yields the answer in chunks as they arrive and records the exchange in `session`."""
+        standalone = not session.messages
+        key = (self.model, normalize_question(question))
+        cached = self._cache_get(key) if standalone else None
+
+        if cached is not None:
+            answer = cached
+            yield answer
+        else:
+            chunks = []
+            stream = self.client.chat.completions.create(
+                messages=self.build_messages(session, question),
+                model=self.model,
+                temperature=self.temperature,
+                max_tokens=self.max_tokens,
+                stream=True,
+            )
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    chunks.append(delta)
+                    yield delta
+            answer = "".join(chunks)
+            if standalone:
+                self._cache_put(key, answer)
+
+        session.messages.append({"role": "user", "content": question})
+        session.messages.append({"role": "assistant", "content": answer})
+        self.compact(session)
+
+    def compact(self, session):
+        """Folds messages beyond the last history_messages into session.summary."""
+        keep_from = len(session.messages) - self.history_messages
+        if keep_from <= session.summarized:
+            return
+        older = session.messages[session.summarized:keep_from]
+        conversation = "\n".join(f"{message['role']}: {message['content']}" for message in older)
+        if session.summary:
+            conversation = f"(earlier summary) {session.summary}\n{conversation}"
+        response = self.client.chat.completions.create(
+            messages=[{"role": "user", "content": SUMMARY_PROMPT.format(conversation=conversation)}],
+            model=self.model,
+            temperature=0,
+            max_tokens=200,
+        )
+        session.summary = response.choices[0].message.content
+        session.summarized = keep_from
+
+    def _cache_get(self, key):
+        with self._lock:
+            if key not in self._cache:
+                return None
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+    def _cache_put(self, key, answer):
+        with self._lock:
+            self._cache[key] = answer
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+
+def backend_from_env(api_key=None):
+    provider = os.environ.get("CHAT_PROVIDER", "groq")
+    return ChatBackend(
+        api_key=os.environ.get("CHAT_API_KEY") or api_key or "",
+        provider=provider,
+        base_url=os.environ.get("CHAT_BASE_URL"),
+        model=os.environ.get("CHAT_MODEL"),
+    )
@@ -13,6 +13,8 @@ import requests
 import plotly.express as px
 import plotly.graph_objects as go
 
+import api_client
+
 st.set_page_config(
     page_title="Check Company",
     page_icon="🏢",
@@ -21,7 +23,7 @@ st.set_page_config(
 
 def get_elevation(lat, lon):
     url = f"https://api.open-elevation.com/api/v1/lookup?locations={lat},{lon}"
-    response = requests.get(url)
+    response = requests.get(url, timeout=api_client.REQUEST_TIMEOUT)
     if response.status_code == 200:
         data = response.json()
         return data['results'][0]['elevation']
@@ -52,6 +54,24 @@ def process_address(address):
             return None
 
 
+def visualize_pollutant_dynamics(lat, lon):
+    # The backend downsamples each series to a fixed point budget, so even multi-year
+    # hourly data plots interactively
+    st.subheader("Pollutant Dynamics")
+    try:
+        series = api_client.timeseries(lat, lon, points=1000)
+    except requests.exceptions.RequestException as e:
+        st.error(f"An error occurred for timeseries: {e}")
+        return
+
+    for pollutant, (frame, who_limit) in series.items():
+        name = pollutant.replace("_conc", "").upper()
+        fig = go.Figure(go.Scattergl(x=frame["time"], y=frame["value"], mode="lines", name=name))
+        fig.add_hline(y=who_limit, line_dash="dash", line_color="red", annotation_text="WHO Limit")
+        fig.update_layout(title=f"{name} Concentration Over Time", yaxis_title="Concentration (μg/m³)", height=300)
+        st.plotly_chart(fig)
+
+
 def visualize_esg_data(esg_results, interpretation, comparison):
     st.header("ESG Data Visualization")
 
@@ -146,27 +166,22 @@ if submit_button:
             "delta": 0.1
         }
 
-        api_endpoints = {
-            'esg_results': 'http://35.228.76.200:8000/esg_results',
-            'interpretation': 'http://35.228.76.200:8000/interpretation',
-            'comparison': 'http://35.228.76.200:8000/comparison'
-        }
+        api_endpoints = ['esg_results', 'interpretation', 'comparison']
         api_responses = {}
 
-        for key, url in api_endpoints.items():
+        for key in api_endpoints:
             try:
-                response = requests.post(url, json=api_data)
-                response.raise_for_status()
-                api_responses[key] = response.json()
+                api_responses[key] = api_client.post(key, api_data)
                 st.success(f"Successfully retrieved {key.replace('_', ' ').title()}.")
             except requests.exceptions.HTTPError as http_err:
                 st.error(f"HTTP error occurred for {key}: {http_err}")
             except Exception as err:
                 st.error(f"An error occurred for {key}: {err}")
 
-        if all(key in api_responses for key in api_endpoints.keys()):
+        if all(key in api_responses for key in api_endpoints):
             visualize_esg_data(api_responses['esg_results'], api_responses['interpretation'],
                                api_responses['comparison'])
+            visualize_pollutant_dynamics(float(lat), float(lon))
         else:
             st.error("Unable to visualize data due to missing API responses.")
     else:
@@ -4,7 +4,7 @@ Ask questions about ESG and get instant answers.
 """
 
 import streamlit as st
-from groq import Groq
+from chat import ChatSession, backend_from_env
 from config import GROQ_API_KEY
 
 st.set_page_config(
@@ -13,63 +13,38 @@ st.set_page_config(
     layout="wide",
 )
 
-# Initialize session state for messages if it doesn't exist
-if "messages" not in st.session_state:
-    st.session_state.messages = []
 
-def ask_question(user_question):
-    client = Groq(api_key=GROQ_API_KEY)
+@st.cache_resource
+def get_chat_backend():
+    # One client (and HTTP connection pool) per server process, shared by all sessions
+    return backend_from_env(api_key=GROQ_API_KEY)
 
-    try:
-        chat_completion = client.chat.completions.create(
-            messages=[
-                {
-                    "role": "system",
-                    "content": "You are an AI assistant specialized in ESG (Environmental, Social, and Governance) and CSR (Corporate Social Responsibility) topics. Provide accurate and helpful information on these subjects."
-                },
-                {
-                    "role": "user",
-                    "content": f"Answer the question: {user_question}. If it's not related to ESG or CSR topics, politely inform that the question should be related to those topics and provide a brief explanation of what ESG and CSR are."
-                }
-            ],
-            model="llama3-8b-8192",
-            temperature=0.5,
-            max_tokens=500
-        )
-        return chat_completion.choices[0].message.content
-    except Exception as e:
-        return f"An error occurred: {str(e)}"
+
+# Initialize session state for the conversation if it doesn't exist
+if "chat" not in st.session_state:
+    st.session_state.chat = ChatSession()
 
 st.title("ESG + CSR Chat Assistant")
 
 # Display chat messages from history on app rerun
-for message in st.session_state.messages:
+for message in st.session_state.chat.messages:
     with st.chat_message(message["role"]):
         st.markdown(message["content"])
 
-# Prompt for user input and store it
+# Prompt for user input and stream the answer as it is generated
 if user_input := st.chat_input("You:"):
-    # Add user message to chat history
-    st.session_state.messages.append({"role": "user", "content": user_input})
-
-    # Display user message in chat
     with st.chat_message("user"):
         st.markdown(user_input)
 
-    # Get AI response
-    with st.spinner("Thinking..."):
-        response = ask_question(user_input)
-
-    # Add assistant response to chat history
-    st.session_state.messages.append({"role": "assistant", "content": response})
-
-    # Display assistant response in chat
     with st.chat_message("assistant"):
-        st.markdown(response)
+        try:
+            st.write_stream(get_chat_backend().stream_answer(st.session_state.chat, user_input))
+        except Exception as e:
+            st.markdown(f"An error occurred: {str(e)}")
 
 # Add a button to clear chat history
 if st.button("Clear Chat History"):
-    st.session_state.messages = []
+    st.session_state.chat = ChatSession()
     st.rerun()
 
 # Display a brief explanation of ESG and CSR
@@ -1,108 +1,191 @@
-import tiktoken
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+from llama_index.core import PromptTemplate
 from llama_index.core.callbacks import CallbackManager, TokenCountingHandler
-from llama_index.core import Settings
 
-from llama_index.llms.anthropic import Anthropic
-from llama_index.llms.openai import OpenAI
+INSTRUCTION_STR = (
+    "1. Convert the query to executable Python code using Pandas.\n"
+    "2. The final line of code should be a Python expression that can be called with the `eval()` function.\n"
+    "3. The code should represent a solution to the query.\n"
+    "4. PRINT ONLY THE EXPRESSION.\n"
+    "5. Do not quote the expression.\n"
+)
+
+PANDAS_PROMPT_STR = (
+    "You are working with a pandas dataframe in Python.\n"
+    "The name of the dataframe is `df`.\n"
+    "This is the result of `print(df.head())`:\n"
+    "{df_str}\n\n"
+    "Here is the result of `print(df.columns)`:\n"
+    "{df_col_str}\n\n"
+    "Follow these instructions:\n"
+    "{instruction_str}\n"
+    "Query: {query_str}\n\n"
+    "Expression:"
+)
 
-from llama_index.core.query_pipeline import (
-    QueryPipeline as QP,
-    Link,
-    InputComponent,
+RESPONSE_SYNTHESIS_PROMPT_STR = (
+    "Given an input question, synthesize a response from the query results. Output the response in Russian language."
+    "Query: {query_str}\n\n"
+    "Pandas Instructions (optional):\n{pandas_instructions}\n\n"
+    "Pandas Output: {pandas_output}\n\n"
+    "Response: "
 )
-from llama_index.experimental.query_engine.pandas import (
-    PandasInstructionParser,
+
+SQL_INSTRUCTION_STR = (
+    "1. Convert the query to a single DuckDB SQL SELECT statement over the tables above.\n"
+    "2. Filter and aggregate in SQL; return only the rows and columns needed to answer.\n"
+    "3. PRINT ONLY THE SQL.\n"
+    "4. Do not quote the SQL or wrap it in a code block.\n"
 )
-from llama_index.core import Settings
-from llama_index.core import PromptTemplate
+
+SQL_PROMPT_STR = (
+    "You are working with a DuckDB database.\n"
+    "These are the tables and their columns:\n"
+    "{schema_str}\n\n"
+    "Follow these instructions:\n"
+    "{instruction_str}\n"
+    "Query: {query_str}\n\n"
+    "SQL:"
+)
+
+SQL_RESPONSE_SYNTHESIS_PROMPT_STR = (
+    "Given an input question, synthesize a response from the query results. Output the response in Russian language."
+    "Query: {query_str}\n\n"
+    "SQL (optional):\n{sql}\n\n"
+    "SQL Output: {sql_output}\n\n"
+    "Response: "
+)
+
+OPENAI_MODEL = "gpt-3.5-turbo-0125"
+ANTHROPIC_MODEL = "claude-3-haiku-20240307"
+
+# Сколько ответов (на экземпляр RAG) и сгенерированных выражений (общий кэш) держать в памяти
+CACHE_SIZE = 256
+
+
+def dataframe_version(df: pd.DataFrame) -> str:
+    """Хэш содержимого и схемы DataFrame: одинаковые данные дают одну и ту же версию."""
+    digest = hashlib.sha256()
+    digest.update(repr(list(df.columns)).encode())
+    digest.update(repr(list(df.dtypes.astype(str))).encode())
+    digest.update(pd.util.hash_pandas_object(df.astype(str), index=True).values.tobytes())
+    return digest.hexdigest()[:16]
+
+
+def normalize_question(question: str) -> str:
+    # Регистр, лишние пробелы и завершающая пунктуация не делают вопрос другим
+    return re.sub(r"\s+", " ", question).strip().rstrip("?!. ").casefold()
+
+
+def make_llm(model: str, callback_manager=None):
+    """LLM для одного экземпляра RAG; глобальные llama_index.Settings не меняются."""
+    if model == "openai":
+        from llama_index.llms.openai import OpenAI
+        return OpenAI(model=OPENAI_MODEL, callback_manager=callback_manager)
+    if model == "anthropic":
+        from llama_index.llms.anthropic import Anthropic
+        return Anthropic(model=ANTHROPIC_MODEL, callback_manager=callback_manager)
+    if model == "mock":
+        from llama_index.core.llms import MockLLM
+        return MockLLM(callback_manager=callback_manager)
+    raise ValueError(f"Unsupported model: {model}")
+
+
+class _LRUCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._items:
+                return None
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key, value) -> None:
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+
+_expressions = _LRUCache(CACHE_SIZE)
 
 
 class RAG:
-    def __init__(
-        self,
-        df,
-        model="openai",
-    ) -> None:
-        pass
-        self.model = model
-        if self.model == "openai":
-            self.token_counter = TokenCountingHandler(
-                tokenizer=tiktoken.encoding_for_model("gpt-3.5-turbo-0125").encode
-            )
-            Settings.llm = OpenAI(model="gpt-3.5-turbo-0125")
-            Settings.callback_manager = CallbackManager([self.token_counter])
-
-        if self.model == "anthropic":
-            Settings.llm = Anthropic(model="claude-3-haiku-20240307")
-        instruction_str = (
-            "1. Convert the query to executable Python code using Pandas.\n"
-            "2. The final line of code should be a Python expression that can be called with the `eval()` function.\n"
-            "3. The code should represent a solution to the query.\n"
-            "4. PRINT ONLY THE EXPRESSION.\n"
-            "5. Do not quote the expression.\n"
-        )
+    """Вопрос → выражение pandas (LLM) → результат над df → ответ (LLM).
 
-        pandas_prompt_str = (
-            "You are working with a pandas dataframe in Python.\n"
-            "The name of the dataframe is `df`.\n"
-            "This is the result of `print(df.head())`:\n"
-            "{df_str}\n\n"
-            "Here is the result of `print(df.columns)`:\n"
-            "{df_col_str}\n\n"
-            "Follow these instructions:\n"
-            "{instruction_str}\n"
-            "Query: {query_str}\n\n"
-            "Expression:"
-        )
+    Промпты и парсер строятся один раз на экземпляр; LLM и счётчик токенов —
+    свои у каждого экземпляра, поэтому параллельные сессии не мешают друг другу.
+    Готовые ответы и сгенерированные выражения кэшируются по нормализованному
+    вопросу и версии данных: повтор вопроса не вызывает LLM, а тот же вопрос над
+    обновлёнными данными пропускает только первый вызов.
+    Для тестов можно передать свой `llm` (например, MockLLM).
+    """
 
-        response_synthesis_prompt_str = (
-            "Given an input question, synthesize a response from the query results. Output the response in Russian language."
-            "Query: {query_str}\n\n"
-            "Pandas Instructions (optional):\n{pandas_instructions}\n\n"
-            "Pandas Output: {pandas_output}\n\n"
-            "Response: "
-        )
+    def __init__(self, df: pd.DataFrame, model: str = "openai", llm=None, cache_size: int = CACHE_SIZE) -> None:
+        # llama-index-experimental нужен только pandas-варианту; SQLRAG работает без него
+        from llama_index.experimental.query_engine.pandas import PandasInstructionParser
+
+        self.model = model
+        self.df = df
+        self.version = dataframe_version(df)
 
-        pandas_prompt = PromptTemplate(pandas_prompt_str).partial_format(
-            instruction_str=instruction_str,
+        self.token_counter = None
+        callback_manager = None
+        if llm is None and model == "openai":
+            import tiktoken
+            self.token_counter = TokenCountingHandler(tokenizer=tiktoken.encoding_for_model(OPENAI_MODEL).encode)
+            callback_manager = CallbackManager([self.token_counter])
+        self.llm = llm if llm is not None else make_llm(model, callback_manager)
+
+        self.pandas_prompt = PromptTemplate(PANDAS_PROMPT_STR).partial_format(
+            instruction_str=INSTRUCTION_STR,
             df_str=df.head(5),
             df_col_str=df.columns,
         )
-        pandas_output_parser = PandasInstructionParser(df)
-        response_synthesis_prompt = PromptTemplate(response_synthesis_prompt_str)
-        self.qp = QP(
-            modules={
-                "input": InputComponent(),
-                "pandas_prompt": pandas_prompt,
-                "llm1": Settings.llm,
-                "pandas_output_parser": pandas_output_parser,
-                "response_synthesis_prompt": response_synthesis_prompt,
-                "llm2": Settings.llm,
-            },
-            verbose=True,
-        )
-        self.qp.add_chain(["input", "pandas_prompt", "llm1", "pandas_output_parser"])
-        self.qp.add_links(
-            [
-                Link("input", "response_synthesis_prompt", dest_key="query_str"),
-                Link(
-                    "llm1", "response_synthesis_prompt", dest_key="pandas_instructions"
-                ),
-                Link(
-                    "pandas_output_parser",
-                    "response_synthesis_prompt",
-                    dest_key="pandas_output",
-                ),
-            ]
-        )
-        # add link from response synthesis prompt to llm2
-        self.qp.add_link("response_synthesis_prompt", "llm2")
+        self.pandas_output_parser = PandasInstructionParser(df)
+        self.response_synthesis_prompt = PromptTemplate(RESPONSE_SYNTHESIS_PROMPT_STR)
+
+        self.answers = _LRUCache(cache_size)
+        # Общий для всех экземпляров: переживает смену версии данных
+        self.expressions = _expressions
 
-    def answer_question(self, question: str):
-        response = self.qp.run(
+    def pandas_expression(self, question: str) -> str:
+        # Выражение зависит только от схемы и вопроса, поэтому ключ — без версии данных
+        key = (self.model, self._schema_key(), normalize_question(question))
+        expression = self.expressions.get(key)
+        if expression is None:
+            expression = self.llm.complete(self.pandas_prompt.format(query_str=question)).text
+            self.expressions.put(key, expression)
+        return expression
+
+    def answer_question(self, question: str) -> str:
+        key = (self.version, normalize_question(question))
+        answer = self.answers.get(key)
+        if answer is not None:
+            return answer
+
+        pandas_instructions = self.pandas_expression(question)
+        pandas_output = self.pandas_output_parser.parse(pandas_instructions)
+        prompt = self.response_synthesis_prompt.format(
             query_str=question,
+            pandas_instructions=pandas_instructions,
+            pandas_output=pandas_output,
         )
-        if self.model == "openai":
+        answer = self.llm.complete(prompt).text
+        self.answers.put(key, answer)
+
+        if self.token_counter is not None:
             print(
                 "Embedding Tokens: ",
                 self.token_counter.total_embedding_token_count,
@@ -117,4 +200,84 @@ class RAG:
                 self.token_counter.total_llm_token_count,
                 "\n",
             )
-        return response
\ No newline at end of file
+        return answer
+
+    def _schema_key(self) -> str:
+        return repr([(column, str(dtype)) for column, dtype in self.df.dtypes.items()])
+
+
+class SQLRAG:
+    """Как RAG, но LLM пишет SQL, который выполняется в SQLEngine (DuckDB над Parquet).
+
+    Запрос читает только нужные столбцы и группы строк, поэтому работает и на
+    таблицах, не помещающихся в память. Кэши те же, что у RAG; версия данных —
+    размеры и времена изменения файлов Parquet.
+    """
+
+    def __init__(self, engine, model: str = "openai", llm=None, cache_size: int = CACHE_SIZE) -> None:
+        self.model = model
+        self.engine = engine
+        self.version = engine.version
+        self.schema = engine.schema()
+        self.llm = llm if llm is not None else make_llm(model)
+
+        self.sql_prompt = PromptTemplate(SQL_PROMPT_STR).partial_format(
+            instruction_str=SQL_INSTRUCTION_STR,
+            schema_str=self.schema,
+        )
+        self.response_synthesis_prompt = PromptTemplate(SQL_RESPONSE_SYNTHESIS_PROMPT_STR)
+
+        self.answers = _LRUCache(cache_size)
+        self.expressions = _expressions
+
+    def sql(self, question: str) -> str:
+        key = ("sql", self.model, self.schema, normalize_question(question))
+        sql = self.expressions.get(key)
+        if sql is None:
+            sql = _strip_code_fence(self.llm.complete(self.sql_prompt.format(query_str=question)).text)
+            self.expressions.put(key, sql)
+        return sql
+
+    def answer_question(self, question: str) -> str:
+        key = (self.version, normalize_question(question))
+        answer = self.answers.get(key)
+        if answer is not None:
+            return answer
+
+        sql = self.sql(question)
+        try:
+            sql_output = self.engine.query(sql).to_string(index=False)
+        except Exception as e:
+            # Как и PandasInstructionParser, отдаём ошибку во второй вызов LLM, но не кэшируем ответ
+            sql_output = f"Error: {e}"
+            key = None
+        prompt = self.response_synthesis_prompt.format(query_str=question, sql=sql, sql_output=sql_output)
+        answer = self.llm.complete(prompt).text
+        if key is not None:
+            self.answers.put(key, answer)
+        return answer
+
+
+def _strip_code_fence(text: str) -> str:
+    text = text.strip()
+    match = re.match(r"^```(?:sql)?\s*(.*?)\s*```$", text, re.DOTALL | re.IGNORECASE)
+    return match.group(1) if match else text
+
+
+_instances = OrderedDict()
+_instances_lock = threading.Lock()
+_MAX_INSTANCES = 8
+
+
+def get_rag(df: pd.DataFrame, model: str = "openai") -> RAG:
+    """RAG для данной версии DataFrame; строится один раз и переиспользуется между сессиями."""
+    key = (dataframe_version(df), model)
+    with _instances_lock:
+        rag = _instances.get(key)
+        if rag is None:
+            rag = _instances[key] = RAG(df, model=model)
+            while len(_instances) > _MAX_INSTANCES:
+                _instances.popitem(last=False)
+        else:
+            _instances.move_to_end(key)
+        return rag
@@ -0,0 +1,177 @@
+"""
+Composite ESG scoring from the weights in Methodolody.md.
+
+All companies are scored at once: per-company weights are rows gathered from
+the industry weight matrix, so a portfolio is one (companies x indicators)
+multiply-and-sum. Indicators and components without data are NaN and drop out
+of their weighted average (the remaining weights are renormalized), which is
+how a score built only from satellite air quality stays comparable with one
+that has the full set of inputs.
+"""
+
+import os
+import re
+
+import numpy as np
+
+METHODOLOGY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Methodolody.md")
+
+ENVIRONMENTAL_INDICATORS = [
+    "GHG Emissions", "Air Pollution", "Deforestation", "Water Pollution",
+    "Land Use Change", "Thermal Anomalies", "Coastline Changes", "Desertification",
+]
+
+# Section 2.3; used when Methodolody.md is not available
+DEFAULT_ENVIRONMENTAL_WEIGHTS = {
+    "Energy": [0.25, 0.20, 0.10, 0.10, 0.15, 0.10, 0.05, 0.05],
+    "Agriculture": [0.15, 0.10, 0.20, 0.15, 0.15, 0.05, 0.05, 0.15],
+    "Manufacturing": [0.20, 0.20, 0.10, 0.15, 0.15, 0.10, 0.05, 0.05],
+    "IT": [0.30, 0.15, 0.10, 0.10, 0.15, 0.10, 0.05, 0.05],
+    "Maritime Transport": [0.25, 0.15, 0.05, 0.25, 0.10, 0.05, 0.15, 0.00],
+    "Extractive Industries": [0.20, 0.15, 0.15, 0.15, 0.20, 0.05, 0.05, 0.05],
+}
+
+# Section 7.2
+ESG_WEIGHTS = {"E": 0.35, "S": 0.25, "G": 0.25, "I&A": 0.15}
+OVERALL_WEIGHTS = {"ESG": 0.75, "CSR": 0.25}
+
+# Section 8
+SEA_INDICATORS = ("Water Pollution", "Coastline Changes")
+ARID_INDICATORS = ("Desertification",)
+SPECIFICS_BOOST = 0.1
+
+# Dashboard industries (static.industries_list and company records) -> methodology rows
+INDUSTRY_ALIASES = {
+    "Technology": "IT",
+    "Telecommunications": "IT",
+    "Mining": "Extractive Industries",
+    "Fishing": "Maritime Transport",
+    "Transportation and Logistics": "Manufacturing",
+    "Transportation": "Manufacturing",
+    "Construction": "Manufacturing",
+    "Materials": "Manufacturing",
+    "Recycling": "Manufacturing",
+}
+
+# Industries without their own row use the average of all rows
+DEFAULT_INDUSTRY = "Average"
+
+
+def parse_environmental_weights(text):
+    """Reads the section 2.3 table: returns (industries, indicators, weights[industry, indicator])."""
+    section = text.split("### 2.3", 1)[1] if "### 2.3" in text else text
+    rows = [line.strip().strip("|").split("|") for line in section.splitlines() if line.strip().startswith("|")]
+    if len(rows) < 3:
+        raise ValueError("No environmental weights table found")
+    indicators = [cell.strip() for cell in rows[0][1:]]
+    industries, weights = [], []
+    for row in rows[1:]:
+        cells = [cell.strip() for cell in row]
+        if re.fullmatch(r"-+", cells[0].replace(":", "")):
+            continue
+        industries.append(cells[0])
+        weights.append([float(cell) for cell in cells[1:]])
+    return industries, indicators, np.array(weights, dtype=np.float64)
+
+
+def load_environmental_weights(path=METHODOLOGY_FILE):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return parse_environmental_weights(f.read())
+    except (OSError, ValueError):
+        industries = list(DEFAULT_ENVIRONMENTAL_WEIGHTS)
+        weights = np.array([DEFAULT_ENVIRONMENTAL_WEIGHTS[i] for i in industries], dtype=np.float64)
+        return industries, list(ENVIRONMENTAL_INDICATORS), weights
+
+
+def _weighted_mean(values, weights):
+    # values (n, k) with NaN for missing data, weights (n, k) or (k,)
+    present = ~np.isnan(values)
+    weights = np.broadcast_to(weights, values.shape)
+    total = np.where(present, weights, 0.0).sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(present, values * weights, 0.0).sum(axis=1) / total
+
+
+def _boost(weights, columns, amount):
+    # +amount to each boosted column, the rest scaled down so every row still sums to its old total
+    boosted = np.zeros(weights.shape[1], dtype=bool)
+    boosted[columns] = True
+    row_total = weights.sum(axis=1, keepdims=True)
+    others = np.where(boosted, 0.0, weights)
+    others_total = others.sum(axis=1, keepdims=True)
+    remaining = row_total - weights[:, boosted].sum(axis=1, keepdims=True) - amount * boosted.sum()
+    with np.errstate(invalid="ignore", divide="ignore"):
+        scaled = np.where(others_total > 0, others * np.clip(remaining, 0, None) / others_total, 0.0)
+    return np.where(boosted, weights + amount, scaled)
+
+
+class ScoringEngine:
+    def __init__(self, industries=None, indicators=None, weights=None, esg_weights=None, overall_weights=None):
+        if weights is None:
+            industries, indicators, weights = load_environmental_weights()
+        self.industries = list(industries) + [DEFAULT_INDUSTRY]
+        self.indicators = list(indicators)
+        weights = np.asarray(weights, dtype=np.float64)
+        self.weights = np.vstack([weights, weights.mean(axis=0, keepdims=True)])
+        self.esg_weights = dict(esg_weights or ESG_WEIGHTS)
+        self.overall_weights = dict(overall_weights or OVERALL_WEIGHTS)
+        self._industry_index = {name: i for i, name in enumerate(self.industries)}
+
+    def reweight(self, industry=None, indicator_weights=None, esg_weights=None, overall_weights=None):
+        """New engine with some weights replaced; nothing else is recomputed until score()."""
+        weights = self.weights[:-1].copy()
+        if indicator_weights:
+            rows = [self._industry_index[industry]] if industry else range(len(weights))
+            for indicator, value in indicator_weights.items():
+                weights[list(rows), self.indicators.index(indicator)] = value
+        return ScoringEngine(self.industries[:-1], self.indicators, weights,
+                             esg_weights={**self.esg_weights, **(esg_weights or {})},
+                             overall_weights={**self.overall_weights, **(overall_weights or {})})
+
+    def industry_codes(self, industries):
+        default = self._industry_index[DEFAULT_INDUSTRY]
+        return np.array([self._industry_index.get(INDUSTRY_ALIASES.get(name, name), default) for name in industries])
+
+    def company_weights(self, industry_codes, sea=None, arid=None):
+        """(n, indicators) weights per company, with the section 8 adjustments applied."""
+        weights = self.weights[industry_codes]
+        for flags, names in ((sea, SEA_INDICATORS), (arid, ARID_INDICATORS)):
+            if flags is None:
+                continue
+            flags = np.asarray(flags, dtype=bool)
+            if flags.any():
+                columns = [self.indicators.index(name) for name in names]
+                weights[flags] = _boost(weights[flags], columns, SPECIFICS_BOOST)
+        return weights
+
+    def score(self, industries, indicators, components=None, sea=None, arid=None):
+        """E, S, G, I&A, CSR, ESG and Overall scores (0..1) for every company.
+
+        indicators: {environmental indicator name: array of n scores in 0..1, 1 best};
+        components: optional {"S" | "G" | "CSR" | "I&A": array of n scores}.
+        Anything not given is missing data.
+        """
+        n = len(industries)
+        values = np.full((n, len(self.indicators)), np.nan)
+        for name, column in indicators.items():
+            values[:, self.indicators.index(name)] = column
+
+        weights = self.company_weights(self.industry_codes(industries), sea=sea, arid=arid)
+        scores = {"E": _weighted_mean(values, weights)}
+        for name in ("S", "G", "I&A", "CSR"):
+            column = (components or {}).get(name)
+            scores[name] = np.full(n, np.nan) if column is None else np.asarray(column, dtype=np.float64)
+
+        esg_names = list(self.esg_weights)
+        scores["ESG"] = _weighted_mean(np.column_stack([scores[name] for name in esg_names]),
+                                       np.array([self.esg_weights[name] for name in esg_names]))
+        overall_names = list(self.overall_weights)
+        scores["Overall"] = _weighted_mean(np.column_stack([scores[name] for name in overall_names]),
+                                           np.array([self.overall_weights[name] for name in overall_names]))
+        return scores
+
+
+def air_pollution_score(pollution_index):
+    """Satellite air-quality indicator on the 0..1 (1 best) scale from the backend pollution index."""
+    return np.clip(1.0 - np.asarray(pollution_index, dtype=np.float64), 0.0, 1.0)
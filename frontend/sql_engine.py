@@ -0,0 +1,124 @@
+import glob
+import hashlib
+import os
+import re
+import threading
+
+import duckdb
+import pandas as pd
+
+# Upper bound on rows handed back to the caller (and to the LLM prompt)
+MAX_RESULT_ROWS = 1000
+
+_TABLE_NAME = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+class SQLSandboxError(ValueError):
+    pass
+
+
+def tables_from_dir(directory):
+    """Maps every Parquet file (or hive-partitioned subdirectory) in `directory` to a table name."""
+    tables = {}
+    for entry in sorted(os.listdir(directory)):
+        path = os.path.join(directory, entry)
+        name, ext = os.path.splitext(entry)
+        if os.path.isdir(path):
+            tables[entry] = os.path.join(path, "**", "*.parquet")
+        elif ext == ".parquet":
+            tables[name] = path
+    return tables
+
+
+class SQLEngine:
+    """Read-only DuckDB over Parquet score and concentration tables.
+
+    Each table is a view over read_parquet, so filters and projections in the
+    query are pushed down into the Parquet scan and only the needed row groups
+    and columns are read. After the views are created the connection loses all
+    file access except to those tables, its configuration is locked, and only a
+    single SELECT statement is accepted per query.
+    """
+
+    def __init__(self, tables, memory_limit="1GB", threads=None):
+        self.tables = dict(tables)
+        for name in self.tables:
+            if not _TABLE_NAME.match(name):
+                raise ValueError(f"Invalid table name: {name}")
+
+        self.conn = duckdb.connect(":memory:")
+        allowed_paths, allowed_directories = [], []
+        for name, path in self.tables.items():
+            path = os.path.abspath(path)
+            if glob.has_magic(path):
+                allowed_directories.append(path[:path.index("*")].rstrip(os.sep) + os.sep)
+                source = f"read_parquet({_literal(path)}, hive_partitioning = true)"
+            else:
+                allowed_paths.append(path)
+                source = f"read_parquet({_literal(path)})"
+            self.conn.execute(f'CREATE VIEW "{name}" AS SELECT * FROM {source}')
+
+        self.conn.execute(f"SET memory_limit = {_literal(memory_limit)}")
+        if threads is not None:
+            self.conn.execute(f"SET threads = {int(threads)}")
+        self.conn.execute(f"SET allowed_paths = [{', '.join(map(_literal, allowed_paths))}]")
+        self.conn.execute(f"SET allowed_directories = [{', '.join(map(_literal, allowed_directories))}]")
+        self.conn.execute("SET enable_external_access = false")
+        self.conn.execute("SET lock_configuration = true")
+        self._local = threading.local()
+
+    @property
+    def version(self):
+        """Changes whenever any underlying Parquet file is rewritten."""
+        digest = hashlib.sha256()
+        for name, path in sorted(self.tables.items()):
+            for file in sorted(glob.glob(path, recursive=True)):
+                stat = os.stat(file)
+                digest.update(f"{name}:{file}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+        return digest.hexdigest()[:16]
+
+    def _cursor(self):
+        # DuckDB connections are not thread-safe; each thread gets its own cursor
+        cursor = getattr(self._local, "cursor", None)
+        if cursor is None:
+            cursor = self._local.cursor = self.conn.cursor()
+        return cursor
+
+    def schema(self):
+        """Table and column listing for the SQL generation prompt."""
+        lines = []
+        for name in self.tables:
+            columns = self._cursor().execute(f'DESCRIBE "{name}"').fetchall()
+            lines.append(f"{name}({', '.join(f'{column} {dtype}' for column, dtype, *_ in columns)})")
+        return "\n".join(lines)
+
+    def query(self, sql, max_rows=MAX_RESULT_ROWS):
+        sql = validate_select(sql)
+        return self._cursor().execute(f"SELECT * FROM ({sql}) LIMIT {int(max_rows)}").df()
+
+
+def validate_select(sql):
+    """Returns the statement without trailing semicolons if it is a single SELECT."""
+    sql = sql.strip().rstrip(";").strip()
+    try:
+        statements = duckdb.extract_statements(sql)
+    except duckdb.Error as e:
+        raise SQLSandboxError(f"Invalid SQL: {e}") from e
+    if len(statements) != 1:
+        raise SQLSandboxError("Exactly one SQL statement is allowed")
+    if statements[0].type != duckdb.StatementType.SELECT:
+        raise SQLSandboxError(f"Only SELECT statements are allowed, got {statements[0].type.name}")
+    return sql
+
+
+def _literal(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def write_parquet(df: pd.DataFrame, path, partition_by=None):
+    """Writes a table for SQLEngine; partition_by produces a hive-partitioned directory."""
+    if partition_by:
+        df.to_parquet(path, partition_cols=list(partition_by), index=False)
+    else:
+        df.to_parquet(path, index=False, compression="zstd")
+    return path
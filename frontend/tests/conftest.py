@@ -0,0 +1,94 @@
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+# Frontend modules are imported by name (from chat import ...), as when Streamlit runs from frontend/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class OpenAIStub:
+    """Local OpenAI-compatible /v1/chat/completions endpoint with scripted answers.
+
+    `reply(request)` gets the decoded request body and returns the answer text;
+    streamed requests get it back word by word as server-sent events. Every
+    request body is kept in `requests`.
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.reply = lambda request: "stub answer"
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                stub.requests.append(request)
+                answer = stub.reply(request)
+                if request.get("stream"):
+                    self._stream(request, answer)
+                else:
+                    self._send(200, "application/json", json.dumps(_completion(request, answer)).encode())
+
+            def _stream(self, request, answer):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.end_headers()
+                words = answer.split(" ")
+                for i, word in enumerate(words):
+                    chunk = word if i == len(words) - 1 else word + " "
+                    self.wfile.write(f"data: {json.dumps(_chunk(request, chunk))}\n\n".encode())
+                self.wfile.write(f"data: {json.dumps(_chunk(request, None, 'stop'))}\n\n".encode())
+                self.wfile.write(b"data: [DONE]\n\n")
+
+            def _send(self, status, content_type, body):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+
+    def prompts(self):
+        """Last user message of every request, in order."""
+        return [request["messages"][-1]["content"] for request in self.requests]
+
+
+def _completion(request, answer):
+    return {
+        "id": "chatcmpl-stub",
+        "object": "chat.completion",
+        "created": 0,
+        "model": request["model"],
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+    }
+
+
+def _chunk(request, content, finish_reason=None):
+    delta = {"content": content} if content is not None else {}
+    return {
+        "id": "chatcmpl-stub",
+        "object": "chat.completion.chunk",
+        "created": 0,
+        "model": request["model"],
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+@pytest.fixture
+def openai_stub():
+    stub = OpenAIStub()
+    thread = threading.Thread(target=stub.server.serve_forever, daemon=True)
+    thread.start()
+    yield stub
+    stub.server.shutdown()
+    stub.server.server_close()
@@ -0,0 +1,69 @@
+from chat import SUMMARY_PROMPT, SYSTEM_PROMPT, ChatBackend, ChatSession, backend_from_env
+
+
+def _backend(openai_stub, **kwargs):
+    return ChatBackend(api_key="test", base_url=openai_stub.base_url, model="stub-model", **kwargs)
+
+
+def test_answer_is_streamed_in_chunks_and_recorded(openai_stub):
+    openai_stub.reply = lambda request: "ESG covers environmental, social and governance factors."
+    session = ChatSession()
+
+    chunks = list(_backend(openai_stub).stream_answer(session, "What is ESG?"))
+    assert len(chunks) == 7
+    assert "".join(chunks) == "ESG covers environmental, social and governance factors."
+    assert session.messages == [
+        {"role": "user", "content": "What is ESG?"},
+        {"role": "assistant", "content": "ESG covers environmental, social and governance factors."},
+    ]
+
+    request = openai_stub.requests[0]
+    assert request["stream"] is True and request["model"] == "stub-model"
+    assert request["messages"][0] == {"role": "system", "content": SYSTEM_PROMPT}
+    assert "What is ESG?" in request["messages"][-1]["content"]
+
+
+def test_standalone_answers_are_cached_but_follow_ups_are_not(openai_stub):
+    backend = _backend(openai_stub)
+    answer = "".join(backend.stream_answer(ChatSession(), "What is CSR?"))
+
+    # A new conversation with the same question (modulo case and punctuation) skips the LLM
+    other = ChatSession()
+    assert list(backend.stream_answer(other, "  what is csr ")) == [answer]
+    assert len(openai_stub.requests) == 1
+
+    # The same text as a follow-up depends on the conversation and goes to the LLM
+    list(backend.stream_answer(other, "What is CSR?"))
+    assert len(openai_stub.requests) == 2
+
+
+def test_older_messages_are_folded_into_summary(openai_stub):
+    openai_stub.reply = lambda request: "summary" if not request.get("stream") else "answer"
+    backend = _backend(openai_stub, history_messages=2)
+    session = ChatSession()
+
+    list(backend.stream_answer(session, "first"))
+    assert session.summary == "" and len(openai_stub.requests) == 1
+
+    list(backend.stream_answer(session, "second"))
+    summary_request = openai_stub.requests[-1]
+    assert summary_request.get("stream") is not True
+    assert summary_request["messages"][0]["content"] == SUMMARY_PROMPT.format(
+        conversation="user: first\nassistant: answer")
+    assert session.summary == "summary" and session.summarized == 2
+
+    list(backend.stream_answer(session, "third"))
+    messages = [request for request in openai_stub.requests if request.get("stream")][-1]["messages"]
+    assert messages[1] == {"role": "system", "content": "Summary of the earlier conversation: summary"}
+    assert [message["content"] for message in messages[2:4]] == ["second", "answer"]
+    assert len(messages) == 5
+
+
+def test_backend_from_env_targets_configured_endpoint(openai_stub, monkeypatch):
+    monkeypatch.setenv("CHAT_PROVIDER", "openai")
+    monkeypatch.setenv("CHAT_BASE_URL", openai_stub.base_url)
+    monkeypatch.setenv("CHAT_MODEL", "local-model")
+    monkeypatch.setenv("CHAT_API_KEY", "test")
+
+    assert "".join(backend_from_env().stream_answer(ChatSession(), "Hi")) == "stub answer"
+    assert openai_stub.requests[0]["model"] == "local-model"
@@ -0,0 +1,97 @@
+import pandas as pd
+import pytest
+
+import rag
+from sql_engine import SQLEngine, write_parquet
+
+
+@pytest.fixture(autouse=True)
+def fresh_expressions(monkeypatch):
+    # The generated-expression cache is shared by all instances; isolate it per test
+    monkeypatch.setattr(rag, "_expressions", rag._LRUCache(rag.CACHE_SIZE))
+
+
+@pytest.fixture
+def stub_llm(openai_stub):
+    from llama_index.llms.openai import OpenAI
+    return OpenAI(model=rag.OPENAI_MODEL, api_base=openai_stub.base_url, api_key="test", max_retries=0)
+
+
+@pytest.fixture
+def scores_engine(tmp_path):
+    path = tmp_path / "scores.parquet"
+    write_parquet(pd.DataFrame({"company": ["Alpha", "Beta", "Gamma"], "score": [0.4, 0.9, 0.7]}), path)
+    return SQLEngine({"scores": str(path)})
+
+
+def _scripted(generated):
+    """First call of a question returns `generated`, the synthesis call echoes its query output."""
+    def reply(request):
+        prompt = request["messages"][-1]["content"]
+        if prompt.rstrip().endswith(("SQL:", "Expression:")):
+            return generated
+        return "Ответ: " + prompt.rsplit("Output:", 1)[1].split("Response:")[0].strip()
+    return reply
+
+
+def test_sql_rag_answers_and_caches_through_openai_stub(openai_stub, stub_llm, scores_engine):
+    openai_stub.reply = _scripted("```sql\nSELECT company FROM scores ORDER BY score DESC LIMIT 1\n```")
+    sql_rag = rag.SQLRAG(scores_engine, llm=stub_llm)
+
+    answer = sql_rag.answer_question("Which company has the best score?")
+    assert answer == "Ответ: company\n   Beta"
+    assert len(openai_stub.requests) == 2
+    assert "scores(company VARCHAR, score DOUBLE)" in openai_stub.prompts()[0]
+    assert "SELECT company FROM scores" in openai_stub.prompts()[1] and "```" not in openai_stub.prompts()[1]
+
+    assert sql_rag.answer_question("  which company has the BEST score ") == answer
+    assert len(openai_stub.requests) == 2
+
+
+def test_sql_rag_reuses_generated_sql_after_data_changes(openai_stub, stub_llm, tmp_path, scores_engine):
+    openai_stub.reply = _scripted("SELECT company FROM scores ORDER BY score DESC LIMIT 1")
+    first = rag.SQLRAG(scores_engine, llm=stub_llm)
+    first.answer_question("Best company?")
+
+    write_parquet(pd.DataFrame({"company": ["Alpha", "Beta", "Gamma"], "score": [0.4, 0.1, 0.7]}),
+                  tmp_path / "scores.parquet")
+    updated = rag.SQLRAG(scores_engine, llm=stub_llm)
+    assert updated.version != first.version
+    assert updated.answer_question("Best company?") == "Ответ: company\n  Gamma"
+    # Only the synthesis call: the SQL is cached by schema and question
+    assert len(openai_stub.requests) == 3
+
+
+def test_sql_rag_does_not_cache_rejected_sql(openai_stub, stub_llm, scores_engine):
+    openai_stub.reply = _scripted("DROP TABLE scores")
+    sql_rag = rag.SQLRAG(scores_engine, llm=stub_llm)
+
+    assert sql_rag.answer_question("Drop everything").startswith("Ответ: Error: Only SELECT statements")
+    sql_rag.answer_question("Drop everything")
+    # The SQL is cached, but the failed answer is not: the synthesis call repeats
+    assert len(openai_stub.requests) == 3
+
+
+def test_pandas_rag_answers_and_caches_through_openai_stub(openai_stub, stub_llm):
+    pytest.importorskip("llama_index.experimental.query_engine.pandas", exc_type=ImportError)
+    openai_stub.reply = _scripted("df['score'].max()")
+    df = pd.DataFrame({"company": ["Alpha", "Beta"], "score": [0.4, 0.9]})
+
+    pandas_rag = rag.RAG(df, llm=stub_llm)
+    assert pandas_rag.answer_question("Max score?") == "Ответ: 0.9"
+    assert pandas_rag.answer_question("max score") == "Ответ: 0.9"
+    assert len(openai_stub.requests) == 2
+
+    updated = rag.RAG(df.assign(score=[0.4, 0.5]), llm=stub_llm)
+    assert updated.answer_question("Max score?") == "Ответ: 0.5"
+    assert len(openai_stub.requests) == 3
+
+
+def test_get_rag_builds_once_per_data_version(monkeypatch):
+    pytest.importorskip("llama_index.experimental.query_engine.pandas", exc_type=ImportError)
+    monkeypatch.setattr(rag, "_instances", type(rag._instances)())
+    df = pd.DataFrame({"company": ["Alpha", "Beta"], "score": [0.4, 0.9]})
+
+    first = rag.get_rag(df, model="mock")
+    assert rag.get_rag(df.copy(), model="mock") is first
+    assert rag.get_rag(df.assign(score=[0.4, 0.5]), model="mock") is not first